@@ -1,3 +1,4 @@
+from jmap import errors
 from .personal import PersonalAccount
 from .imap import ImapAccount
 from .smtp import SmtpAccountMixin
@@ -21,11 +22,30 @@ class UserAccount(ImapAccount, ProxyBlobMixin, SmtpAccountMixin, PersonalAccount
         await ImapAccount.ainit(self)
 
     async def upload(self, stream, type=None):
-        # Overrides ImapAccount.upload
+        # Overrides ImapAccount.upload, blobs are kept by storage service
         return await ProxyBlobMixin.upload(self, stream, type)
 
     async def download(self, blobId: str):
-        try:
-            return await ProxyBlobMixin.download(self, blobId)
-        except Exception:
-            return await ImapAccount.download(self, blobId)
+        if blobId[:1] == 'G':
+            # blobs of messages and their parts are in IMAP
+            try:
+                return await ImapAccount.download(self, blobId)
+            except errors.notFound:
+                pass
+        return await ProxyBlobMixin.download(self, blobId)
+
+    async def download_stream(self, blobId: str, start=0, stop=None):
+        if blobId[:1] == 'G':
+            try:
+                return await ImapAccount.download_stream(self, blobId, start, stop)
+            except errors.notFound:
+                pass
+        return await ProxyBlobMixin.download_stream(self, blobId, start, stop)
+
+    async def blob_copy(self, fromAccount, blobId: str):
+        if blobId[:1] == 'G':
+            try:
+                return await ImapAccount.blob_copy(self, fromAccount, blobId)
+            except errors.notFound:
+                pass
+        return await ProxyBlobMixin.blob_copy(self, fromAccount, blobId)
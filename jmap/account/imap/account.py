@@ -1,21 +1,77 @@
 import asyncio
+from base64 import encodebytes
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 import itertools
 from datetime import datetime
+import os
 import re
+import time
 from operator import itemgetter
 
-from jmap import errors
+import aiofiles.tempfile
+
+from jmap import errors, plan
+from jmap.cache import LRUCache
 from jmap.core import MAX_OBJECTS_IN_GET
-from jmap.parse import asAddresses, asDate, asGroupedAddresses, asMessageIds, asRaw, asText, asURLs, htmltotext
+from jmap.fragment import Fragment, dumps
+from jmap.journal import ChangeJournal
+from jmap.parse import asAddresses, asDate, asGroupedAddresses, asMessageIds, asRaw, asText, asURLs, \
+    parse_email, encoded_size, truncate_utf8
 from .aioimaplib import IMAP4, parse_list_status, parse_esearch, parse_status, parse_fetch, iter_messageset, \
     encode_messageset, parse_thread, unquoted, quoted, parse_metadata
-from .email import ImapEmail, EmailState, keyword2flag
+from .index import EmailIndex
+from .fts import TextIndex, TEXT_COLUMNS
+from .email import ImapEmail, EmailState, MessageSink, ParsedBody, StreamSink, keyword2flag, keywords2flags, \
+    flags_list, nbytes, PREVIEW_CACHE, TEXT_TYPES
 from .mailbox import ImapMailbox
+from .pool import ImapPool
+from ..storage import BlobStream, byte_range, copy_blob_stream
+
+
+PARSE_PROCESSES = int(os.getenv('PARSE_PROCESSES', 0))
+PARSE_INLINE_MAX_SIZE = int(os.getenv('PARSE_INLINE_MAX_SIZE', 1000000))
+PARSE_STREAMING = os.getenv('PARSE_STREAMING', '0') == '1'
+IMAP_BODYSTRUCTURE = os.getenv('IMAP_BODYSTRUCTURE', '0') == '1'
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 10))
+IMAP_SHARED_PREFIX = os.getenv('IMAP_SHARED_PREFIX', 'shared/')
+CHANGES_JOURNAL_SIZE = int(os.getenv('CHANGES_JOURNAL_SIZE', 10000))
+MAX_CHANGES = int(os.getenv('MAX_CHANGES', 10000))
+EMAIL_INDEX = os.getenv('EMAIL_INDEX', '0') == '1'
+FTS_INDEX = os.getenv('FTS_INDEX', '0') == '1'
+FTS_PATH = os.getenv('FTS_PATH', './data/fts/')
+FRAGMENT_CACHE_SIZE = int(os.getenv('FRAGMENT_CACHE_SIZE', 0))
+BLOB_UID_CACHE_SIZE = int(os.getenv('BLOB_UID_CACHE_SIZE', 100000))
+IMAP_CONNECTIONS = int(os.getenv('IMAP_CONNECTIONS', 3))
+DOWNLOAD_CONNECTIONS = int(os.getenv('DOWNLOAD_CONNECTIONS', 2))
 
 
 class ImapAccount:
     """JMAP user Account using IMAP as backend"""
 
+    # messages bigger than parse_inline_max_size are parsed in parse_pool
+    # to not block event loop, smaller ones are parsed lazily inline
+    parse_pool = ProcessPoolExecutor(PARSE_PROCESSES) if PARSE_PROCESSES else None
+    parse_inline_max_size = PARSE_INLINE_MAX_SIZE
+    # bigger messages are parsed while their literal arrives, before parse_pool
+    parse_streaming = PARSE_STREAMING
+    # Email/import streams at most import_batch_size blobs at once
+    import_batch_size = IMPORT_BATCH_SIZE
+    # downloads pause reading from their IMAP connection while more bytes wait for client
+    download_chunk_size = 1 << 20
+    # build body properties from IMAP BODYSTRUCTURE and fetch
+    # only needed text sections instead of whole messages
+    use_bodystructure = IMAP_BODYSTRUCTURE
+    # Dovecot shared namespace prefix of other users' mailboxes
+    shared_prefix = IMAP_SHARED_PREFIX
+    # Email/changes page size when client asks for more or unlimited
+    max_changes = MAX_CHANGES
+    # evaluate Email/query filters and sorts on local EmailIndex
+    use_index = EMAIL_INDEX
+    # answer text filters and SearchSnippet/get from local TextIndex
+    use_fts = FTS_INDEX
+
     def __init__(self, username, password='h', host='localhost', port=143, loop=None):
         self.capabilities = {
             "urn:ietf:params:jmap:mail": {
@@ -34,6 +90,9 @@ class ImapAccount:
                 ]
             }
         }
+        if self.use_index:
+            sort_options = self.capabilities["urn:ietf:params:jmap:mail"]["emailQuerySortOptions"]
+            sort_options += ["sentAt", "from", "to"]
         self.id = username
         self.name = username
         self.username = username
@@ -41,20 +100,50 @@ class ImapAccount:
 
         self.mailboxes = {}
         self.byimapname = {}
-        self._mailbox_state = now_state()
-        self._mailbox_state_low = self._mailbox_state
+        # mailbox states are journal counters, started from time to not repeat after restart
+        self.mailbox_journal = ChangeJournal(time.time_ns() // 1000, CHANGES_JOURNAL_SIZE)
+        # email states are indexed by HIGHESTMODSEQ of virtual/All
+        self.email_journal = None
         self.emails = {}
-        self.blobs = {}
-
-        self.imap = IMAP4(host, port, timeout=600, loop=loop)
+        # concurrent calls share journals, one sync runs at a time
+        self.mailbox_sync_lock = asyncio.Lock()
+        self.email_sync_lock = asyncio.Lock()
+        # message blobId -> uid, filled whenever X-GUID is fetched
+        self.blobs = LRUCache(BLOB_UID_CACHE_SIZE)
+        # blobId -> size, blob content doesn't change
+        self.blob_sizes = LRUCache(BLOB_UID_CACHE_SIZE)
+        self.index = EmailIndex() if self.use_index else None
+        # first build of EmailIndex runs in background
+        self.index_build = None
+        self.fts = TextIndex(os.path.join(FTS_PATH, '%s.sqlite' % re.sub(r'[^\w@.-]', '_', username))) \
+            if self.use_fts else None
+        # first build of TextIndex runs in background
+        self.fts_build = None
+        # serialized Email/get objects keyed by (id, MODSEQ, requested properties)
+        self.fragments = LRUCache(FRAGMENT_CACHE_SIZE) if FRAGMENT_CACHE_SIZE else None
+
+        self.host = host
+        self.port = port
+        self.loop = loop
+        # connection checked out for call in current task, main one otherwise
+        self.imap_context = ContextVar(f'imap {username}', default=None)
+        self.imap_main = IMAP4(host, port, timeout=600, loop=loop)
+        self.pool = ImapPool(self.open_connection, IMAP_CONNECTIONS)
+        # streamed downloads wait for slow clients on their own connections
+        self.downloads = ImapPool(self.open_connection, DOWNLOAD_CONNECTIONS)
         self.imapname_all = 'virtual/All'
 
+    @property
+    def imap(self):
+        return self.imap_context.get() or self.imap_main
+
+    @imap.setter
+    def imap(self, imap):
+        self.imap_main = imap
+
     async def ainit(self):
         """Asynchronously connects to imap class"""
-        await self.imap.wait_hello_from_server()
-        await self.imap.login(self.username, self.password)
-        await self.imap.enable("UTF8=ACCEPT")
-        await self.imap.enable("QRESYNC")
+        await self.login(self.imap)
         await self.sync_mailboxes({'imapname'})
         # find \All mailbox
         for mailbox in self.mailboxes.values():
@@ -72,6 +161,53 @@ class ImapAccount:
                 break
         else:
             raise Exception('UIDVALIDITY for virtual/All not found.')
+        # changes before start are not known
+        self.mailbox_journal.clear()
+        ok, lines = await self.imap.status(self.imapname_all, '(UIDNEXT HIGHESTMODSEQ)')
+        status = parse_status(lines)
+        self.email_journal = ChangeJournal(int(status['HIGHESTMODSEQ']), CHANGES_JOURNAL_SIZE)
+        self.email_uidnext = int(status['UIDNEXT'])
+        self.pool.add(self.imap_main)
+
+    async def login(self, imap):
+        await imap.wait_hello_from_server()
+        await imap.login(self.username, self.password)
+        await imap.enable("UTF8=ACCEPT")
+        await imap.enable("QRESYNC")
+
+    async def open_connection(self):
+        "Returns new IMAP connection logged in with virtual/All selected"
+        imap = IMAP4(self.host, self.port, timeout=600, loop=self.loop)
+        await self.login(imap)
+        ok, lines = await imap.select(self.imapname_all)
+        if ok != 'OK':
+            raise errors.serverFail(lines[-1])
+        return imap
+
+    @asynccontextmanager
+    async def connection(self):
+        """Checks out pooled connection used as self.imap by current task
+        and tasks it starts, nested checkout keeps the outer one"""
+        imap = self.imap_context.get()
+        if imap is not None:
+            yield imap
+            return
+        imap = await self.pool.acquire()
+        token = self.imap_context.set(imap)
+        try:
+            yield imap
+        finally:
+            self.imap_context.reset(token)
+            self.pool.release(imap)
+
+    async def background(self, func, *args):
+        "Runs func on main connection, for tasks which outlive call checking out connection"
+        self.imap_context.set(None)
+        return await func(*args)
+
+    @property
+    def fields_map(self):
+        return FIELDS_MAP_BODYSTRUCTURE if self.use_bodystructure else FIELDS_MAP
 
     async def mailbox_get(self, idmap, ids=None, properties=None):
         """https://jmap.io/spec-mail.html#mailboxget"""
@@ -138,6 +274,7 @@ class ImapAccount:
                     mbox['flags'] = set()
                     self.mailboxes[id] = mbox
                     self.byimapname[imapname] = mbox
+                    self.mailbox_journal.record(id, 'created')
                     created[cid] = {'id': id}
                 else:
                     # set created[cid] after sync_mailboxes()
@@ -175,6 +312,7 @@ class ImapAccount:
                 if ok != 'OK':
                     raise errors.serverFail(lines[0])
                 mailbox['deleted'] = True
+                self.mailbox_journal.record(id, 'destroyed')
                 destroyed.append(id)
             except errors.JmapError as e:
                 notDestroyed[id] = e.to_dict()
@@ -254,37 +392,22 @@ class ImapAccount:
 
     async def mailbox_changes(self, sinceState, maxChanges=None):
         """https://jmap.io/spec-mail.html#mailboxchanges"""
-        new_state = await self.mailbox_state()
-        if sinceState <= await self.mailbox_state_low():
-            raise errors.cannotCalculateChanges({'new_state': new_state})
-
-        removed = []
-        created = []
-        updated = []
-        only_counts = True
-        for mbox in self.mailboxes:
-            if mbox['updated'] > sinceState:
-                if mbox['deleted']:
-                    # don't append created and deleted
-                    if mbox['created'] <= sinceState:
-                        removed.append(mbox['id'])
-                elif mbox['created'] > sinceState:
-                    created.append(mbox['id'])
-                else:
-                    if mbox['updatedNonCounts'] > sinceState:
-                        only_counts = False
-                    updated.append(mbox['id'])
-
-        if len(removed) + len(created) + len(updated) > maxChanges:
-            raise errors.cannotCalculateChanges({'new_state': new_state})
+        await self.sync_mailboxes()
+        try:
+            since = int(sinceState)
+        except ValueError:
+            raise errors.cannotCalculateChanges()
+        new_state, has_more, created, updated, removed = \
+            self.mailbox_journal.changes_since(since, maxChanges)
+        only_counts = updated and all(kind == 'counts' for kind in updated.values())
 
         return {
             'accountId': self.id,
             'oldState': sinceState,
-            'newState': new_state,
-            'hasMoreChanges': False,
+            'newState': str(new_state),
+            'hasMoreChanges': has_more,
             'created': created,
-            'updated': updated,
+            'updated': list(updated),
             'removed': removed,
             'changedProperties': ["totalEmails", "unreadEmails", "totalThreads",
                                   "unreadThreads"] if only_counts else None,
@@ -295,22 +418,19 @@ class ImapAccount:
                           anchor=None, anchorOffset=None,
                           collapseThreads=False, calculateTotal=False):
         position, limit2, sort, filter = _validate_query(position, limit, sort, filter)
-
-        search_criteria = self.as_imap_search(filter)
-        sort_criteria = as_imap_sort(sort)
-        if collapseThreads:
-            ok, lines = await self.imap.uid_thread('REFS', search_criteria.decode())
-            threads = parse_thread(lines[:1])
-            # TODO flatten threads
-            if threads:
-                search_criteria += b' UID %s' % encode_messageset((int(t[0]) for t in threads))
-        if sort_criteria:
-            ok, lines = await self.imap.uid_sort(sort_criteria.decode(), search_criteria.decode(), ret='ALL COUNT')
-        elif search_criteria:
-            ok, lines = await self.imap.uid_search(search_criteria.decode(), ret='ALL COUNT')
-        result = parse_esearch(lines)
-        uidset = result.get('ALL', '')
-        total = int(result.get('COUNT', 0))
+        if self.fts is not None and filter and await self.fts_sync():
+            filter = await self.fts_filter(filter)
+
+        uids = None
+        if self.index is not None and await self.index_sync():
+            uids = self.index.query(filter, sort, self.mailboxes, collapseThreads)
+        if uids is not None:
+            total = len(uids)
+            iter_uids = uids.__iter__
+        else:
+            # text criteria need IMAP SEARCH
+            uidset, total = await self._imap_query(sort, filter, collapseThreads)
+            iter_uids = lambda: iter_messageset(uidset)
 
         if anchor:
             # need to calculate position
@@ -318,7 +438,7 @@ class ImapAccount:
                 anchor_uid = self.parse_email_id(anchor)
             except ValueError:
                 raise errors.anchorNotFound()
-            for position, uid in enumerate(iter_messageset(uidset)):
+            for position, uid in enumerate(iter_uids()):
                 if uid == anchor_uid:
                     if type(anchorOffset) is int:
                         position = max(position + anchorOffset, 0)
@@ -331,12 +451,15 @@ class ImapAccount:
             position = max(position + total, 0)
 
         if position < total:
-            uids = iter_messageset(uidset)
-            uids = itertools.islice(uids, position, position + limit)
+            uids = itertools.islice(iter_uids(), position, position + limit2)
             ids = list(self.format_email_id(uid) for uid in uids)
         else:
             ids = []
 
+        prefetch_props, prefetch_names = self.prefetch_properties()
+        if ids and (prefetch_props or prefetch_names):
+            await self.fill_emails(prefetch_props, ids, prefetch_names)
+
         out = {
             'accountId': self.id,
             'queryState': await self.email_state(),
@@ -351,6 +474,85 @@ class ImapAccount:
             out['limit'] = limit2
         return out
 
+    async def index_sync(self):
+        """Syncs built EmailIndex and returns True. Index without all emails
+        is built in background task, returns False until it is done,
+        meanwhile Email/query is answered by IMAP SEARCH"""
+        if self.index.modseq:
+            await self.index.sync(self)
+            return True
+        if self.index_build is None or self.index_build.done():
+            # failed build skips rows already added
+            self.index_build = asyncio.ensure_future(self.background(self.index.sync, self))
+        return False
+
+    async def fts_sync(self):
+        """Syncs built TextIndex and returns True. Index without all emails
+        is built in background task, returns False until it is done,
+        meanwhile text criteria are searched by IMAP"""
+        if self.fts.modseq and self.fts.uidvalidity == self.uidvalidity:
+            await self.fts.sync(self)
+            return True
+        if self.fts_build is None or self.fts_build.done():
+            # failed build continues from the last indexed batch
+            self.fts_build = asyncio.ensure_future(self.background(self.fts.sync, self))
+        return False
+
+    async def fts_filter(self, filter):
+        "Replaces text criteria in filter with uids found in TextIndex"
+        if 'operator' in filter:
+            return {**filter, 'conditions': [await self.fts_filter(cond) for cond in filter.get('conditions', ())]}
+        text = {crit: value for crit, value in filter.items() if crit in TEXT_COLUMNS}
+        if not text:
+            return filter
+        uids = await self.fts.search(text)
+        if uids is None:
+            return filter
+        filter = {crit: value for crit, value in filter.items() if crit not in text}
+        filter['uids'] = frozenset(uids)
+        return filter
+
+    async def searchsnippet_get(self, filter=None, emailIds=()):
+        """https://jmap.io/spec-mail.html#searchsnippetget"""
+        lst = []
+        notFound = []
+        uids = {}
+        for id in emailIds:
+            try:
+                uids[self.parse_email_id(id)] = id
+            except ValueError:
+                notFound.append(id)
+        snippets = {}
+        text = {}
+        collect_text_criteria(filter or {}, text)
+        if self.fts is not None and text and await self.fts_sync():
+            snippets = await self.fts.snippets(text, list(uids))
+        for uid, id in uids.items():
+            subject, preview = snippets.get(uid, (None, None))
+            lst.append({'emailId': id, 'subject': subject, 'preview': preview})
+        return {
+            'accountId': self.id,
+            'list': lst,
+            'notFound': notFound or None,
+        }
+
+    async def _imap_query(self, sort, filter, collapseThreads):
+        "Returns (uidset, total) found by IMAP SORT or SEARCH"
+        search_criteria = self.as_imap_search(filter)
+        sort_criteria = as_imap_sort(sort)
+        if collapseThreads:
+            ok, lines = await self.imap.uid_thread('REFS', search_criteria.decode())
+            threads = parse_thread(lines[:1])
+            # TODO flatten threads
+            if threads:
+                search_criteria += b' UID %s' % encode_messageset((int(t[0]) for t in threads))
+        if sort_criteria:
+            ok, lines = await self.imap.uid_sort(sort_criteria.decode(), search_criteria.decode(), ret='ALL COUNT')
+        else:
+            ok, lines = await self.imap.uid_search(search_criteria.decode() or 'ALL', ret='ALL COUNT')
+        result = parse_esearch(lines)
+        return result.get('ALL', ''), int(result.get('COUNT', 0))
+
     async def email_get(self, idmap, ids=None, properties=None, bodyProperties=None,
                         fetchTextBodyValues=False, fetchHTMLBodyValues=False,
                         fetchAllBodyValues=False, maxBodyValueBytes=0):
@@ -364,9 +566,10 @@ class ImapAccount:
                 m = header_prop_re.match(prop)
                 if m is None:
                     fill_props.add(prop)
-                else:
+                elif header_name_re.match(m.group(1)):
                     header_props.add(m.group(0, 1, 2, 3))
-                    fill_props.add('headers')
+                else:
+                    raise errors.invalidProperties(f'Invalid header name in {prop}')
             if 'body' in fill_props:
                 fill_props.remove('body')
                 fill_props.update(('textBody', 'htmlBody'))
@@ -377,9 +580,6 @@ class ImapAccount:
         if bodyProperties is None:
             bodyProperties = ALL_BODY_PROPERTIES
 
-        if header_props and 'headers' not in properties:
-            fill_props.remove('headers')
-
         if ids is None:
             # get MAX_OBJECTS_IN_GET
             ok, lines = await self.imap.search('ALL', ret='ALL')
@@ -393,7 +593,24 @@ class ImapAccount:
         else:
             ids = [idmap.get(id) for id in ids]
 
-        await self.fill_emails(fill_props, ids)
+        prefetch_props, prefetch_names = self.prefetch_properties()
+        if self.fragments is not None:
+            # MODSEQ keys cached fragments
+            prefetch_props.add('updated')
+            fragment_props = (frozenset(fill_props), frozenset(header_props), fetchTextBodyValues,
+                              fetchHTMLBodyValues, fetchAllBodyValues, maxBodyValueBytes)
+        await self.fill_emails(fill_props | prefetch_props, ids,
+                               {name.lower() for _, name, _, _ in header_props} | prefetch_names)
+        if 'bodyValues' in fill_props and self.use_bodystructure:
+            if fetchHTMLBodyValues:
+                types = {'text/html'}
+            elif fetchTextBodyValues:
+                types = {'text/plain'}
+            else:
+                types = TEXT_TYPES
+            await self.fill_body_values(ids, types, maxBodyValueBytes)
+        if 'preview' in fill_props and self.use_bodystructure:
+            await self.fill_previews(ids)
 
         for id in ids:
             try:
@@ -402,11 +619,18 @@ class ImapAccount:
                 notFound.append(id)
                 continue
 
+            fragment_key = None
+            if self.fragments is not None and 'MODSEQ' in msg \
+                    and ('preview' not in fill_props or 'PREVIEW' in msg):
+                fragment_key = (id, msg['MODSEQ'], fragment_props)
+                fragment = self.fragments.get(fragment_key)
+                if fragment is not None:
+                    lst.append(fragment)
+                    continue
+
             # Fill most of msg properties except header:*
             data = {prop: msg[prop] for prop in fill_props}
             data['id'] = msg['id']
-            if 'textBody' in msg and 'htmlBody' not in msg and not msg['textBody']:
-                data['textBody'] = htmltotext(msg['htmlBody'])
             if 'bodyValues' in properties:
                 # bug: jmap-demo-webmail needs all bodyValues even when fetchHTMLBodyValues=True
                 if fetchHTMLBodyValues:
@@ -416,12 +640,9 @@ class ImapAccount:
                 elif fetchAllBodyValues:
                     data['bodyValues'] = msg['bodyValues']
                 if maxBodyValueBytes:
-                    for k, bodyValue in data['bodyValues'].items():
-                        if len(bodyValue['value']) > maxBodyValueBytes:
-                            bodyValue = {k: v for k, v in bodyValue.items()}
-                            bodyValue['value'] = bodyValue['value'][:maxBodyValueBytes]
-                            bodyValue['isTruncated'] = True,
-                            data['bodyValues'][k] = bodyValue
+                    # copy, msg['bodyValues'] stays cached untruncated
+                    data['bodyValues'] = {k: truncate_body_value(v, maxBodyValueBytes)
+                                          for k, v in data['bodyValues'].items()}
 
             for prop, name, form, getall in header_props:
                 try:
@@ -431,11 +652,12 @@ class ImapAccount:
 
                 name = name.lower()
                 if getall:
-                    data[prop] = [func(h['value'])
-                                  for h in msg['headers'] if h['name'].lower() == name]
+                    data[prop] = [func(raw) for raw in msg.get_all_headers(name)]
                 else:
                     data[prop] = func(msg.get_header(name))
 
+            if fragment_key is not None:
+                data = self.fragments[fragment_key] = Fragment(dumps(data))
             lst.append(data)
 
         return {
@@ -445,7 +667,9 @@ class ImapAccount:
             'notFound': list(notFound),
         }
 
-    async def create_email(self, data):
+    async def prepare_email(self, data):
+        """Validates and makes email for creation
+        returns (msg, (body, imapname, flags, date))"""
         try:
             mailboxid, = data['mailboxIds']
         except KeyError:
@@ -463,42 +687,101 @@ class ImapAccount:
             if blobId is not None:
                 blobs[blobId] = await self.download(blobId)
         body = msg.make_body(blobs)
-        flags = "(%s)" % (''.join(msg['FLAGS']))
-        imapname = mailbox['imapname']
-        uid, msg['X-GUID'] = await self._imap_append(body, imapname, flags)
-        msg['id'] = self.format_email_id(uid)
-        self.emails[id] = msg
-        return {
-            'id': msg['id'],
-            'blobId': msg['blobId'],
-        }
-
-    async def _imap_append(self, body, imapname='INBOX', flags=None, data=None):
-        ok, lines = await self.imap.append(body, imapname, flags)
-        match = re.search(r'\[APPENDUID (\d+) (\d+)\]', lines[-1])
+        flags = keywords2flags(data.get('keywords', ()))
+        return msg, (body, mailbox['imapname'], flags, None)
+
+    async def _imap_append(self, body, imapname='INBOX', flags=None, date=None):
+        result, = await self._imap_append_batch([(body, imapname, flags, date)])
+        if isinstance(result, errors.JmapError):
+            raise result
+        return result
+
+    async def _imap_append_batch(self, items):
+        """APPENDs items [(body, imapname, flags, date), ...]
+        with one MULTIAPPEND per target mailbox.
+        Returns list of (uid, guid) or JmapError for each item in same order"""
+        results = [None] * len(items)
+        bymailbox = {}
+        for i, item in enumerate(items):
+            bymailbox.setdefault(item[1], []).append(i)
+
+        if self.imap.has_capability('MULTIAPPEND'):
+            batches = bymailbox.items()
+        else:
+            batches = [(imapname, [i]) for imapname, ii in bymailbox.items() for i in ii]
+
+        realuids = {}
+        for imapname, ii in batches:
+            messages = [(items[i][0], items[i][2], items[i][3]) for i in ii]
+            ok, lines = await self.imap.multiappend(messages, quoted(imapname))
+            match = appenduid_re.search(lines[-1]) if ok == 'OK' else None
+            if match is None:
+                for i in ii:
+                    results[i] = errors.serverFail(lines[-1])
+                continue
+            for i, realuid in zip(ii, iter_messageset(match[2])):
+                realuids.setdefault(imapname, {})[realuid] = i
+        if realuids:
+            for i, result in (await self._find_real_uids(realuids)).items():
+                results[i] = result
+
+        for i, result in enumerate(results):
+            if result is None:
+                results[i] = errors.serverFail("Couldn't fetch UID X-GUID")
+        return results
+
+    async def _find_real_uids(self, realuids):
+        """Maps uids in real mailboxes {imapname: {realuid: key}}
+        to virtual/All with one search and one fetch.
+        Returns {key: (uid, guid)}"""
+        found = {}
         # ensure refreshed folder view
         ok, lines = await self.imap.noop()
-        ok, lines = await self.imap.uid_search(f"X-REAL-UID {match[2]} X-MAILBOX {imapname}", ret='ALL')
-        search = parse_esearch(lines)
-        ok, lines = await self.imap.uid_fetch(search['ALL'], "(UID X-GUID)")
-        for seq, fetch in parse_fetch(lines[:-1]):
-            return int(fetch['UID']), fetch['X-GUID']
-        raise errors.serverFail("Couldn't fetch UID X-GUID")
+        conds = [b'(X-MAILBOX %s X-REAL-UID %s)' % (quoted(imapname.encode()), encode_messageset(uids))
+                 for imapname, uids in realuids.items()]
+        search = b'OR ' * (len(conds) - 1) + b' '.join(conds)
+        ok, lines = await self.imap.uid_search(search.decode(), ret='ALL')
+        uidset = parse_esearch(lines).get('ALL', '')
+        if uidset:
+            ok, lines = await self.imap.uid_fetch(uidset, "(UID X-GUID X-MAILBOX X-REAL-UID)")
+            for seq, fetch in parse_fetch(lines[:-1]):
+                try:
+                    key = realuids[unquoted(fetch['X-MAILBOX'])][int(fetch['X-REAL-UID'])]
+                except KeyError:
+                    continue
+                found[key] = int(fetch['UID']), fetch['X-GUID']
+                self.blobs[f"G{fetch['X-GUID']}"] = int(fetch['UID'])
+        return found
 
     async def create_emails(self, idmap, create):
         created, notCreated = {}, {}
+        prepared = []
         for cid, data in create.items():
             try:
-                created[cid] = await self.create_email(data)
-                idmap.set(cid, created[cid]['id'])
+                prepared.append((cid, *await self.prepare_email(data)))
             except errors.JmapError as e:
                 notCreated[cid] = e.to_dict()
+
+        results = await self._imap_append_batch([item for cid, msg, item in prepared])
+        for (cid, msg, item), result in zip(prepared, results):
+            if isinstance(result, errors.JmapError):
+                notCreated[cid] = result.to_dict()
+                continue
+            uid, msg['X-GUID'] = result
+            msg['id'] = self.format_email_id(uid)
+            self.emails[msg['id']] = msg
+            created[cid] = {
+                'id': msg['id'],
+                'blobId': msg['blobId'],
+            }
+            idmap.set(cid, msg['id'])
         return created, notCreated
 
-    async def update_email(self, msg, patch):
+    def parse_email_patch(self, msg, patch):
+        """Returns flags to add, flags to remove and mailbox to move msg to (or None)"""
         values = patch.pop('keywords', {})
-        store = {True: [keyword2flag(k) for k, v in values.items() if v],
-                False: [keyword2flag(k) for k, v in values.items() if not v]}
+        store = {True: {keyword2flag(k) for k, v in values.items() if v},
+                False: {keyword2flag(k) for k, v in values.items() if not v}}
         values = patch.pop('mailboxIds', {})
         mids = {True: [k for k, v in values.items() if v],
                False: [k for k, v in values.items() if not v]}
@@ -506,24 +789,14 @@ class ImapAccount:
         for path, value in patch.items():
             prop, _, key = path.partition('/')
             if prop == 'keywords':
-                store[bool(value)].append(keyword2flag(key))
+                store[bool(value)].add(keyword2flag(key))
             elif prop == 'mailboxIds':
                 mids[bool(value)].append(key)
             else:
                 raise errors.invalidArguments(f"Unknown update {path}")
 
-        uid = str(self.parse_email_id(msg['id']))
-        for add, flags in store.items():
-            flags = f"({' '.join(flags)})"
-            ok, lines = await self.imap.uid_store(uid, '+FLAGS' if add else '-FLAGS', flags)
-            if ok != 'OK':
-                raise errors.serverFail('\n'.join(lines))
-            for seq, data in parse_fetch(lines[:-1]):
-                if uid == data['UID']:
-                    msg['FLAGS'] = data['FLAGS']
-                    msg.pop('keywords', None)
-
         # if msg is already there, ignore invalid False folders
+        mailbox_to = None
         if (mids[True] or mids[False]) and \
             msg['mailboxIds'] != mids[True]:
             if len(mids[True]) > 1 or \
@@ -534,21 +807,93 @@ class ImapAccount:
                 mailbox_to = self.mailboxes[mids[True][0]]
             except KeyError:
                 raise errors.notFound('Mailbox not found')
-            ok, lines = await self.imap.uid_move(uid, quoted(mailbox_to['imapname']))
-            if ok != 'OK':
-                raise errors.serverFail('\n'.join(lines))
+        return store[True], store[False], mailbox_to
 
     async def update_emails(self, update):
+        """Updates emails with one UID STORE per identical flag change
+        and one UID MOVE per target mailbox"""
         updated = {}
         notUpdated = {}
         await self.fill_emails(('keywords', 'mailboxIds'), update.keys())
+        byuid = {}
+        stores = {}
+        moves = {}
         for id, patch in update.items():
             try:
-                updated[id] = await self.update_email(self.emails[id], patch)
+                msg = self.emails[id]
+                add, remove, mailbox_to = self.parse_email_patch(msg, patch)
             except KeyError:
                 notUpdated[id] = errors.notFound().to_dict()
+                continue
             except errors.JmapError as e:
                 notUpdated[id] = e.to_dict()
+                continue
+            uid = self.parse_email_id(id)
+            byuid[uid] = msg
+            if add:
+                stores.setdefault(('+FLAGS', frozenset(add)), []).append(uid)
+            if remove:
+                stores.setdefault(('-FLAGS', frozenset(remove)), []).append(uid)
+            if mailbox_to:
+                moves.setdefault(mailbox_to['id'], []).append(uid)
+
+        failed = {}
+        for (op, flags), uids in stores.items():
+            uidset = encode_messageset(uids).decode()
+            ok, lines = await self.imap.uid_store(uidset, op, flags_list(flags))
+            if ok != 'OK':
+                for uid in uids:
+                    failed.setdefault(uid, errors.serverFail(lines[-1]))
+                continue
+            stored = set()
+            for seq, data in parse_fetch(lines[:-1]):
+                msg = byuid.get(int(data.get('UID', 0)), None)
+                if msg is not None and 'FLAGS' in data:
+                    msg['FLAGS'] = data['FLAGS']
+                    msg.pop('keywords', None)
+                    # stale MODSEQ would serve cached fragment with old keywords
+                    if 'MODSEQ' in data:
+                        msg['MODSEQ'] = data['MODSEQ']
+                    else:
+                        msg.pop('MODSEQ', None)
+                    stored.add(int(data['UID']))
+            # servers don't need to send FETCH for unchanged flags,
+            # email without FETCH which doesn't have the flags set was expunged
+            for uid in uids:
+                if uid not in stored:
+                    has = {f.lower() for f in byuid[uid]['FLAGS']}
+                    if any(((f if isinstance(f, str) else f.decode()).lower() in has) != (op == '+FLAGS')
+                           for f in flags):
+                        failed.setdefault(uid, errors.notFound())
+
+        for mailboxid, uids in moves.items():
+            uids = [uid for uid in uids if uid not in failed]
+            if not uids:
+                continue
+            uidset = encode_messageset(uids).decode()
+            ok, lines = await self.imap.uid_move(uidset, quoted(self.mailboxes[mailboxid]['imapname']))
+            if ok != 'OK':
+                for uid in uids:
+                    failed[uid] = errors.serverFail('\n'.join(lines))
+                continue
+            for line in lines:
+                match = copyuid_re.search(line)
+                if match:
+                    moved = set(iter_messageset(match[2]))
+                    break
+            else:  # without UIDPLUS expect all were moved
+                moved = uids
+            for uid in uids:
+                if uid in moved:
+                    byuid[uid]['mailboxIds'] = [mailboxid]
+                else:
+                    failed[uid] = errors.notFound()
+
+        for uid, msg in byuid.items():
+            if uid in failed:
+                notUpdated[msg['id']] = failed[uid].to_dict()
+            else:
+                updated[msg['id']] = None
         return updated, notUpdated
 
     async def destroy_emails(self, ids):
@@ -594,47 +939,220 @@ class ImapAccount:
         }
 
     async def email_changes(self, sinceState, maxChanges=None):
-        newState = await self.email_state()
-        if sinceState <= await self.email_state_low():
-            raise errors.cannotCalculateChanges({'new_state': newState})
+        """https://jmap.io/spec-mail.html#emailchanges"""
+        try:
+            state = EmailState.from_string(sinceState)
+        except ValueError:
+            raise errors.cannotCalculateChanges()
+        if state.uidvalidity != self.uidvalidity:
+            raise errors.cannotCalculateChanges()
+        await self.sync_emails()
+        if state.cursor or state.modseq < self.email_journal.low:
+            return await self.email_changes_imap(state, maxChanges)
+        modseq, has_more, created, updated, removed = \
+            self.email_journal.changes_since(state.modseq, maxChanges)
+        # uids of emails not reported as created are higher
+        uid = max([state.uid] + [self.parse_email_id(id) + 1 for id in created])
+        if not has_more:
+            uid = max(uid, self.email_uidnext)
 
-        state = EmailState.from_string(sinceState)
-        ok, lines = await self.imap.uid_fetch(
-            '%d:*' % state.uid,
-            "(UID)",
-            '(CHANGEDSINCE %s VANISHED)' % state.modseq
-        )
-        if lines[0].startswith('(EARLIER) '):
-            removed = [self.format_email_id(uid)
-                       for uid in iter_messageset(lines[0][10:])]
-            lines = lines[1:]
+        return {
+            'accountId': self.id,
+            'oldState': sinceState,
+            'newState': str(EmailState(self.uidvalidity, uid, modseq)),
+            'hasMoreChanges': has_more,
+            'created': created,
+            'updated': list(updated),
+            'removed': removed,
+        }
+
+    async def email_changes_imap(self, state, maxChanges=None):
+        """Email changes older than email_journal from IMAP CONDSTORE.
+        Walks modseq windows (state.modseq, top] with at most maxChanges
+        changed and vanished messages, intermediate states keep uid of
+        sinceState, so created emails are recognized in later windows"""
+        limit = min(maxChanges or self.max_changes, self.max_changes)
+        ok, lines = await self.imap.status(self.imapname_all, '(UIDNEXT HIGHESTMODSEQ)')
+        status = parse_status(lines)
+        highestmodseq = int(status['HIGHESTMODSEQ'])
+        since = state.modseq
+        vanished = await self._vanished_since(since, await self._missing_uids(int(status['UIDNEXT'])))
+        if state.cursor:
+            return await self._email_changes_page(state, limit, status, vanished)
+        changed = await self._count_changed(since)
+        top = highestmodseq
+        if changed + messageset_count(vanished) > limit:
+            # binary search highest top fitting into limit
+            low, high = since, highestmodseq
+            while low < high:
+                mid = (low + high + 1) // 2
+                count = changed - await self._count_changed(mid) \
+                    + messageset_count(vanished) - messageset_count(await self._vanished_since(mid, vanished))
+                if count <= limit:
+                    low = mid
+                else:
+                    high = mid - 1
+            if low == since:
+                # too many changes with one modseq, like bulk STORE
+                return await self._email_changes_page(state, limit, status, vanished)
+            top = low
+
+        if top < highestmodseq:
+            search = 'MODSEQ %d NOT MODSEQ %d' % (since + 1, top + 1)
+            removed = set(iter_messageset(vanished)) if vanished else set()
+            still = await self._vanished_since(top, vanished) if removed else ''
+            if still:
+                removed.difference_update(iter_messageset(still))
+            newState = EmailState(self.uidvalidity, state.uid, top)
         else:
-            removed = []
+            search = 'MODSEQ %d' % (since + 1)
+            removed = iter_messageset(vanished) if vanished else ()
+            newState = EmailState(self.uidvalidity, int(status['UIDNEXT']), highestmodseq)
 
         created = []
         updated = []
-        for seq, data in parse_fetch(lines[:-1]):
-            uid = int(data['UID'])
-            id = self.format_email_id(uid)
-            if uid > state.uid:
-                created.append(id)
-            else:
-                updated.append(id)
+        if changed:
+            ok, lines = await self.imap.uid_search(search, ret='ALL')
+            uidset = parse_esearch(lines).get('ALL', '')
+            for uid in iter_messageset(uidset) if uidset else ():
+                if uid >= state.uid:
+                    created.append(self.format_email_id(uid))
+                else:
+                    updated.append(self.format_email_id(uid))
+
+        return {
+            'accountId': self.id,
+            'oldState': str(state),
+            'newState': str(newState),
+            'hasMoreChanges': top < highestmodseq,
+            'created': created,
+            'updated': updated,
+            'removed': [self.format_email_id(uid) for uid in sorted(removed)],
+        }
 
-        # TODO: create intermediate state
-        if maxChanges and len(removed) + len(created) + len(updated) > maxChanges:
-            raise errors.cannotCalculateChanges({'new_state': newState})
+    async def _email_changes_page(self, state, limit, status, vanished):
+        """Email changes with modseq just after state.modseq, which don't fit
+        into limit, paged by uid. Intermediate states carry the last reported
+        uid as cursor until it passes the last uid changed with that modseq"""
+        modseq = state.modseq + 1
+        ok, lines = await self.imap.uid_search('UID %d:* MODSEQ %d NOT MODSEQ %d'
+                                               % (state.cursor + 1, modseq, modseq + 1), ret='ALL')
+        uidset = parse_esearch(lines).get('ALL', '')
+        changed = {uid for uid in iter_messageset(uidset) if uid > state.cursor} if uidset else set()
+        removed = set(iter_messageset(vanished)) if vanished else set()
+        if removed:
+            later = await self._vanished_since(modseq, vanished)
+            if later:
+                removed.difference_update(iter_messageset(later))
+            removed = {uid for uid in removed if uid > state.cursor}
+
+        uids = sorted(changed | removed)
+        page = uids[:limit]
+        highestmodseq = int(status['HIGHESTMODSEQ'])
+        if len(uids) > limit:
+            newState = EmailState(self.uidvalidity, state.uid, state.modseq, page[-1])
+        elif modseq < highestmodseq:
+            newState = EmailState(self.uidvalidity, state.uid, modseq)
+        else:
+            newState = EmailState(self.uidvalidity, int(status['UIDNEXT']), highestmodseq)
 
+        created = []
+        updated = []
+        for uid in page:
+            if uid in removed:
+                continue
+            if uid >= state.uid:
+                created.append(self.format_email_id(uid))
+            else:
+                updated.append(self.format_email_id(uid))
         return {
             'accountId': self.id,
-            'oldState': sinceState,
-            'newState': newState,
-            'hasMoreChanges': False,
+            'oldState': str(state),
+            'newState': str(newState),
+            'hasMoreChanges': len(uids) > limit or modseq < highestmodseq,
             'created': created,
             'updated': updated,
-            'removed': removed,
+            'removed': [self.format_email_id(uid) for uid in page if uid in removed],
         }
 
+    async def _count_changed(self, modseq):
+        "Returns count of emails changed after modseq"
+        ok, lines = await self.imap.uid_search('MODSEQ %d' % (modseq + 1), ret='COUNT')
+        return int(parse_esearch(lines).get('COUNT', 0))
+
+    async def _missing_uids(self, uidnext):
+        "Returns messageset of uids lower than uidnext which don't exist"
+        ok, lines = await self.imap.uid_search('ALL', ret='ALL')
+        uidset = parse_esearch(lines).get('ALL', '')
+        return messageset_complement(uidset, uidnext)
+
+    async def _vanished_since(self, modseq, uidset):
+        "Returns messageset of uids from uidset expunged after modseq"
+        if not uidset:
+            return ''
+        ok, lines = await self.imap.uid_fetch(uidset, "(UID)", '(CHANGEDSINCE %d VANISHED)' % modseq)
+        if lines and lines[0].startswith('(EARLIER) '):
+            return lines[0][10:]
+        return ''
+
+    async def sync_emails(self):
+        "Records email changes since last sync to email_journal"
+        async with self.email_sync_lock:
+            await self._sync_emails()
+
+    async def _sync_emails(self):
+        journal = self.email_journal
+        ok, lines = await self.imap.status(self.imapname_all, '(UIDNEXT HIGHESTMODSEQ)')
+        status = parse_status(lines)
+        highestmodseq = int(status['HIGHESTMODSEQ'])
+        if highestmodseq <= journal.state:
+            return
+        if await self._count_changed(journal.state) > journal.maxsize:
+            # huge delta would not fit, older states use email_changes_imap
+            journal.advance(highestmodseq)
+            journal.clear()
+            # changed emails are not known, cached ones may be stale
+            self.emails.clear()
+            if self.fragments is not None:
+                self.fragments.clear()
+            self.email_uidnext = int(status['UIDNEXT'])
+            return
+        ok, lines = await self.imap.uid_fetch(
+            '1:*',
+            "(UID MODSEQ)",
+            '(CHANGEDSINCE %s VANISHED)' % journal.state
+        )
+        if lines[0].startswith('(EARLIER) '):
+            vanished = iter_messageset(lines[0][10:])
+            lines = lines[1:]
+        else:
+            vanished = ()
+
+        changes = []
+        for seq, data in parse_fetch(lines[:-1]):
+            uid = int(data['UID'])
+            modseq = int(data['MODSEQ'][0])
+            changes.append((modseq, uid, 'created' if uid >= self.email_uidnext else 'updated'))
+        changes.sort()
+        for modseq, uid, kind in changes:
+            id = self.format_email_id(uid)
+            journal.record(id, kind, modseq)
+            msg = self.emails.get(id, None)
+            if msg is not None and msg.get('MODSEQ', None) != modseq:
+                # changed by other client, new MODSEQ keys its fragments
+                # and flags are fetched again
+                msg['MODSEQ'] = modseq
+                msg.pop('FLAGS', None)
+                msg.pop('keywords', None)
+        # expunges have no modseq, newest state sees them
+        for uid in vanished:
+            id = self.format_email_id(uid)
+            journal.record(id, 'destroyed', highestmodseq)
+            # fragments are served only for cached emails
+            self.emails.pop(id, None)
+        journal.advance(highestmodseq)
+        self.email_uidnext = max(self.email_uidnext, int(status['UIDNEXT']))
+
     async def thread_get(self, idmap, ids=None):
         lst = []
         notFound = []
@@ -652,7 +1170,8 @@ class ImapAccount:
             # threads = parse_thread(lines)
             # await self.fill_emails(['blobId'], [t[0] for t in threads])
             ids = [self.format_email_id(uid) for uid in iter_messageset(uidset)]
-            await self.fill_emails(['blobId'], ids)
+            prefetch_props, prefetch_names = self.prefetch_properties()
+            await self.fill_emails({'blobId', *prefetch_props}, ids, prefetch_names)
             for id in ids:
                 try:
                     msg = self.emails[id]
@@ -667,31 +1186,175 @@ class ImapAccount:
             'notFound': notFound,
         }
 
-    async def upload(self, content, typ=''):
-        """Store as email with 1 part containing content"""
-        from email.message import EmailMessage
-        msg = EmailMessage()
-        msg.set_content(content)
-        body = msg.as_bytes()
-        ok, lines = self.imap.append(body, 'Drafts')
-        # TODO: fetch created email['id']
+    async def upload(self, stream, typ=None):
+        """Store as email with 1 part containing content,
+        returned blobId is of that part. Content is spooled base64 encoded
+        to temporary file, APPEND literal is streamed from it"""
+        maintype, _, subtype = (typ or 'application/octet-stream').partition('/')
+        head = (f"MIME-Version: 1.0\r\nContent-Type: {maintype}/{subtype or 'octet-stream'}\r\n"
+                "Content-Transfer-Encoding: base64\r\n\r\n").encode()
+        size = 0
+        rest = b''
+        async with aiofiles.tempfile.TemporaryFile('w+b') as spool:
+            async for chunk in stream:
+                size += len(chunk)
+                rest += chunk
+                # whole base64 lines of 57 bytes
+                cut = len(rest) - len(rest) % 57
+                if cut:
+                    await spool.write(base64_lines(rest[:cut]))
+                    rest = rest[cut:]
+            await spool.write(base64_lines(rest))
+            length = await spool.tell()
+            await spool.seek(0)
+            body = BlobStream(len(head) + length, spooled_chunks(head, spool, self.download_chunk_size))
+            try:
+                result, = await self._imap_append_batch([(body, 'Drafts', keywords2flags(['$draft']), None)])
+            finally:
+                await body.aclose()
+        if isinstance(result, errors.JmapError):
+            raise result
+        uid, guid = result
         return {
             'accountId': self.id,
-            'blobId': f"G{email['id']}-0",
-            'size': len(content),
+            'blobId': f"G{guid}-1",
+            'size': size,
             'type': typ,
         }
 
-    async def download(self, blobId):
-        search = self.as_imap_search({'blobId': blobId[1:]})
+    async def blob_copy(self, fromAccount, blobId):
+        """Copies blob from fromAccount, returns blobId in this account.
+        Copy is a $draft message in Drafts of this account, it is visible
+        to its clients like uploaded blobs and deleting it removes the blob.
+        Messages on the same IMAP server are copied by UID COPY
+        into Drafts, seen by other user in shared namespace"""
+        if blobId[:1] != 'G' or not isinstance(fromAccount, ImapAccount):
+            return await copy_blob_stream(self, fromAccount, blobId)
+        partId = blobId[1:].partition('-')[2]
+        suffix = f'-{partId}' if partId else ''
+
+        if (fromAccount.imap.host, fromAccount.imap.port) == (self.imap.host, self.imap.port):
+            if fromAccount.username == self.username:
+                # the same mailbox, blob is already there
+                if await self.blob_uid(blobId) is None:
+                    raise errors.notFound(f"Blob {blobId} not found")
+                return blobId
+            mailbox = f'{self.shared_prefix}{self.username}/Drafts'
+            uid = await fromAccount.blob_uid(blobId)
+            if uid is None:
+                raise errors.notFound(f"Blob {blobId} not found")
+            ok, lines = await fromAccount.imap.uid_copy(str(uid), quoted(mailbox))
+            match = copyuid_re.search(lines[-1]) if ok == 'OK' else None
+            if match:
+                found = await self._find_real_uids({'Drafts': {int(match[3]): blobId}})
+                if blobId in found:
+                    return f"G{found[blobId][1]}{suffix}"
+            # no access to other user's Drafts, copy data
+
+        body = await fromAccount.download(blobId)
+        if partId:
+            return (await self.upload(BlobStream.from_bytes(body), None))['blobId']
+        result, = await self._imap_append_batch([(body, 'Drafts', keywords2flags(['$draft']), None)])
+        if isinstance(result, errors.JmapError):
+            raise result
+        return f"G{result[1]}"
+
+    async def blob_uid(self, blobId, refresh=False):
+        """Returns uid of message containing blobId, or None
+        blobId is G{X-GUID} of message or G{X-GUID}-{partId} of its part"""
+        guid = blobId[1:].partition('-')[0]
+        if not refresh:
+            uid = self.blobs.get(f'G{guid}')
+            if uid is not None:
+                return uid
+        self.blobs.pop(f'G{guid}')
+        search = self.as_imap_search({'blobId': guid})
         ok, lines = await self.imap.uid_search(search.decode(), ret='ALL')
-        uidset = parse_esearch(lines).get('ALL', '')
-        for uid in iter_messageset(uidset):
-            ok, lines = await self.imap.uid_fetch(str(uid), '(BODY.PEEK[])')
+        for uid in iter_messageset(parse_esearch(lines).get('ALL', '')):
+            self.blobs[f'G{guid}'] = uid
+            return uid
+        return None
+
+    async def _fetch_blob(self, blobId, items):
+        """Fetches items of message containing blobId with one UID FETCH when its uid is known.
+        Returns (uid, fetched data) or raises notFound"""
+        guid = blobId[1:].partition('-')[0]
+        for refresh in (False, True):
+            uid = await self.blob_uid(blobId, refresh)
+            if uid is None:
+                break
+            ok, lines = await self.imap.uid_fetch(str(uid), f'(UID X-GUID {items})')
             for seq, data in parse_fetch(lines[:-1]):
-                return data['BODY[]']
+                if data.get('X-GUID', None) == guid:
+                    return uid, data
+            # message expunged or moved, search again
         raise errors.notFound(f"Blob {blobId} not found")
 
+    async def download(self, blobId):
+        section = blob_section(blobId)
+        if section:
+            # decoded content of part
+            uid, data = await self._fetch_blob(blobId, f'BINARY.PEEK[{section}]')
+            return nbytes(data[f'BINARY[{section}]'])
+        uid, data = await self._fetch_blob(blobId, 'BODY.PEEK[]')
+        return data['BODY[]']
+
+    async def download_stream(self, blobId, start=0, stop=None):
+        """Returns BlobStream of message or part fetched by one partial FETCH
+        when its uid and size are known, its literal is yielded while it arrives.
+        Streaming FETCH runs on connection of downloads pool, so slow client
+        delays only other downloads, not calls of account"""
+        section = blob_section(blobId)
+        field = f'BINARY.PEEK[{section}]' if section else 'BODY.PEEK[]'
+        uid = self.blobs.get(f"G{blobId[1:].partition('-')[0]}")
+        total = self.blob_sizes.get(blobId)
+        if uid is not None and total is not None:
+            begin, end = byte_range(start, stop, total)
+            chunks = await self._stream_literal(uid, field, begin, end - begin)
+            if chunks is not None:
+                return BlobStream(end - begin, chunks, total, begin)
+            self.blobs.pop(f"G{blobId[1:].partition('-')[0]}")
+        # size is not known or message is not at uid anymore
+        item = f'BINARY.SIZE[{section}]' if section else 'RFC822.SIZE'
+        uid, data = await self._fetch_blob(blobId, item)
+        total = self.blob_sizes[blobId] = int(data[item])
+        start, stop = byte_range(start, stop, total)
+        chunks = await self._stream_literal(uid, field, start, stop - start)
+        if chunks is None:
+            raise errors.notFound(f"Blob {blobId} not found")
+        return BlobStream(stop - start, chunks, total, start)
+
+    async def _stream_literal(self, uid, field, start, size):
+        """Starts partial FETCH, returns async iterator over chunks of its literal
+        when it begins to arrive, None when message has no such literal"""
+        chunks = self._literal_chunks(uid, field, start, size)
+        if await chunks.__anext__():
+            return chunks
+        await chunks.aclose()
+        return None
+
+    async def _literal_chunks(self, uid, field, start, size):
+        if not size:
+            yield True
+            return
+        imap = await self.downloads.acquire()
+        fetch = None
+        try:
+            sink = StreamSink(imap.protocol.transport, self.download_chunk_size)
+            fetch = asyncio.ensure_future(
+                imap.uid_fetch(str(uid), f'({field}<{start}.{size}>)', literal_sink=sink))
+            yield await sink.started(fetch)
+            async for chunk in sink.iterate(fetch):
+                yield chunk
+            ok, lines = await fetch
+            if ok != 'OK' or sink.size is None:
+                raise errors.serverFail(lines[-1])
+        finally:
+            # stopped early, command ends in background without the rest of literal
+            if fetch is not None and not fetch.done():
+                fetch.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self.downloads.release(imap)
+
     async def email_import(self, ifInState=None, emails=()):
         oldState = await self.thread_state()
         if ifInState and ifInState != oldState:
@@ -699,12 +1362,12 @@ class ImapAccount:
 
         created = {}
         notCreated = {}
+        prepared = []
         for id, email in emails.items():
             try:
                 blobId = email.get('blobId', None)
                 if not blobId:
                     raise errors.invalidArguments()
-                body = await self.download(blobId)
                 mailboxIds = email.get('mailboxIds', None)
                 if not mailboxIds:
                     raise errors.invalidArguments('mailboxIds are required')
@@ -714,14 +1377,47 @@ class ImapAccount:
                     imapname = self.mailboxes[mailboxIds[0]]['imapname']
                 except KeyError:
                     raise errors.notFound(f"mailboxId {mailboxIds[0]} not found")
-                flags = "(%s)" % (' '.join(keyword2flag(kw) for kw in email['keywords']))
-                date = email.get('receivedAt', datetime.now())
-                uid, guid = await self._imap_append(body, imapname, flags, date)
-                created[id] = self.format_email_id(uid)
+                flags = keywords2flags(email.get('keywords', ()))
+                date = email.get('receivedAt', None)
+                if isinstance(date, str):
+                    date = datetime.fromisoformat(date.replace('Z', '+00:00'))
+                prepared.append((id, blobId, imapname, flags, date))
             except errors.JmapError as e:
                 notCreated[id] = e.to_dict()
             except Exception as e:
-                notCreated[id] = errors.serverPartialFail(str(e))
+                notCreated[id] = errors.serverPartialFail(str(e)).to_dict()
+
+        # blobs are streamed into APPEND literals, at most import_batch_size at once
+        for i in range(0, len(prepared), self.import_batch_size):
+            batch = prepared[i:i + self.import_batch_size]
+            streams = await asyncio.gather(*(self._import_stream(blobId) for _, blobId, *_ in batch),
+                                           return_exceptions=True)
+            ids = []
+            items = []
+            for (id, blobId, imapname, flags, date), stream in zip(batch, streams):
+                if isinstance(stream, errors.JmapError):
+                    notCreated[id] = stream.to_dict()
+                elif isinstance(stream, Exception):
+                    notCreated[id] = errors.serverPartialFail(str(stream)).to_dict()
+                else:
+                    ids.append(id)
+                    items.append((stream, imapname, flags, date))
+            try:
+                results = await self._imap_append_batch(items)
+            finally:
+                for stream, *_ in items:
+                    await stream.aclose()
+            for id, (stream, *_), result in zip(ids, items, results):
+                if isinstance(result, errors.JmapError):
+                    notCreated[id] = result.to_dict()
+                    continue
+                uid, guid = result
+                created[id] = {
+                    'id': self.format_email_id(uid),
+                    'blobId': f"G{guid}",
+                    'threadId': guid,
+                    'size': len(stream),
+                }
 
         return {
             'accountId': self.id,
@@ -731,6 +1427,13 @@ class ImapAccount:
             'notCreated': notCreated,
         }
 
+    async def _import_stream(self, blobId):
+        if blobId.startswith('G'):
+            # message from this IMAP account, can't be streamed
+            # over the connection used by APPEND
+            return BlobStream.from_bytes(await self.download(blobId))
+        return await self.download_stream(blobId)
+
     async def thread_changes(self, sinceState, maxChanges=None):
         # TODO: threadIds
         return await self.email_changes(sinceState, maxChanges)
@@ -747,10 +1450,10 @@ class ImapAccount:
     async def mailbox_state(self):
         "Return current Mailbox state"
         await self.sync_mailboxes({'created'})
-        return self._mailbox_state
+        return str(self.mailbox_journal.state)
 
     async def mailbox_state_low(self):
-        return self._mailbox_state_low
+        return str(self.mailbox_journal.low)
 
     async def thread_state(self):
         "Return current Thread state"
@@ -759,11 +1462,28 @@ class ImapAccount:
     async def thread_state_low(self):
         await self.email_state_low()
 
-    async def fill_emails(self, properties=(), ids=None):
-        """Fills self.emails with required properties"""
+    def prefetch_properties(self):
+        """Returns (properties, header_names) of emails needed
+        by later method calls in the same request, see jmap.plan"""
+        properties = set()
+        header_names = set()
+        for prop in plan.prefetch.get():
+            m = header_prop_re.match(prop)
+            if m is None:
+                if prop == 'body':
+                    properties.update(('textBody', 'htmlBody'))
+                elif prop in self.fields_map:
+                    properties.add(prop)
+            elif header_name_re.match(m.group(1)):
+                header_names.add(m.group(1).lower())
+        return properties, header_names
+
+    async def fill_emails(self, properties=(), ids=None, header_names=()):
+        """Fills self.emails with required properties
+        and headers with lowercase header_names"""
 
         try:
-            fields = {FIELDS_MAP[prop] for prop in properties}
+            fields = {self.fields_map[prop] for prop in properties}
         except KeyError as e:
             raise errors.invalidArguments(f'Property not recognized: {e}')
 
@@ -771,8 +1491,16 @@ class ImapAccount:
             fields.discard('BODY.PEEK[HEADER]')
             fields.discard('RFC822.SIZE')
 
+        # headers needed for properties are fetched only when not all are fetched
+        fields.discard(HEADER_FIELDS)
+        header_names = set(header_names)
+        header_names.update(HEADER_PROPERTIES[prop] for prop in properties if prop in HEADER_PROPERTIES)
+        if 'BODY.PEEK[]' in fields or 'BODY.PEEK[HEADER]' in fields:
+            header_names.clear()
+
         fetch_uids = set()
         fetch_fields = set()
+        fetch_header_names = set()
         for id in ids:
             try:
                 uid = self.parse_email_id(id)
@@ -781,26 +1509,49 @@ class ImapAccount:
             msg = self.emails.get(id, None)
             if msg is None:
                 fetch_uids.add(uid)
-                fetch_fields = fields
+                fetch_fields.update(fields)
+                fetch_header_names.update(header_names)
             else:
-                missing = fields - msg.keys()
-                if missing:
+                missing = {field for field in fields if fetch_key(field) not in msg}
+                missing_names = msg.missing_header_fields(header_names)
+                if missing or missing_names:
                     fetch_uids.add(uid)
                     fetch_fields.update(missing)
+                    fetch_header_names.update(missing_names)
 
+        if fetch_header_names:
+            fetch_fields.add('BODY.PEEK[HEADER.FIELDS (%s)]' % ' '.join(sorted(fetch_header_names)))
         if not fetch_fields:
             return
         fetch_fields.add('UID')
         fetch_uids = encode_messageset(fetch_uids).decode()
-        ok, lines = await self.imap.uid_fetch(fetch_uids, "(%s)" % (' '.join(fetch_fields)))
+        sink = self.body_sink if self.parse_streaming and 'BODY.PEEK[]' in fetch_fields else None
+        ok, lines = await self.imap.uid_fetch(fetch_uids, "(%s)" % (' '.join(fetch_fields)), literal_sink=sink)
         if ok != 'OK':
             raise errors.serverFail(lines[0])
+        fetched = []
         for seq, data in parse_fetch(lines[:-1]):
             id = self.format_email_id(data['UID'])
             msg = self.emails.get(id, None)
             if not msg:
                 msg = ImapEmail(id=id)
                 self.emails[id] = msg
+            if 'X-GUID' in data:
+                self.blobs[f"G{data['X-GUID']}"] = int(data['UID'])
+                if 'RFC822.SIZE' in data:
+                    self.blob_sizes[f"G{data['X-GUID']}"] = int(data['RFC822.SIZE'])
+            for key in [key for key in data if key.startswith('BODY[HEADER')]:
+                raw = nbytes(data.pop(key))
+                m = header_fields_re.match(key)
+                if m:
+                    names = {unquoted(name).lower() for name in m.group(1).split()}
+                    msg.add_header_fields(names, raw)
+                elif key == 'BODY[HEADER]':
+                    msg.set_headers(raw)
+            body = data.get('BODY[]', None)
+            if isinstance(body, ParsedBody):
+                msg.set_headers(body.headers)
+                msg['EML'] = body.message
             if 'mailboxIds' in properties:
                 try:
                     imapname = unquoted(data['X-MAILBOX'])
@@ -811,12 +1562,93 @@ class ImapAccount:
                         continue
                 msg['mailboxIds'] = [self.byimapname[imapname]['id']]
             msg.update(data)
+            if msg.get('PREVIEW', None) == 'NIL':
+                # not generated yet, fetch again next time
+                del msg['PREVIEW']
+            fetched.append(msg)
+
+        if self.parse_pool is not None and 'BODY.PEEK[]' in fetch_fields \
+                and BODY_PROPERTIES.intersection(properties):
+            await self.parse_bodies(fetched)
+
+    def body_sink(self, line, size):
+        "Literal sink of fill_emails, big BODY[] literals are parsed while they arrive"
+        if size > self.parse_inline_max_size and line.endswith(' BODY[] {%d}' % size):
+            return MessageSink(size)
+        return None
+
+    async def fill_body_values(self, ids, types=TEXT_TYPES, maxBodyValueBytes=0):
+        """Fetches only sections of text parts with given types
+        needed for bodyValues, emails need to have BODYSTRUCTURE.
+        With maxBodyValueBytes only first bytes of bigger sections are fetched"""
+        byfields = {}
+        for id in ids:
+            msg = self.emails.get(id, None)
+            if msg is None or 'BODYSTRUCTURE' not in msg:
+                continue
+            fields = set()
+            for part in msg['BODYSECTIONS'].values():
+                section = part['section']
+                if part['type'] not in types or f"BODY[{section}]" in msg:
+                    continue
+                if maxBodyValueBytes:
+                    size = encoded_size(maxBodyValueBytes, part['encoding'], part['charset'])
+                    if size < part['size']:
+                        partial = msg.get(f"BODY[{section}]<0>", None)
+                        if partial is None or len(nbytes(partial)) < size:
+                            fields.add(f"BODY.PEEK[{section}]<0.{size}>")
+                        continue
+                fields.add(f"BODY.PEEK[{section}]")
+            if fields:
+                byfields.setdefault(frozenset(fields), []).append(self.parse_email_id(id))
+
+        for fields, uids in byfields.items():
+            fetch_fields = ' '.join(sorted(fields))
+            ok, lines = await self.imap.uid_fetch(encode_messageset(uids).decode(), f"(UID {fetch_fields})")
+            if ok != 'OK':
+                raise errors.serverFail(lines[0])
+            for seq, data in parse_fetch(lines[:-1]):
+                msg = self.emails.get(self.format_email_id(data['UID']), None)
+                if msg is not None:
+                    msg.update(data)
+                    msg.pop('bodyValues', None)
+
+    async def fill_previews(self, ids):
+        """Fetches BODYSTRUCTURE and whole text sections of emails
+        without preview generated by server or cached"""
+        missing = []
+        for id in ids:
+            msg = self.emails.get(id, None)
+            if msg is None or 'PREVIEW' in msg:
+                continue
+            if 'X-GUID' in msg and PREVIEW_CACHE.get(msg['blobId']) is not None:
+                continue
+            missing.append(id)
+        if missing:
+            await self.fill_emails({'bodyStructure'}, missing)
+            await self.fill_body_values(missing)
+
+    async def parse_bodies(self, msgs):
+        """Parses big messages in parse_pool, smaller stay parsed lazily"""
+        loop = asyncio.get_running_loop()
+        msgs = [msg for msg in msgs
+                if 'bodyStructure' not in msg and 'EML' not in msg and
+                len(msg.get('BODY[]', None) or b'') > self.parse_inline_max_size]
+        results = await asyncio.gather(*(
+            loop.run_in_executor(self.parse_pool, parse_email, msg['blobId'], msg['BODY[]'])
+            for msg in msgs))
+        for msg, (bodyValues, bodyStructure) in zip(msgs, results):
+            msg['bodyValues'] = bodyValues
+            msg['bodyStructure'] = bodyStructure
 
     async def sync_mailboxes(self, fields=None):
+        async with self.mailbox_sync_lock:
+            await self._sync_mailboxes(fields)
+
+    async def _sync_mailboxes(self, fields=None):
         deleted_ids = set(self.mailboxes.keys())
         if fields is None:
             fields = {'totalEmails', 'unreadEmails', 'totalThreads', 'unreadThreads'}
-        new_state = now_state()
         ok, lines = await self.imap.list(ret='SPECIAL-USE SUBSCRIBED STATUS (MESSAGES X-GUID)')
         for flags, sep, imapnameq, status in parse_list_status(lines):
             imapname = unquoted(imapnameq)
@@ -824,14 +1656,14 @@ class ImapAccount:
             if flags.intersection({'\\noselect', '\\nonexistent'}):
                 continue
             id = status['X-GUID']
+            deleted_ids.discard(id)
             mailbox = self.mailboxes.get(id, None)
-            if mailbox:
-                deleted_ids.remove(id)
-            else:
+            if not mailbox or mailbox['deleted']:
                 mailbox = ImapMailbox(id=id, imapname=imapname, sep=sep, flags=flags)
                 mailbox.db = self
                 self.byimapname[imapname] = mailbox
                 self.mailboxes[id] = mailbox
+                self.mailbox_journal.record(id, 'created')
             data = {
                 'totalEmails': int(status['MESSAGES']),
                 'imapname': imapname,
@@ -853,21 +1685,26 @@ class ImapAccount:
                         except ValueError:  # got NIL or wrong value
                             pass
 
-            # set updated state
+            # record update to journal
+            kind = None
             for key, val in data.items():
                 if mailbox[key] != val:
                     if key not in {'totalEmails', 'unreadEmails', 'totalThreads', 'unreadThreads'}:
-                        mailbox['updatedNonCounts'] = new_state
+                        kind = 'updated'
                         if key == 'imapname':
                             mailbox.pop('name', None)
                             mailbox.pop('parentId', None)
-                    mailbox['updated'] = new_state
+                    elif kind is None:
+                        kind = 'counts'
                     mailbox[key] = val
+            if kind:
+                self.mailbox_journal.record(id, kind)
 
         for id in deleted_ids:
             mailbox = self.mailboxes[id]
             if not mailbox['deleted']:
-                mailbox['deleted'] = new_state
+                mailbox['deleted'] = True
+                self.mailbox_journal.record(id, 'destroyed')
 
     async def update_mailbox(self, mailbox, update):
         fail = errors.serverFail
@@ -931,6 +1768,9 @@ class ImapAccount:
                 out += b' '
                 out += func(value) if func else value
                 out += b' '
+            elif 'uids' == crit and isinstance(value, frozenset):
+                # found by TextIndex
+                out += b'UID %s ' % encode_messageset(value) if value else b'NOT ALL '
             elif 'deleted' == crit:
                 if not value:
                     out += b'NOT '
@@ -1015,7 +1855,10 @@ def _validate_query(position, limit, sort, filter):
 
 
 header_prop_re = re.compile(r'^header:([^:]+)(?::as(\w+))?(:all)?')
+header_name_re = re.compile(r'^[\w-]+$', re.ASCII)
 uidvalidity_re = re.compile(r'\[UIDVALIDITY ([0-9]+)\]', re.I)
+appenduid_re = re.compile(r'\[APPENDUID ([0-9]+) ([0-9:,]+)\]', re.I)
+copyuid_re = re.compile(r'\[COPYUID ([0-9]+) ([0-9:,]+) ([0-9:,]+)\]', re.I)
 
 ALL_MAILBOX_PROPERTIES = {
     'id', 'name', 'parentId', 'role', 'sortOrder', 'isSubscribed',
@@ -1034,11 +1877,32 @@ ALL_PROPERTIES = {
     # 'body'
 }
 
+BODY_PROPERTIES = {
+    'bodyStructure', 'bodyValues', 'textBody', 'htmlBody', 'attachments',
+}
+
 ALL_BODY_PROPERTIES = {
     "partId", "blobId", "size", "name", "type",
     "charset", "disposition", "cid", "language", "location",
 }
 
+# properties parsed from single header, fetched by BODY.PEEK[HEADER.FIELDS (...)]
+HEADER_FIELDS = 'BODY.PEEK[HEADER.FIELDS]'
+HEADER_PROPERTIES = {
+    'messageId':    'message-id',
+    'sender':       'sender',
+    'subject':      'subject',
+    'from':         'from',
+    'to':           'to',
+    'cc':           'cc',
+    'bcc':          'bcc',
+    'replyTo':      'reply-to',
+    'inReplyTo':    'in-reply-to',
+    'sentAt':       'date',
+    'references':   'references',
+}
+header_fields_re = re.compile(r'^BODY\[HEADER\.FIELDS \(([^)]*)\)\]$', re.I)
+
 FIELDS_MAP = {
     'id':           'UID',
 
@@ -1057,8 +1921,9 @@ FIELDS_MAP = {
 
     'keywords':     'FLAGS',
 
-    # PREVIEW=* extension https://datatracker.ietf.org/doc/draft-ietf-extra-imap-fetch-preview/
-    'preview':      'PREVIEW',
+    # PREVIEW extension https://datatracker.ietf.org/doc/html/rfc8970
+    # LAZY returns NIL instead of waiting for preview generation
+    'preview':      'PREVIEW (LAZY)',
     # 'preview':      'BODY.PEEK[]',
 
     'receivedAt':   'INTERNALDATE',
@@ -1068,23 +1933,69 @@ FIELDS_MAP = {
     'bodyValues':   'BODY.PEEK[]',
     'textBody':     'BODY.PEEK[]',
     'htmlBody':     'BODY.PEEK[]',
-    'messageId':    'BODY.PEEK[HEADER]',
+    'messageId':    HEADER_FIELDS,
     'headers':      'BODY.PEEK[HEADER]',
-    'sender':       'BODY.PEEK[HEADER]',
-    'subject':      'BODY.PEEK[HEADER]',
-    'from':         'BODY.PEEK[HEADER]',
-    'to':           'BODY.PEEK[HEADER]',
-    'cc':           'BODY.PEEK[HEADER]',
-    'bcc':          'BODY.PEEK[HEADER]',
-    'replyTo':      'BODY.PEEK[HEADER]',
-    'inReplyTo':    'BODY.PEEK[HEADER]',
-    'sentAt':       'BODY.PEEK[HEADER]',
-    'references':   'BODY.PEEK[HEADER]',
+    'sender':       HEADER_FIELDS,
+    'subject':      HEADER_FIELDS,
+    'from':         HEADER_FIELDS,
+    'to':           HEADER_FIELDS,
+    'cc':           HEADER_FIELDS,
+    'bcc':          HEADER_FIELDS,
+    'replyTo':      HEADER_FIELDS,
+    'inReplyTo':    HEADER_FIELDS,
+    'sentAt':       HEADER_FIELDS,
+    'references':   HEADER_FIELDS,
     'created':      'UID',
     'updated':      'MODSEQ',
     'deleted':      'MODSEQ',
 }
 
+FIELDS_MAP_BODYSTRUCTURE = {
+    **FIELDS_MAP,
+    'hasAttachment': 'BODYSTRUCTURE',
+    'attachments':  'BODYSTRUCTURE',
+    'bodyStructure':'BODYSTRUCTURE',
+    'bodyValues':   'BODYSTRUCTURE',  # text sections fetched by fill_body_values()
+    'textBody':     'BODYSTRUCTURE',
+    'htmlBody':     'BODYSTRUCTURE',
+}
+
+def blob_section(blobId):
+    "Returns IMAP section of part blobId G{X-GUID}-{partId} or '' for whole message"
+    return blobId[1:].partition('-')[2].replace('-', '.')
+
+
+def base64_lines(data):
+    "Base64 of data in lines of 76 characters ending by CRLF"
+    return encodebytes(data).replace(b'\n', b'\r\n')
+
+
+async def spooled_chunks(head, file, chunk_size):
+    "Yields head and then content of file from current position"
+    yield head
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def fetch_key(field):
+    "Returns key of FETCH response data item for requested field"
+    field = fetch_modifiers_re.sub('', field)
+    return partial_length_re.sub(r'<\1>', field.replace('.PEEK', '', 1))
+
+partial_length_re = re.compile(r'<([0-9]+)\.[0-9]+>$')
+fetch_modifiers_re = re.compile(r' \([A-Z ]*\)$')
+
+
+def truncate_body_value(bodyValue, maxBodyValueBytes):
+    "Returns bodyValue with value of at most maxBodyValueBytes UTF-8 bytes"
+    value = truncate_utf8(bodyValue['value'], maxBodyValueBytes)
+    if len(value) == len(bodyValue['value']):
+        return bodyValue
+    return {**bodyValue, 'value': value, 'isTruncated': True}
+
 HEADER_FORMS = {
     None: asRaw,
     'Raw': asRaw,
@@ -1096,6 +2007,42 @@ HEADER_FORMS = {
     'MessageIds': asMessageIds,
 }
 
+def collect_text_criteria(filter, text):
+    "Collects text criteria {crit: words} from nested filter for highlighting"
+    if 'operator' in filter:
+        if filter['operator'] != 'NOT':
+            for cond in filter.get('conditions', ()):
+                collect_text_criteria(cond, text)
+        return
+    for crit, value in filter.items():
+        if crit in TEXT_COLUMNS and isinstance(value, str):
+            text[crit] = f"{text[crit]} {value}" if crit in text else value
+
+
+def messageset_count(s):
+    "Returns count of uids in IMAP messageset without expanding it"
+    count = 0
+    for pair in s.split(',') if s else ():
+        start, _, end = pair.partition(':')
+        count += abs(int(end or start) - int(start)) + 1
+    return count
+
+
+def messageset_complement(s, uidnext):
+    "Returns messageset of uids lower than uidnext not in sorted messageset s"
+    out = []
+    expected = 1
+    for pair in s.split(',') if s else ():
+        start, _, end = pair.partition(':')
+        start, end = sorted((int(start), int(end or start)))
+        if start > expected:
+            out.append(f'{expected}:{start - 1}' if start - 1 > expected else str(expected))
+        expected = max(expected, end + 1)
+    if uidnext > expected:
+        out.append(f'{expected}:{uidnext - 1}' if uidnext - 1 > expected else str(expected))
+    return ','.join(out)
+
+
 def int2bytes(i):
     return b'%d' % i
 
@@ -1148,10 +2095,6 @@ def as_imap_sort(sort):
     return out
 
 
-def now_state():
-    return str(int(datetime.now().timestamp()))
-
-
 MAILBOX_FILTERS = {
     'hasAnyRole':   lambda mbox, val: bool(mbox['role']) == val,
     'isSubscribed': lambda mbox, val: mbox['isSubscribed'] == val,
@@ -27,6 +27,9 @@ from collections import namedtuple
 from copy import copy
 from datetime import datetime, timezone, timedelta
 from enum import Enum
+from time import monotonic
+
+from jmap.metrics import imap_bytes, imap_commands
 
 try:
     from asyncio import get_running_loop
@@ -148,11 +151,17 @@ def arguments_rfs2971(**kwargs):
 
 
 class Command(object):
-    def __init__(self, name, tag, *args, by_uid=False, untagged_name=None, loop=None, timeout=None):
+    def __init__(self, name, tag, *args, by_uid=False, untagged_name=None, loop=None, timeout=None, literals=None,
+                 literal_sink=None):
         self.name = name
         self.tag = tag
         self.args = args
         self.by_uid = by_uid
+        # [literal, tail] to send on continuations, literal is bytes or async iterable with len()
+        self.literals = literals or []
+        # literal_sink(line, size) returns object with feed(chunk) and close() or None,
+        # its literal is fed to it while it arrives and close() result is the response line
+        self.literal_sink = literal_sink
         if untagged_name is None:
             self.untagged_names = (name,)
         elif isinstance(untagged_name, str):
@@ -168,6 +177,8 @@ class Command(object):
         self._timer = asyncio.Handle(lambda: None, None, self._loop)  # fake timer
         self._set_timer()
         self._literal_data = None
+        self._literal_size = 0
+        self._sink = None
         self._expected_size = 0
 
     def __repr__(self):
@@ -190,20 +201,28 @@ class Command(object):
 
     def begin_literal_data(self, expected_size, literal_data=b''):
         self._expected_size = expected_size
+        self._literal_size = 0
         self._literal_data = bytearray()
+        if self.literal_sink is not None and self.response is not None:
+            self._sink = self.literal_sink(self.response.lines[-1], expected_size)
         return self.append_literal_data(literal_data)
 
     def wait_literal_data(self):
-        return self._expected_size != 0 and len(self._literal_data) != self._expected_size
+        return self._expected_size != 0 and self._literal_size != self._expected_size
 
     def wait_data(self):
         return self.wait_literal_data()
 
     def append_literal_data(self, data):
-        nb_bytes_to_add = self._expected_size - len(self._literal_data)
-        self._literal_data += data[0:nb_bytes_to_add]
+        nb_bytes_to_add = self._expected_size - self._literal_size
+        chunk = data[0:nb_bytes_to_add]
+        self._literal_size += len(chunk)
+        if self._sink is not None:
+            self._sink.feed(chunk)
+        else:
+            self._literal_data += chunk
         if not self.wait_literal_data():
-            self.append_to_resp(self._literal_data)
+            self.append_to_resp(self._literal_data if self._sink is None else self._sink.close())
             self._end_literal_data()
         self._reset_timer()
         return data[nb_bytes_to_add:]
@@ -227,7 +246,9 @@ class Command(object):
 
     def _end_literal_data(self):
         self._expected_size = 0
+        self._literal_size = 0
         self._literal_data = None
+        self._sink = None
 
     def _set_timer(self):
         if self._timeout is not None:
@@ -343,10 +364,13 @@ class IMAP4ClientProtocol(asyncio.Protocol):
         self.pending_sync_command = None
         self.idle_queue = asyncio.Queue()
         self.imap_version = None
-        self.literal_data = None
         self.incomplete_line = b''
+        self.can_write = asyncio.Event()
+        self.can_write.set()
         self.current_command = None
         self.conn_lost_cb = conn_lost_cb
+        # one command at a time, concurrent callers share this connection
+        self.command_lock = asyncio.Lock()
 
         self.tagnum = 0
         self.tagpre = int2ap(random.randint(4096, 65535))
@@ -357,6 +381,7 @@ class IMAP4ClientProtocol(asyncio.Protocol):
 
     def data_received(self, d):
         log.debug('Received : %s' % d)
+        imap_bytes['in'] += len(d)
         try:
             self._handle_responses(self.incomplete_line + d, self._handle_line, self.current_command)
             self.incomplete_line = b''
@@ -365,8 +390,15 @@ class IMAP4ClientProtocol(asyncio.Protocol):
             self.current_command = incomplete_read.cmd
             self.incomplete_line = incomplete_read.data
 
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
     def connection_lost(self, exc):
         log.debug('connection lost: %s', exc)
+        self.can_write.set()
         if self.conn_lost_cb is not None:
             self.conn_lost_cb(exc)
 
@@ -421,9 +453,20 @@ class IMAP4ClientProtocol(asyncio.Protocol):
     def send(self, line):
         data = ('%s\r\n' % line).encode()
         log.debug('Sending : %s' % data)
+        imap_bytes['out'] += len(data)
         self.transport.write(data)
 
     async def execute(self, command):
+        async with self.command_lock:
+            # timeout counts from sending, not from waiting for lock
+            command._reset_timer()
+            t0 = monotonic()
+            try:
+                return await self._execute(command)
+            finally:
+                imap_commands.observe(command.name, monotonic() - t0)
+
+    async def _execute(self, command):
         if self.pending_sync_command is not None:
             await self.pending_sync_command.wait()
 
@@ -565,10 +608,10 @@ class IMAP4ClientProtocol(asyncio.Protocol):
                     timeout=timeout,
                     ))
 
-    async def fetch(self, message_set, parts, modifiers=None, by_uid=False, timeout=None):
+    async def fetch(self, message_set, parts, modifiers=None, by_uid=False, timeout=None, literal_sink=None):
         return await self.execute(
             FetchCommand(self.new_tag(), message_set, parts, modifiers,
-                         by_uid=by_uid, loop=self.loop, timeout=timeout))
+                         by_uid=by_uid, loop=self.loop, timeout=timeout, literal_sink=literal_sink))
 
     async def store(self, *args, by_uid=False, timeout=None):
         return await self.execute(
@@ -621,17 +664,36 @@ class IMAP4ClientProtocol(asyncio.Protocol):
             raise Error('server not IMAP4 compliant')
 
     async def append(self, message_bytes, mailbox='INBOX', flags=None, date=None, timeout=None):
+        return await self.multiappend(((message_bytes, flags, date),), mailbox, timeout=timeout)
+
+    async def multiappend(self, messages, mailbox='INBOX', timeout=None):
+        """RFC 3502 MULTIAPPEND
+        messages is sequence of (message_bytes, flags, date)
+        message_bytes can be async iterable of chunks with len(),
+        it is streamed with respect to transport write buffer.
+        one message is sent as plain APPEND"""
+        if len(messages) > 1 and 'MULTIAPPEND' not in self.capabilities:
+            raise Abort('server has not MULTIAPPEND capability')
         args = [mailbox]
-        if flags is not None:
-            if (flags[0], flags[-1]) != ('(', ')'):
-                args.append('(%s)' % flags)
+        literals = []
+        for message_bytes, flags, date in messages:
+            msgargs = []
+            if flags is not None:
+                if (flags[0], flags[-1]) != ('(', ')'):
+                    msgargs.append('(%s)' % flags)
+                else:
+                    msgargs.append(flags)
+            if date is not None:
+                msgargs.append(time2internaldate(date))
+            msgargs.append('{%s}' % len(message_bytes))
+            if literals:
+                # arguments of next message are sent right after previous literal
+                literals[-1][1] = (' ' + ' '.join(msgargs)).encode()
             else:
-                args.append(flags)
-        if date is not None:
-            args.append(time2internaldate(date))
-        args.append('{%s}' % len(message_bytes))
-        self.literal_data = message_bytes
-        return await self.execute(Command('APPEND', self.new_tag(), *args, loop=self.loop, timeout=timeout))
+                args.extend(msgargs)
+            literals.append([message_bytes, b''])
+        return await self.execute(Command('APPEND', self.new_tag(), *args, loop=self.loop, timeout=timeout,
+                                          literals=literals))
 
     async def getmetadata(self, mailbox, metadata, options=None, timeout=None):
         args = () if options is None else (options)
@@ -730,11 +792,16 @@ class IMAP4ClientProtocol(asyncio.Protocol):
 
     def _continuation(self, line):
         if self.pending_sync_command is not None and self.pending_sync_command.name == 'APPEND':
-            if self.literal_data is None:
-                Abort('asked for literal data but have no literal data to send')
-            self.transport.write(self.literal_data)
-            self.transport.write(b'\r\n')
-            self.literal_data = None
+            command = self.pending_sync_command
+            if not command.literals:
+                raise Abort('asked for literal data but have no literal data to send')
+            literal, tail = command.literals.pop(0)
+            if isinstance(literal, (bytes, bytearray, memoryview)):
+                imap_bytes['out'] += len(literal) + len(tail) + 2
+                self.transport.write(literal)
+                self.transport.write(tail + b'\r\n')
+            else:
+                asyncio.ensure_future(self._write_literal_stream(command, literal, tail))
         elif self.pending_sync_command is not None:
             log.debug('continuation line appended to pending sync command %s : %s' % (self.pending_sync_command, line))
             self.pending_sync_command.append_to_resp(line)
@@ -742,6 +809,27 @@ class IMAP4ClientProtocol(asyncio.Protocol):
         else:
             log.info('server says %s (ignored)' % line)
 
+    async def _write_literal_stream(self, command, literal, tail):
+        size = 0
+        try:
+            async for chunk in literal:
+                size += len(chunk)
+                if size > len(literal):
+                    raise Abort('literal is longer than announced')
+                imap_bytes['out'] += len(chunk)
+                self.transport.write(chunk)
+                await self.can_write.wait()
+            if size != len(literal):
+                raise Abort('literal is shorter than announced')
+        except Exception as e:
+            # server waits for rest of literal, connection is not usable anymore
+            log.error('failed to send literal of %s: %s', command, e)
+            self.transport.abort()
+            command.close(str(e), 'NO')
+            return
+        imap_bytes['out'] += len(tail) + 2
+        self.transport.write(tail + b'\r\n')
+
     def new_tag(self):
         tag = self.tagpre + str(self.tagnum)
         self.tagnum += 1
@@ -829,9 +917,9 @@ class IMAP4(object):
         return await self.protocol.fetch(message_set, message_parts, modifiers,
                                          timeout=self.timeout)
 
-    async def uid_fetch(self, message_set, message_parts, modifiers=None):
+    async def uid_fetch(self, message_set, message_parts, modifiers=None, literal_sink=None):
         return await self.protocol.fetch(message_set, message_parts, modifiers,
-                                         by_uid=True, timeout=self.timeout)
+                                         by_uid=True, timeout=self.timeout, literal_sink=literal_sink)
 
     async def idle(self):
         return await self.protocol.idle()
@@ -906,6 +994,9 @@ class IMAP4(object):
     async def append(self, message_bytes, mailbox='INBOX', flags=None, date=None):
         return await self.protocol.append(message_bytes, mailbox, flags, date, timeout=self.timeout)
 
+    async def multiappend(self, messages, mailbox='INBOX'):
+        return await self.protocol.multiappend(messages, mailbox, timeout=self.timeout)
+
     async def close(self):
         return await asyncio.wait_for(self.protocol.close(), self.timeout)
 
@@ -1055,13 +1146,13 @@ def parse_metadata(lines):
 class ResponseParser:
     __slots__ = 'atoms', 'literal_next'
 
-    # doesn't work for BODY.PEEK[HEADER.FIELDS (SUBJECT)]
-    # and similar with brackets inside field name
     atom_re = re.compile(r'''
         ( # brackets
         [()]
         | # quoted
         \"(?:|.*?[^\\](?:(?:\\\\)+)?)\"
+        | # section with spaces and brackets like BODY[HEADER.FIELDS (SUBJECT)]<0>
+        (?:BODY|BINARY)(?:\.PEEK)?\[[^\]]*\](?:<[0-9]+>)?
         | # other value without space
         [^()\s]+
         )''', re.VERBOSE)
@@ -1,10 +1,18 @@
+import asyncio
+from collections import deque
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta, timezone
 import email
+from email.feedparser import BytesFeedParser
 from email.policy import default
+import os
 import re
+import sys
 
 from .aioimaplib import unquoted
+from jmap.cache import LRUCache
 from jmap.parse import asAddresses, asDate, asMessageIds, asText, bodystructure, htmltotext, make, parseStructure, \
-    htmlpreview
+    htmlpreview, asCommaList, asFilename, asOneURL, decode_body
 
 KEYWORD2FLAG = {
     '$answered':'\\Answered',
@@ -14,18 +22,123 @@ KEYWORD2FLAG = {
 }
 FLAG2KEYWORD = {flag.lower(): kw for kw, flag in KEYWORD2FLAG.items()}
 
+# previews computed from bodies, keyed by immutable blobId
+PREVIEW_CACHE = LRUCache(int(os.getenv('PREVIEW_CACHE_SIZE', 10000)))
+
 def keyword2flag(kw):
     return KEYWORD2FLAG.get(kw, None) or kw.encode()
 
-
-header_re = re.compile(r'^([\w-]+)\s*:\s*(.+?)\r\n(?=[\w\r])',
-                       re.I | re.M | re.DOTALL | re.ASCII)
+def keywords2flags(keywords):
+    "Formats JMAP keywords as IMAP flag list"
+    return flags_list(KEYWORD2FLAG.get(kw, kw) for kw in keywords)
+
+def flags_list(flags):
+    "Formats IMAP flags (str or bytes) as IMAP flag list"
+    return '(%s)' % ' '.join(f if isinstance(f, str) else f.decode() for f in flags)
+
+
+# field name, value with folded lines, one scan of header bytes
+header_re = re.compile(rb'^([!-9;-~]+)[ \t]*:[ \t]*([^\r\n]*(?:\r?\n[ \t][^\r\n]*)*)\r?\n', re.M)
+header_end_re = re.compile(rb'\r?\n\r?\n')
+
+# flags of all emails interned in one table, each email keeps only bitmask,
+# the table is shared by all accounts and capped, other flags are kept by email
+MAX_FLAGS = 256
+FLAG_BITS = {}
+FLAG_NAMES = []
+
+def flags_mask(flags):
+    """Returns bitmask of flags and set of flags without bit or None,
+    new flags get next bit until there are MAX_FLAGS"""
+    mask = 0
+    overflow = None
+    for flag in flags:
+        bit = FLAG_BITS.get(flag, None)
+        if bit is None:
+            if len(FLAG_NAMES) >= MAX_FLAGS:
+                if overflow is None:
+                    overflow = set()
+                overflow.add(flag)
+                continue
+            bit = FLAG_BITS[flag] = len(FLAG_NAMES)
+            FLAG_NAMES.append(sys.intern(flag))
+        mask |= 1 << bit
+    return mask, frozenset(overflow) if overflow else None
+
+def mask_flags(mask, overflow=None):
+    "Returns list of flags in bitmask and overflow set"
+    flags = [FLAG_NAMES[bit] for bit in range(mask.bit_length()) if mask >> bit & 1]
+    if overflow:
+        flags.extend(overflow)
+    return flags
+
+
+def decode_header_value(blob, start, length):
+    "Decodes raw header value, UTF-8 with fallback to latin-1 for 8-bit headers"
+    raw = blob[start:start + length]
+    try:
+        return raw.decode()
+    except UnicodeDecodeError:
+        return raw.decode('latin-1')
+
+
+def parse_internaldate(value):
+    "Returns (timestamp, utcoffset minutes) from IMAP INTERNALDATE"
+    date = datetime.strptime(unquoted(value).strip(), '%d-%b-%Y %H:%M:%S %z')
+    return int(date.timestamp()), int(date.utcoffset().total_seconds()) // 60
+
+
+# raw IMAP fetch items kept in slots, other items and properties in _data
+SLOTS = {
+    'id':           '_id',
+    'UID':          '_uid',
+    'X-GUID':       '_guid',
+    'X-MAILBOX':    '_mailbox',
+    'FLAGS':        '_flags',
+    'INTERNALDATE': '_internaldate',
+    'RFC822.SIZE':  '_size',
+    'MODSEQ':       '_modseq',
+    'BODY[HEADER]': '_headers',
+}
 
 
-class ImapEmail(dict):
-    __slots__ = ()
+class ImapEmail(MutableMapping):
+    """Cached email metadata, mapping of IMAP fetch items and JMAP properties.
+    Frequent items are compact slots: flags as bitmask of interned FLAG_NAMES,
+    INTERNALDATE as timestamp, headers as one bytes blob with offset table.
+    Missing JMAP properties are derived on demand by methods of the same name."""
+    __slots__ = ('_id', '_uid', '_guid', '_mailbox', '_flags', '_flags_overflow', '_internaldate', '_tzoffset',
+                 '_size', '_modseq', '_headers', '_header_fields', '_header_index', '_data')
+
+    def __init__(self, *args, **kwargs):
+        self._id = self._uid = self._guid = self._mailbox = None
+        self._flags = self._internaldate = self._tzoffset = self._size = self._modseq = None
+        # flags over MAX_FLAGS in FLAG_NAMES
+        self._flags_overflow = None
+        # headers of _header_fields, all headers when it is None
+        self._headers = self._header_fields = self._header_index = None
+        self._data = None
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        slot = SLOTS.get(key, None)
+        if slot is not None:
+            value = getattr(self, slot)
+            if value is not None:
+                if slot == '_flags':
+                    return mask_flags(value, self._flags_overflow)
+                if slot == '_internaldate':
+                    return '"%s"' % self.receivedAt().strftime('%d-%b-%Y %H:%M:%S %z')
+                if slot == '_headers' and self._header_fields is not None:
+                    return self.__missing__(key)
+                return value
+        elif self._data is not None and key in self._data:
+            return self._data[key]
+        return self.__missing__(key)
 
     def __missing__(self, key):
+        if key[:1] == '_':
+            raise KeyError(key)
         try:
             return getattr(self, key)()
         except TypeError:
@@ -33,33 +146,143 @@ class ImapEmail(dict):
         except AttributeError:
             raise KeyError(key)
 
+    def __setitem__(self, key, value):
+        slot = SLOTS.get(key, None)
+        if slot is None:
+            if self._data is None:
+                self._data = {}
+            self._data[key] = value
+            if key == 'BODY[]' and self._header_fields is not None:
+                # subset of header fields, all are in whole message
+                self._headers = self._header_fields = self._header_index = None
+        elif slot == '_headers':
+            self.set_headers(value)
+        elif slot == '_flags':
+            self._flags, self._flags_overflow = flags_mask(value)
+        elif slot == '_internaldate':
+            try:
+                self._internaldate, self._tzoffset = parse_internaldate(value)
+            except ValueError:
+                # kept raw for asDate
+                self._internaldate = None
+                if self._data is None:
+                    self._data = {}
+                self._data[key] = value
+        elif slot in ('_uid', '_size', '_modseq'):
+            # MODSEQ is parsed as list
+            setattr(self, slot, int(value[0] if isinstance(value, list) else value))
+        elif slot == '_mailbox':
+            self._mailbox = sys.intern(value)
+        else:
+            setattr(self, slot, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        slot = SLOTS.get(key, None)
+        if slot is None:
+            del self._data[key]
+        elif slot == '_headers':
+            self._headers = self._header_fields = self._header_index = None
+        elif slot == '_flags':
+            self._flags = self._flags_overflow = None
+        else:
+            setattr(self, slot, None)
+
+    def __contains__(self, key):
+        slot = SLOTS.get(key, None)
+        if slot is not None:
+            if slot == '_headers':
+                return self._headers is not None and self._header_fields is None
+            return getattr(self, slot) is not None
+        return self._data is not None and key in self._data
+
+    def __iter__(self):
+        for key in SLOTS:
+            if key in self:
+                yield key
+        if self._data is not None:
+            yield from self._data
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    # only fetched or set items, like dict methods without __missing__
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def header_blob(self):
+        "Returns bytes of fetched headers, from BODY[] when headers were not fetched"
+        if self._headers is None:
+            body = self.get('BODY[]', None)
+            if body is None:
+                return None
+            end = header_end_re.search(body)
+            self._headers = bytes(body[:end.end()]) if end else bytes(body)
+        return self._headers
+
+    def header_index(self):
+        """Returns tuple of (lowercase name, name start, value start, value length)
+        in header_blob, made by one scan, values are decoded only when requested"""
+        if self._header_index is None:
+            blob = self.header_blob()
+            if blob is None:
+                raise KeyError('BODY[HEADER]')
+            self._header_index = tuple(
+                (sys.intern(m.group(1).decode('ascii').lower()), m.start(1), m.start(2), m.end(2) - m.start(2))
+                for m in header_re.finditer(blob))
+        return self._header_index
+
     def get_header(self, name: str):
         "Return raw value from last header instance, name needs to be lowercase."
-        return self['LASTHEADERS'].get(name, None)
+        for lname, name_start, start, length in reversed(self.header_index()):
+            if lname == name:
+                return decode_header_value(self._headers, start, length)
+        return None
+
+    def get_all_headers(self, name: str):
+        "Return raw values from all header instances, name needs to be lowercase."
+        index = self.header_index()
+        return [decode_header_value(self._headers, start, length)
+                for lname, name_start, start, length in index if lname == name]
+
+    def missing_header_fields(self, names):
+        "Return names of headers not fetched yet, names need to be lowercase."
+        if self._header_fields is None and (self._headers is not None or 'BODY[]' in self):
+            return set()
+        return set(names).difference(self._header_fields or ())
+
+    def add_header_fields(self, names, raw):
+        """Merge headers fetched by BODY.PEEK[HEADER.FIELDS (names)]
+        with headers of other fields fetched before"""
+        if self._header_fields is None and (self._headers is not None or 'BODY[]' in self):
+            # all headers are known already
+            return
+        headers = self._headers or b'\r\n'
+        # both end with empty line
+        self._headers = headers[:-2] + bytes(raw)
+        self._header_fields = frozenset(sys.intern(name) for name in (self._header_fields or ())).union(names)
+        self._header_index = None
+
+    def set_headers(self, raw):
+        "Set all headers fetched by BODY.PEEK[HEADER]"
+        self._headers = bytes(raw)
+        self._header_fields = None
+        self._header_index = None
 
     def EML(self):
         self['EML'] = email.message_from_bytes(self['BODY[]'], policy=default)
         return self['EML']
 
-    def LASTHEADERS(self):
-        # make headers dict with only last instance of each header
-        # as required by JMAP spec for single header get
-        self['LASTHEADERS'] = {name.lower(): raw
-                for name, raw in header_re.findall(self['DECODEDHEADERS'])}
-        return self['LASTHEADERS']
-
-    def DECODEDHEADERS(self):
-        try:
-            self['DECODEDHEADERS'] = self['BODY[HEADER]'].decode()
-            # free memory but keep in dict to avoid fetching it again
-            self['BODY[HEADER]'] = None
-            return self['DECODEDHEADERS']
-        except KeyError:
-            match = re.search(rb'\r\n\r\n', self['BODY[]'])
-            if match:
-                self['DECODEDHEADERS'] = str(memoryview(self['BODY[]'])[:match.end()])
-                return self['DECODEDHEADERS']
-
     def blobId(self):
         return f"G{self['X-GUID']}"
         # TODO: OBJECTID extension: return self['EMAILID'][0]
@@ -69,19 +292,23 @@ class ImapEmail(dict):
         # TODO: OBJECTID extension: self['THREADID'][0]
 
     def hasAttachment(self):
+        if 'BODYSTRUCTURE' in self:
+            return bool(self['attachments'])
         # Dovecot with mail_attachment_detection_options = add-flags-on-save
         return '$HasAttachment' in self['FLAGS']
 
     def headers(self):
-        return [{'name': name, 'value': value}
-                for name, value in header_re.findall(self['DECODEDHEADERS'])]
+        index = self.header_index()
+        blob = self._headers
+        return [{'name': blob[name_start:name_start + len(lname)].decode('ascii'),
+                 'value': decode_header_value(blob, start, length)}
+                for lname, name_start, start, length in index]
 
     def inReplyTo(self):
         return asMessageIds(self.get_header('in-reply-to'))
 
     def keywords(self):
-        self['keywords'] = {FLAG2KEYWORD.get(f.lower(), f): True for f in self['FLAGS']}
-        return self['keywords']
+        return {FLAG2KEYWORD.get(f.lower(), f): True for f in self['FLAGS']}
 
     def messageId(self):
         return asMessageIds(self.get_header('message-id'))
@@ -93,23 +320,42 @@ class ImapEmail(dict):
 
     def preview(self):
         try:
-            preview = self['PREVIEW'][1]
-            if isinstance(preview, str):
-                return unquoted(preview)
-            else:
-                return preview.decode()
+            preview = self['PREVIEW']
         except KeyError:
-            pass
+            preview = None
+        if isinstance(preview, list):
+            # draft-ietf-extra-imap-fetch-preview form (FUZZY "text")
+            preview = preview[-1]
+        preview = nstring(preview)
+        if preview is not None:
+            return preview
+        # PREVIEW (LAZY) returns NIL until server generates it
+        blobId = self['blobId'] if 'X-GUID' in self else None
+        preview = PREVIEW_CACHE.get(blobId)
+        if preview is None:
+            if not ('BODY[]' in self or 'BODYSTRUCTURE' in self or 'bodyValues' in self):
+                # don't fetch whole message only for preview
+                return ''
+            preview, complete = self._preview()
+            # preview of partially fetched text would stay cut short
+            if blobId is not None and preview and complete:
+                PREVIEW_CACHE[blobId] = preview
+        return preview
+
+    def _preview(self):
+        "Returns (preview, True when made from whole text part)"
         for part in self['bodyValues'].values():
             if part['type'] == 'text/plain':
-                return part['value'].strip()[:256]
+                return part['value'].strip()[:256], not part.get('isTruncated', False)
         for part in self['bodyValues'].values():
             if part['type'] == 'text/html':
-                return htmlpreview(part['value'], 256)
-        return None
+                return htmlpreview(part['value'], 256), not part.get('isTruncated', False)
+        return '', False
 
     def receivedAt(self):
-        return asDate(unquoted(self['INTERNALDATE']))
+        if self._internaldate is None:
+            return asDate(unquoted(self._data['INTERNALDATE']))
+        return datetime.fromtimestamp(self._internaldate, timezone(timedelta(minutes=self._tzoffset)))
 
     def references(self):
         return asMessageIds(self.get_header('references'))
@@ -134,11 +380,38 @@ class ImapEmail(dict):
             = bodystructure(self['blobId'], self['EML'])
 
     def bodyStructure(self):
-        self._bodystructure()
+        if 'BODYSTRUCTURE' in self:
+            self['bodyStructure'], self['BODYSECTIONS'] \
+                = imap_bodystructure(self['blobId'], self['BODYSTRUCTURE'])
+        else:
+            self._bodystructure()
         return self['bodyStructure']
 
+    def BODYSECTIONS(self):
+        self.bodyStructure()
+        return self['BODYSECTIONS']
+
     def bodyValues(self):
-        self._bodystructure()
+        if 'BODYSTRUCTURE' in self:
+            # only from sections already fetched
+            self['bodyValues'] = {}
+            for partId, part in self['BODYSECTIONS'].items():
+                data = self.get(f"BODY[{part['section']}]", None)
+                partial = data is None
+                if partial:
+                    # first bytes fetched for maxBodyValueBytes
+                    data = self.get(f"BODY[{part['section']}]<0>", None)
+                    if data is None:
+                        continue
+                value, problem = decode_body(nbytes(data), part['encoding'], part['charset'], partial)
+                self['bodyValues'][partId] = {
+                    'value': value,
+                    'type': part['type'],
+                    'isEncodingProblem': problem,
+                    'isTruncated': partial,
+                }
+        else:
+            self._bodystructure()
         return self['bodyValues']
 
     def _parseStructure(self):
@@ -181,8 +454,7 @@ class ImapEmail(dict):
 # Define address getters
 def address_getter(field):
     def get(self):
-        self[field] = asAddresses(self.get_header(field))
-        return self[field]
+        return asAddresses(self.get_header(field))
     return get
 
 # "from" is python reserved keyword, others are similar
@@ -190,32 +462,269 @@ for prop in ('from', 'to', 'cc', 'bcc', 'sender'):
     setattr(ImapEmail, prop, address_getter(prop))
 
 
+def nstring(atom):
+    "Returns str or None from parsed IMAP nstring atom"
+    if atom is None or atom == 'NIL':
+        return None
+    if isinstance(atom, (bytes, bytearray)):  # literal
+        return atom.decode(errors='replace')
+    return unquoted(atom)
+
+
+def nbytes(atom):
+    "Returns bytes from parsed IMAP nstring atom"
+    if isinstance(atom, (bytes, bytearray)):
+        return atom
+    return (nstring(atom) or '').encode()
+
+
+def nparams(atoms):
+    "Returns dict from parsed IMAP body parameter list"
+    if not isinstance(atoms, list):
+        return {}
+    return {nstring(atoms[i]).lower(): nstring(atoms[i+1])
+            for i in range(0, len(atoms) - 1, 2)}
+
+
+TEXT_TYPES = {'text/plain', 'text/html'}
+
+def imap_bodystructure(blobId, bs, section=''):
+    """Converts parsed IMAP BODYSTRUCTURE to JMAP bodyStructure
+    returns (bodyStructure, sections)
+    sections maps partId of text parts to dict with IMAP section,
+    type, encoding, charset and encoded size needed to fetch its value"""
+    sections = {}
+    if isinstance(bs[0], list):
+        subparts = []
+        i = 0
+        while isinstance(bs[i], list):
+            subsection = f"{section}.{i + 1}" if section else f"{i + 1}"
+            subpart, subsections = imap_bodystructure(blobId, bs[i], subsection)
+            subparts.append(subpart)
+            sections.update(subsections)
+            i += 1
+        return {
+            'partId': None,
+            'blobId': None,
+            'type': f"multipart/{nstring(bs[i]).lower()}",
+            'size': 0,
+            'headers': [],
+            'name': None,
+            'cid': None,
+            'disposition': None,
+            'subParts': subparts,
+        }, sections
+
+    section = section or '1'
+    partId = section.replace('.', '-')
+    typ = f"{nstring(bs[0])}/{nstring(bs[1])}".lower()
+    params = nparams(bs[2])
+    encoding = (nstring(bs[5]) or '7BIT').upper()
+    size = int(bs[6])
+    if typ.startswith('text/'):
+        ext = bs[8:]
+    elif typ == 'message/rfc822':
+        ext = bs[10:]
+    else:
+        ext = bs[7:]
+    disposition, dparams = None, {}
+    if len(ext) > 1 and isinstance(ext[1], list):
+        disposition = nstring(ext[1][0]).lower()
+        dparams = nparams(ext[1][1])
+    language = None
+    if len(ext) > 2:
+        if isinstance(ext[2], list):
+            language = [nstring(lang) for lang in ext[2]]
+        else:
+            language = asCommaList(nstring(ext[2]))
+    location = nstring(ext[3]) if len(ext) > 3 else None
+
+    charset = params.get('charset', None)
+    if charset is None and typ.startswith('text/'):
+        charset = 'us-ascii'
+    if typ in TEXT_TYPES:
+        sections[partId] = {
+            'section': section,
+            'type': typ,
+            'encoding': encoding,
+            'charset': charset,
+            'size': size,
+        }
+    if encoding == 'BASE64':
+        # 57 decoded bytes in each 76 chars line + CRLF
+        size = size * 57 // 78
+    return {
+        'partId': partId,
+        'blobId': f"{blobId}-{partId}",
+        'type': typ,
+        'charset': charset,
+        'size': size,
+        'headers': [
+            {'name': 'Content-Type', 'value': typ + ''.join(f'; {k}="{v}"' for k, v in params.items())},
+            {'name': 'Content-Transfer-Encoding', 'value': encoding.lower()},
+        ],
+        'name': asFilename(dparams) or asFilename(params),
+        'cid': asOneURL(nstring(bs[3])),
+        'language': language,
+        'location': location,
+        'disposition': disposition or 'none',
+    }, sections
+
+
+class ParsedBody:
+    "BODY[] parsed by MessageSink, len() is size of raw message"
+    __slots__ = ('message', 'headers', 'size')
+
+    def __init__(self, message, headers, size):
+        self.message = message
+        self.headers = headers
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class MessageSink:
+    """Literal sink for aioimaplib, feeds chunks of BODY[] literal
+    to BytesFeedParser as they arrive, so parsing overlaps with network.
+    Raw message is not kept, only header bytes and parsed message."""
+    __slots__ = ('parser', 'head', 'headers', 'size')
+
+    def __init__(self, size):
+        self.parser = BytesFeedParser(policy=default)
+        self.head = bytearray()
+        self.headers = None
+        self.size = size
+
+    def feed(self, chunk):
+        if self.headers is None:
+            # empty line may be split between chunks
+            start = max(0, len(self.head) - 3)
+            self.head += chunk
+            end = header_end_re.search(self.head, start)
+            if end:
+                self.headers = bytes(self.head[:end.end()])
+                self.head = None
+        self.parser.feed(bytes(chunk))
+
+    def close(self):
+        if self.headers is None:
+            self.headers = bytes(self.head)
+            self.head = None
+        return ParsedBody(self.parser.close(), self.headers, self.size)
+
+
+class StreamSink:
+    """Literal sink for aioimaplib, queues chunks of the first literal
+    for async iteration while the command is still running. Reading from
+    transport is paused while more than limit bytes wait for consumer."""
+
+    def __init__(self, transport, limit=1 << 20):
+        self.transport = transport
+        self.limit = limit
+        self.chunks = deque()
+        self.queued = 0
+        self.paused = False
+        self.closed = False
+        self.discard = False
+        self.waiter = None
+        self.size = None
+
+    def __call__(self, line, size):
+        "literal_sink factory, other literals are kept in response"
+        if self.size is not None:
+            return None
+        self.size = size
+        self.wakeup()
+        return self
+
+    def feed(self, chunk):
+        if self.discard or not chunk:
+            return
+        self.chunks.append(bytes(chunk))
+        self.queued += len(chunk)
+        if self.queued > self.limit and not self.paused:
+            self.paused = True
+            self.transport.pause_reading()
+        self.wakeup()
+
+    def close(self):
+        self.closed = True
+        self.wakeup()
+        return b''
+
+    def wakeup(self, *args):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def resume(self):
+        if self.paused:
+            self.paused = False
+            self.transport.resume_reading()
+
+    async def started(self, command):
+        "Returns True when literal begins to arrive, False when command ended without it"
+        command.add_done_callback(self.wakeup)
+        while self.size is None and not command.done():
+            self.waiter = asyncio.get_running_loop().create_future()
+            await self.waiter
+        return self.size is not None
+
+    async def iterate(self, command):
+        """Yields chunks until literal or command future ends,
+        rest of literal is dropped when iteration stops early"""
+        command.add_done_callback(self.wakeup)
+        try:
+            while True:
+                if self.chunks:
+                    chunk = self.chunks.popleft()
+                    self.queued -= len(chunk)
+                    if self.queued <= self.limit // 2:
+                        self.resume()
+                    yield chunk
+                elif self.closed or command.done():
+                    return
+                else:
+                    self.waiter = asyncio.get_running_loop().create_future()
+                    await self.waiter
+        finally:
+            self.discard = True
+            self.chunks.clear()
+            self.resume()
+
+
 class EmailState:
-    __slots__ = ('uidvalidity', 'uid', 'modseq')
+    """uidvalidity,uid,modseq of virtual/All. Intermediate state of
+    Email/changes paging changes of modseq + 1 has uid cursor as modseq:cursor"""
+    __slots__ = ('uidvalidity', 'uid', 'modseq', 'cursor')
 
     @classmethod
     def from_string(cls, state):
         uidvalidity, uid, modseq = state.split(',')
-        return cls(int(uidvalidity), int(uid), int(modseq))
+        modseq, _, cursor = modseq.partition(':')
+        return cls(int(uidvalidity), int(uid), int(modseq), int(cursor or 0))
 
-    def __init__(self, uidvalidity, uid, modseq):
+    def __init__(self, uidvalidity, uid, modseq, cursor=0):
         self.uidvalidity = uidvalidity
         self.uid = uid
         self.modseq = modseq
+        self.cursor = cursor
 
     def __gt__(self, other):
         if isinstance(other, str):
             other = EmailState.from_string(other)
-        return (self.uidvalidity, self.uid, self.modseq) > \
-               (other.uidvalidity, other.uid, other.modseq)
+        return (self.uidvalidity, self.uid, self.modseq, self.cursor) > \
+               (other.uidvalidity, other.uid, other.modseq, other.cursor)
 
     def __le__(self, other):
         if isinstance(other, str):
             other = EmailState.from_string(other)
-        return (self.uidvalidity, self.uid, self.modseq) <= \
-               (other.uidvalidity, other.uid, other.modseq)
+        return (self.uidvalidity, self.uid, self.modseq, self.cursor) <= \
+               (other.uidvalidity, other.uid, other.modseq, other.cursor)
 
     def __str__(self):
+        if self.cursor:
+            return f"{self.uidvalidity},{self.uid},{self.modseq}:{self.cursor}"
         return f"{self.uidvalidity},{self.uid},{self.modseq}"
 
 
@@ -0,0 +1,189 @@
+import asyncio
+import email
+from email.policy import default
+from html import escape
+import os
+import re
+import sqlite3
+
+from jmap.parse import htmltotext
+from .aioimaplib import parse_status, parse_fetch, iter_messageset
+from .email import nbytes
+
+
+# JMAP text filter -> FTS5 columns
+TEXT_COLUMNS = {
+    'text':     ('subject', 'mfrom', 'mto', 'mcc', 'mbcc', 'body'),
+    'subject':  ('subject',),
+    'body':     ('body',),
+    'from':     ('mfrom',),
+    'to':       ('mto',),
+    'cc':       ('mcc',),
+    'bcc':      ('mbcc',),
+}
+# columns highlighted in SearchSnippet
+SUBJECT_COLUMN = 0
+BODY_COLUMN = 5
+# marks replaced by <mark> after escaping HTML
+MARK_START = '\x02'
+MARK_END = '\x03'
+word_re = re.compile(r'\w+')
+
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS emails USING fts5(
+    subject, mfrom, mto, mcc, mbcc, body,
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TABLE IF NOT EXISTS sync (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    uidvalidity INTEGER, uidnext INTEGER, modseq INTEGER
+);
+"""
+
+
+class TextIndex:
+    """SQLite FTS5 index of headers and text parts of emails in virtual/All,
+    rowid is UID. Answers text filters and highlights SearchSnippets.
+    Updated incrementally with CONDSTORE, sqlite runs in executor threads."""
+    fetch_batch_size = 500
+    # bytes of message fetched for indexing
+    body_max_size = 100000
+
+    def __init__(self, path=':memory:'):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = asyncio.Lock()
+        self.sync_lock = asyncio.Lock()
+        row = self.db.execute('SELECT uidvalidity, uidnext, modseq FROM sync').fetchone()
+        self.uidvalidity, self.uidnext, self.modseq = row or (0, 1, 0)
+
+    async def run(self, func, *args):
+        "Runs sqlite work in thread, one at a time"
+        async with self.lock:
+            return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def sync(self, account):
+        "Indexes new and removes expunged emails of account since last sync"
+        async with self.sync_lock:
+            await self._sync(account)
+
+    async def _sync(self, account):
+        imap = account.imap
+        ok, lines = await imap.status(account.imapname_all, '(UIDNEXT HIGHESTMODSEQ)')
+        status = parse_status(lines)
+        modseq = int(status['HIGHESTMODSEQ'])
+        uidnext = int(status['UIDNEXT'])
+        if account.uidvalidity != self.uidvalidity:
+            await self.run(self._reset, account.uidvalidity)
+        if modseq == self.modseq:
+            return
+        if self.modseq:
+            # text of email doesn't change, only expunges matter
+            ok, lines = await imap.uid_fetch('1:*', '(UID)', '(CHANGEDSINCE %d VANISHED)' % self.modseq)
+            if lines and lines[0].startswith('(EARLIER) '):
+                await self.run(self._remove, list(iter_messageset(lines[0][10:])))
+        for start in range(self.uidnext, uidnext, self.fetch_batch_size):
+            stop = min(start + self.fetch_batch_size, uidnext) - 1
+            ok, lines = await imap.uid_fetch(f'{start}:{stop}', '(UID BODY.PEEK[]<0.%d>)' % self.body_max_size)
+            messages = [(int(data['UID']), nbytes(data.get('BODY[]<0>', None)))
+                        for seq, data in parse_fetch(lines[:-1]) if 'UID' in data]
+            await self.run(self._add, messages, stop + 1)
+        await self.run(self._save, max(self.uidnext, uidnext), modseq)
+
+    def _reset(self, uidvalidity):
+        self.db.execute('DELETE FROM emails')
+        self.uidvalidity, self.uidnext, self.modseq = uidvalidity, 1, 0
+        self._save(1, 0)
+
+    def _save(self, uidnext, modseq):
+        self.uidnext, self.modseq = uidnext, modseq
+        self.db.execute('INSERT OR REPLACE INTO sync VALUES (1, ?, ?, ?)',
+                        (self.uidvalidity, uidnext, modseq))
+        self.db.commit()
+
+    def _remove(self, uids):
+        self.db.executemany('DELETE FROM emails WHERE rowid = ?', ((uid,) for uid in uids))
+        self.db.commit()
+
+    def _add(self, messages, uidnext):
+        rows = [(uid, *extract_text(raw)) for uid, raw in messages if raw]
+        self.db.executemany('INSERT OR REPLACE INTO emails (rowid, subject, mfrom, mto, mcc, mbcc, body) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        self.uidnext = uidnext
+        self.db.execute('UPDATE sync SET uidnext = ?', (uidnext,))
+        self.db.commit()
+
+    async def search(self, criteria):
+        """Returns set of uids matching all text criteria {filter: text},
+        None when index can't answer them"""
+        query = match_query(criteria)
+        if query is None:
+            return None
+        rows = await self.run(self._execute, 'SELECT rowid FROM emails WHERE emails MATCH ?', (query,))
+        return {uid for uid, in rows}
+
+    async def snippets(self, criteria, uids):
+        "Returns {uid: (subject, preview)} highlighted with <mark> for uids matching any word"
+        query = match_query(criteria, ' OR ')
+        if query is None or not uids:
+            return {}
+        rows = await self.run(self._execute, f"""
+            SELECT rowid, highlight(emails, {SUBJECT_COLUMN}, ?, ?), snippet(emails, {BODY_COLUMN}, ?, ?, '…', 32)
+            FROM emails WHERE emails MATCH ? AND rowid IN ({','.join('?' * len(uids))})
+            """, (MARK_START, MARK_END, MARK_START, MARK_END, query, *uids))
+        return {uid: (highlighted(subject), highlighted(preview)) for uid, subject, preview in rows}
+
+    def _execute(self, sql, params):
+        return self.db.execute(sql, params).fetchall()
+
+
+def match_query(criteria, operator=' AND '):
+    "Formats {filter: text} as FTS5 MATCH query of words in filter columns"
+    terms = []
+    for crit, text in criteria.items():
+        columns = TEXT_COLUMNS.get(crit, None)
+        if columns is None or not isinstance(text, str):
+            return None
+        for word in word_re.findall(text):
+            terms.append('{%s} : "%s"' % (' '.join(columns), word.replace('"', '""')))
+    return operator.join(terms) or None
+
+
+def highlighted(text):
+    "Escapes HTML of text with marks from FTS5, returns None if nothing matched"
+    if not text or MARK_START not in text:
+        return None
+    return escape(text).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+def extract_text(raw):
+    "Returns (subject, from, to, cc, bcc, body) of (maybe truncated) message"
+    try:
+        msg = email.message_from_bytes(raw, policy=default)
+        headers = [str(msg.get(name, '') or '') for name in ('subject', 'from', 'to', 'cc', 'bcc')]
+    except Exception:
+        return '', '', '', '', '', ''
+    texts = []
+    html = []
+    for part in msg.walk():
+        typ = part.get_content_type()
+        if typ not in ('text/plain', 'text/html') or part.is_attachment():
+            continue
+        try:
+            content = part.get_content()
+        except Exception:
+            # truncated or broken encoding
+            continue
+        if typ == 'text/plain':
+            texts.append(content)
+        else:
+            html.append(content)
+    if not texts:
+        for content in html:
+            try:
+                texts.append(htmltotext(content))
+            except Exception:
+                continue
+    return (*headers, '\n'.join(texts))
@@ -0,0 +1,310 @@
+import asyncio
+from array import array
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from jmap.parse import asAddresses
+from .aioimaplib import parse_status, parse_fetch, iter_messageset, unquoted
+from .email import ImapEmail, nbytes
+
+
+# numeric columns with array typecodes
+COLUMNS = {
+    'uid':        'I',
+    'receivedAt': 'q',
+    'sentAt':     'q',
+    'size':       'Q',
+    'flags':      'Q',  # bitmask, bit of each flag in EmailIndex.flagbits
+    'mailbox':    'I',  # ordinal in EmailIndex.mailbox_ords
+    'thread':     'I',  # ordinal in EmailIndex.thread_ords
+}
+# string columns compared as casefolded names or emails
+STRING_COLUMNS = ('from', 'to')
+SORT_COLUMNS = {'receivedAt', 'sentAt', 'size', *STRING_COLUMNS}
+INDEX_HEADERS = ('date', 'from', 'to')
+FETCH_FIELDS = "(UID FLAGS INTERNALDATE RFC822.SIZE X-MAILBOX X-GUID BODY.PEEK[HEADER.FIELDS (%s)])" \
+               % ' '.join(INDEX_HEADERS).upper()
+MAX_FLAGS = 64
+
+
+class Unsupported(Exception):
+    "Query can't be evaluated by index, IMAP SEARCH is used instead"
+
+
+class EmailIndex:
+    """Columnar metadata of all emails in virtual/All kept current with CONDSTORE,
+    evaluates Email/query filters and sorts without IMAP SEARCH.
+    Columns are arrays, with NumPy installed they are filtered and sorted as vectors."""
+    fetch_batch_size = 5000
+
+    def __init__(self):
+        self.columns = {name: array(typecode) for name, typecode in COLUMNS.items()}
+        self.strings = {name: [] for name in STRING_COLUMNS}
+        self.rows = {}  # uid -> row
+        self.flagbits = {}
+        self.mailbox_ords = {}
+        self.thread_ords = {}
+        self.modseq = 0
+        self.uidnext = 1
+        self.lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    async def sync(self, account):
+        "Fetches changes since last sync from virtual/All of account"
+        async with self.lock:
+            await self._sync(account)
+
+    async def _sync(self, account):
+        imap = account.imap
+        ok, lines = await imap.status(account.imapname_all, '(UIDNEXT HIGHESTMODSEQ)')
+        status = parse_status(lines)
+        modseq = int(status['HIGHESTMODSEQ'])
+        uidnext = int(status['UIDNEXT'])
+        if modseq == self.modseq:
+            return
+        if self.modseq:
+            ok, lines = await imap.uid_fetch('1:*', '(UID FLAGS)', '(CHANGEDSINCE %d VANISHED)' % self.modseq)
+            if lines and lines[0].startswith('(EARLIER) '):
+                for uid in iter_messageset(lines[0][10:]):
+                    self.remove(uid)
+                lines = lines[1:]
+            for seq, data in parse_fetch(lines[:-1]):
+                row = self.rows.get(int(data['UID']), None)
+                if row is not None:
+                    self.columns['flags'][row] = self.flags_mask(data['FLAGS'])
+        # new messages in batches of uids
+        for start in range(self.uidnext, uidnext, self.fetch_batch_size):
+            stop = min(start + self.fetch_batch_size, uidnext) - 1
+            ok, lines = await imap.uid_fetch(f'{start}:{stop}', FETCH_FIELDS)
+            for seq, data in parse_fetch(lines[:-1]):
+                if 'X-GUID' in data:
+                    self.add(data)
+        self.modseq = modseq
+        self.uidnext = max(self.uidnext, uidnext)
+
+    def add(self, data):
+        "Adds row from parsed FETCH of FETCH_FIELDS"
+        uid = int(data['UID'])
+        if uid in self.rows:
+            return
+        msg = ImapEmail(data)
+        for key in [key for key in msg if key.startswith('BODY[HEADER')]:
+            msg.add_header_fields(INDEX_HEADERS, nbytes(msg.pop(key)))
+        sentAt = msg['sentAt']
+        row = {
+            'uid': uid,
+            'receivedAt': int(msg['receivedAt'].timestamp()),
+            'sentAt': int(sentAt.timestamp()) if sentAt else 0,
+            'size': msg['size'],
+            'flags': self.flags_mask(msg['FLAGS']),
+            'mailbox': self.mailbox_ords.setdefault(unquoted(msg['X-MAILBOX']), len(self.mailbox_ords)),
+            'thread': self.thread_ords.setdefault(msg['threadId'], len(self.thread_ords)),
+        }
+        self.rows[uid] = len(self.columns['uid'])
+        for name, value in row.items():
+            self.columns[name].append(value)
+        for name in STRING_COLUMNS:
+            self.strings[name].append(address_key(msg.get_header(name)))
+
+    def remove(self, uid):
+        "Removes row by moving last row in its place"
+        row = self.rows.pop(uid, None)
+        if row is None:
+            return
+        last = len(self.columns['uid']) - 1
+        for col in (*self.columns.values(), *self.strings.values()):
+            col[row] = col[last]
+            col.pop()
+        if row != last:
+            self.rows[self.columns['uid'][row]] = row
+
+    def flags_mask(self, flags):
+        mask = 0
+        for flag in flags:
+            bit = self.flagbits.get(flag.lower(), None)
+            if bit is None:
+                if len(self.flagbits) >= MAX_FLAGS:
+                    continue
+                bit = self.flagbits[flag.lower()] = 1 << len(self.flagbits)
+            mask |= bit
+        return mask
+
+    def query(self, filter, sort, mailboxes, collapseThreads=False):
+        """Returns list of uids matching JMAP filter in sort order,
+        None when some criterion needs IMAP SEARCH"""
+        try:
+            mask = self.mask(filter, mailboxes) if filter else None
+            for crit in sort:
+                if crit.get('property') not in SORT_COLUMNS:
+                    raise Unsupported(crit.get('property'))
+        except Unsupported:
+            return None
+        if not self.rows:
+            return []
+        if np is not None:
+            return self._query_numpy(mask, sort, collapseThreads)
+
+        rows = list(range(len(self.rows))) if mask is None else [i for i, m in enumerate(mask) if m]
+        # stable sorts from last criterion, uid is last
+        rows.sort(key=self.columns['uid'].__getitem__)
+        for crit in reversed(sort):
+            col = self.strings.get(crit['property'], None) or self.columns[crit['property']]
+            rows.sort(key=col.__getitem__, reverse=not crit.get('isAscending', True))
+        if collapseThreads:
+            rows = first_in_thread(rows, self.columns['thread'].__getitem__)
+        uids = self.columns['uid']
+        return [uids[i] for i in rows]
+
+    def _query_numpy(self, mask, sort, collapseThreads):
+        rows = np.arange(len(self.rows)) if mask is None else np.flatnonzero(mask)
+        # lexsort uses last key as primary
+        keys = [self.vector('uid')[rows]]
+        for crit in reversed(sort):
+            name = crit['property']
+            if name in self.strings:
+                key = np.unique(np.array(self.strings[name], dtype=object)[rows], return_inverse=True)[1]
+            else:
+                key = self.vector(name)[rows].astype(np.int64)
+            keys.append(key if crit.get('isAscending', True) else -key)
+        rows = rows[np.lexsort(keys)]
+        if collapseThreads:
+            threads = self.vector('thread')[rows]
+            rows = rows[np.sort(np.unique(threads, return_index=True)[1])]
+        return self.vector('uid')[rows].tolist()
+
+    def vector(self, name):
+        col = self.columns[name]
+        return np.frombuffer(col, dtype=col.typecode) if np is not None else col
+
+    def apply(self, name, func):
+        "Returns mask of func applied on every value of column"
+        if np is not None:
+            return func(self.vector(name))
+        return [func(value) for value in self.columns[name]]
+
+    def mask(self, criteria, mailboxes):
+        "Returns mask of rows matching JMAP FilterOperator or FilterCondition"
+        if 'operator' in criteria:
+            operator = criteria['operator']
+            masks = [self.mask(cond, mailboxes) for cond in criteria['conditions']]
+            if not masks:
+                raise Unsupported('Empty filter conditions')
+            if operator == 'AND':
+                return mask_all(masks)
+            elif operator == 'OR':
+                return mask_any(masks)
+            elif operator == 'NOT':
+                return mask_not(mask_any(masks))
+            raise Unsupported(operator)
+
+        masks = []
+        for crit, value in criteria.items():
+            if crit == 'uids':
+                # found by TextIndex
+                if np is not None:
+                    uids = np.fromiter(value, dtype=np.int64, count=len(value))
+                    masks.append(np.isin(self.vector('uid'), uids))
+                else:
+                    masks.append(self.apply('uid', value.__contains__))
+            elif crit == 'inMailbox':
+                ordinal = self.mailbox_ordinal(value, mailboxes)
+                masks.append(self.apply('mailbox', lambda col: col == ordinal))
+            elif crit == 'inMailboxOtherThan':
+                for id in value:
+                    ordinal = self.mailbox_ordinal(id, mailboxes)
+                    masks.append(self.apply('mailbox', lambda col, ordinal=ordinal: col != ordinal))
+            elif crit == 'before':
+                timestamp = utc_timestamp(value)
+                masks.append(self.apply('receivedAt', lambda col: col < timestamp))
+            elif crit == 'after':
+                timestamp = utc_timestamp(value)
+                masks.append(self.apply('receivedAt', lambda col: col >= timestamp))
+            elif crit == 'minSize':
+                masks.append(self.apply('size', lambda col: col >= value))
+            elif crit == 'maxSize':
+                masks.append(self.apply('size', lambda col: col < value))
+            elif crit in ('hasKeyword', 'notKeyword', 'hasAttachment', 'deleted'):
+                if crit in ('hasKeyword', 'notKeyword'):
+                    flag = keyword_flag(value)
+                    present = crit == 'hasKeyword'
+                else:
+                    flag = '$hasattachment' if crit == 'hasAttachment' else '\\deleted'
+                    present = bool(value)
+                bit = self.flagbits.get(flag, None)
+                if bit is None:
+                    if len(self.flagbits) >= MAX_FLAGS:
+                        raise Unsupported(crit)
+                    # no message has it
+                    bit = 0
+                masks.append(self.apply('flags', lambda col: (col & bit) != 0 if present else (col & bit) == 0))
+            else:
+                raise Unsupported(crit)
+        if not masks:
+            return self.apply('uid', lambda col: col == col)
+        return mask_all(masks)
+
+    def mailbox_ordinal(self, id, mailboxes):
+        try:
+            imapname = mailboxes[id]['imapname']
+        except KeyError:
+            raise Unsupported(f"Mailbox {id} not found")
+        # ordinal of mailbox without messages matches none
+        return self.mailbox_ords.get(imapname, len(self.mailbox_ords))
+
+
+def mask_all(masks):
+    result = masks[0]
+    for mask in masks[1:]:
+        result = result & mask if np is not None else [a and b for a, b in zip(result, mask)]
+    return result
+
+
+def mask_any(masks):
+    result = masks[0]
+    for mask in masks[1:]:
+        result = result | mask if np is not None else [a or b for a, b in zip(result, mask)]
+    return result
+
+
+def mask_not(mask):
+    return ~mask if np is not None else [not a for a in mask]
+
+
+def first_in_thread(rows, thread_of):
+    seen = set()
+    out = []
+    for row in rows:
+        thread = thread_of(row)
+        if thread not in seen:
+            seen.add(thread)
+            out.append(row)
+    return out
+
+
+def keyword_flag(keyword):
+    keyword = keyword.lower()
+    return f"\\{keyword[1:]}" if keyword in ('$seen', '$flagged', '$answered', '$draft') else keyword
+
+
+def address_key(raw):
+    "Sort key of first address, its name or email when name is missing"
+    try:
+        addresses = asAddresses(raw)
+    except Exception:
+        return ''
+    if not addresses:
+        return ''
+    return (addresses[0]['name'] or addresses[0]['email'] or '').casefold()
+
+
+def utc_timestamp(value):
+    try:
+        return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp())
+    except (AttributeError, ValueError):
+        raise Unsupported(f"Invalid date {value}")
@@ -0,0 +1,74 @@
+import asyncio
+from collections import deque
+
+
+class ImapPool:
+    """Logged in IMAP connections of account with its mailbox selected.
+    Connections are opened by connect() when all are busy, at most size,
+    then callers wait for released one in order of acquire"""
+
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = size
+        # opened and being opened connections
+        self.count = 0
+        self.connections = []
+        self.idle = []
+        self.waiters = deque()
+
+    def add(self, imap):
+        "Adds already opened connection as idle"
+        self.count += 1
+        self.connections.append(imap)
+        self.release(imap)
+
+    async def acquire(self):
+        while True:
+            while self.idle:
+                imap = self.idle.pop()
+                if is_open(imap):
+                    return imap
+                self._remove(imap)
+            if self.count < self.size:
+                self.count += 1
+                try:
+                    imap = await self.connect()
+                except BaseException:
+                    self.count -= 1
+                    raise
+                self.connections.append(imap)
+                return imap
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                imap = await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled() and waiter.result() is not None:
+                    # connection was handed over meanwhile
+                    self.release(waiter.result())
+                raise
+            if imap is not None:
+                return imap
+            # released connection was closed, its place is free
+
+    def release(self, imap):
+        if not is_open(imap):
+            self._remove(imap)
+            imap = None
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(imap)
+                return
+        if imap is not None:
+            self.idle.append(imap)
+
+    def _remove(self, imap):
+        if imap in self.connections:
+            self.connections.remove(imap)
+            self.count -= 1
+
+
+def is_open(imap):
+    transport = getattr(imap.protocol, 'transport', None)
+    return transport is not None and not transport.is_closing()
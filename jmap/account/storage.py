@@ -1,26 +1,123 @@
+import hashlib
+import os
 import random
+import re
 
 from aiofiles import open
 from aiohttp.client import ClientSession
 
 from jmap import errors
 
+
+class BlobStream:
+    """Blob content of known size as async iterator over chunks,
+    it can be only a range of total bytes starting at start"""
+    __slots__ = 'size', 'chunks', 'total', 'start'
+
+    def __init__(self, size, chunks, total=None, start=0):
+        self.size = size
+        self.chunks = chunks
+        self.total = size if total is None else total
+        self.start = start
+
+    @classmethod
+    def from_bytes(cls, body, total=None, start=0):
+        async def chunks():
+            if body:
+                yield body
+        return cls(len(body), chunks(), total, start)
+
+    def __len__(self):
+        return self.size
+
+    def __aiter__(self):
+        return self.chunks.__aiter__()
+
+    async def read(self):
+        body = bytearray()
+        async for chunk in self:
+            body += chunk
+        return body
+
+    async def aclose(self):
+        "Releases source when stream was not read to the end"
+        aclose = getattr(self.chunks, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+
+def byte_range(start, stop, total):
+    """Returns (start, stop) of bytes range within total size
+    negative start counts from the end, stop None is the end"""
+    if start < 0:
+        start = max(total + start, 0)
+    stop = total if stop is None else min(stop, total)
+    start = min(start, total)
+    return start, max(start, stop)
+
+
+async def slice_chunks(chunks, start, stop):
+    "Yields only bytes from start to stop of chunks"
+    offset = 0
+    try:
+        async for chunk in chunks:
+            end = offset + len(chunk)
+            if end > start and offset < stop:
+                yield chunk[max(start - offset, 0):stop - offset]
+            offset = end
+            if offset >= stop:
+                break
+    finally:
+        aclose = getattr(chunks, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+
+async def copy_blob_stream(account, fromAccount, blobId):
+    "Copies blob between accounts on server side, returns new blobId"
+    stream = await fromAccount.download_stream(blobId)
+    try:
+        return (await account.upload(stream, None))['blobId']
+    finally:
+        await stream.aclose()
+
+
 class FileBlobMixin:
     """Provides methods upload and download.
-    Stores files in local filesystem directory"""
+    Stores files in local filesystem directory
+    under SHA-256 of their content"""
 
-    chunk_size = 4096
+    chunk_size = 65536
 
     def __init__(self, dir=None):
         self.dir = dir or './data/'
 
+    def blob_path(self, blobId):
+        if not file_blob_id_re.match(blobId):
+            raise errors.notFound(f'Blob {blobId} not found')
+        return os.path.join(self.dir, blobId)
+
     async def upload(self, stream, type):
-        blobId = random.randbytes(16).hex()
+        # spool to temporary file, content hash is known at the end
+        os.makedirs(self.dir, exist_ok=True)
+        spool = os.path.join(self.dir, f'.upload-{random.randbytes(8).hex()}')
+        sha = hashlib.sha256()
         size = 0
-        async with open(f'data/{blobId}', 'w') as f:
-            async for chunk in stream:
-                await f.write(chunk)
-                size += len(chunk)
+        try:
+            async with open(spool, 'wb') as f:
+                async for chunk in stream:
+                    sha.update(chunk)
+                    size += len(chunk)
+                    await f.write(chunk)
+            blobId = sha.hexdigest()
+            # same content has the same blobId
+            os.replace(spool, self.blob_path(blobId))
+        except BaseException:
+            try:
+                os.unlink(spool)
+            except FileNotFoundError:
+                pass
+            raise
 
         return {
             'accountId': self.id,
@@ -29,17 +126,55 @@ class FileBlobMixin:
             'size': size,
         }
 
+    async def blob_copy(self, fromAccount, blobId):
+        "Links content-addressed file, data is not copied on the same filesystem"
+        if not isinstance(fromAccount, FileBlobMixin):
+            return await copy_blob_stream(self, fromAccount, blobId)
+        src = fromAccount.blob_path(blobId)
+        dst = self.blob_path(blobId)
+        if not os.path.exists(src):
+            raise errors.notFound(f'Blob {blobId} not found')
+        if os.path.exists(dst):
+            return blobId
+        os.makedirs(self.dir, exist_ok=True)
+        try:
+            # hard link count is the reference count
+            os.link(src, dst)
+        except FileExistsError:
+            pass
+        except OSError:
+            return await copy_blob_stream(self, fromAccount, blobId)
+        return blobId
+
     async def download(self, blobId):
         try:
-            async with open(f'data/{blobId}', 'r') as file:
-                body = bytearray()
-                chunk = range(self.chunk_size)
-                while len(chunk) == self.chunk_size:
-                    chunk = await file.read(self.chunk_size)
-                    body += chunk
-                return body
+            async with open(self.blob_path(blobId), 'rb') as file:
+                return await file.read()
+        except FileNotFoundError:
+            raise errors.notFound()
+
+    async def download_stream(self, blobId, start=0, stop=None):
+        path = self.blob_path(blobId)
+        try:
+            total = os.stat(path).st_size
         except FileNotFoundError:
             raise errors.notFound()
+        start, stop = byte_range(start, stop, total)
+
+        async def chunks():
+            async with open(path, 'rb') as file:
+                await file.seek(start)
+                remaining = stop - start
+                while remaining > 0:
+                    chunk = await file.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+        return BlobStream(stop - start, chunks(), total, start)
+
+
+file_blob_id_re = re.compile(r'^[0-9a-f]+$')
 
 
 class ProxyBlobMixin:
@@ -47,6 +182,7 @@ class ProxyBlobMixin:
     Proxies request to other HTTP service"""
 
     http = ClientSession()
+    chunk_size = 65536
 
     def __init__(self, base, http_session=None):
         self.base = base
@@ -54,10 +190,14 @@ class ProxyBlobMixin:
             self.http = http_session or ClientSession()
 
     async def upload(self, stream, content_type=None):
+        """Streams chunks to storage service as they arrive, it names the blob,
+        so the upload isn't spooled or hashed here like in FileBlobMixin"""
         headers = {}
         if content_type is not None:
             headers['content-type'] = content_type
         async with self.http.post(f"{self.base}{self.id}", data=stream, headers=headers) as r:
+            if r.status // 100 != 2:
+                raise errors.serverFail(f'Storage responded {r.status}')
             return await r.json()
 
     async def download(self, blobId):
@@ -67,3 +207,61 @@ class ProxyBlobMixin:
             elif res.status // 100 == 5:
                 raise errors.serverFail()
         raise errors.notFound(f'Blob {blobId} not found')
+
+    async def blob_copy(self, fromAccount, blobId):
+        return await copy_blob_stream(self, fromAccount, blobId)
+
+    async def download_stream(self, blobId, start=0, stop=None):
+        headers = {}
+        if start < 0:
+            headers['range'] = f'bytes={start}'
+        elif start or stop is not None:
+            headers['range'] = f"bytes={start}-{'' if stop is None else stop - 1}"
+        res = await self.http.get(f"{self.base}{self.id}/{blobId}", headers=headers)
+        if res.status == 416:
+            res.release()
+            total = int(res.headers.get('content-range', '/0').rpartition('/')[2])
+            return BlobStream.from_bytes(b'', total, total)
+        if res.status not in (200, 206):
+            res.release()
+            if res.status // 100 == 5:
+                raise errors.serverFail()
+            raise errors.notFound(f'Blob {blobId} not found')
+
+        if res.status == 206:
+            # bytes start-end/total
+            match = content_range_re.match(res.headers.get('content-range', ''))
+            if match and res.content_length is not None:
+                async def chunks():
+                    try:
+                        async for chunk in res.content.iter_chunked(self.chunk_size):
+                            yield chunk
+                    finally:
+                        res.release()
+                return BlobStream(res.content_length, chunks(), int(match[3]), int(match[1]))
+            # unknown range, take whole blob
+            res.release()
+            res = await self.http.get(f"{self.base}{self.id}/{blobId}")
+
+        if res.content_length is None:
+            try:
+                body = await res.read()
+            finally:
+                res.release()
+            start, stop = byte_range(start, stop, len(body))
+            return BlobStream.from_bytes(body[start:stop], len(body), start)
+
+        async def whole():
+            try:
+                async for chunk in res.content.iter_chunked(self.chunk_size):
+                    yield chunk
+            finally:
+                res.release()
+        total = res.content_length
+        start, stop = byte_range(start, stop, total)
+        if (start, stop) == (0, total):
+            return BlobStream(total, whole())
+        return BlobStream(stop - start, slice_chunks(whole(), start, stop), total, start)
+
+
+content_range_re = re.compile(r'^bytes ([0-9]+)-([0-9]+)/([0-9]+)$')
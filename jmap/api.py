@@ -1,15 +1,19 @@
+import asyncio
+from contextlib import nullcontext
 from inspect import isawaitable
 import logging as log
+import os
 from time import monotonic
 import re
 
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
 
 import jmap.core as core
 import jmap.mail as mail
 import jmap.submission as submission
 import jmap.vacationresponse as vacationresponse
-from jmap import errors
+from jmap import errors, metrics, plan
+from jmap.fragment import Fragment, dumps
 
 try:
     import orjson as json
@@ -23,6 +27,9 @@ CAPABILITIES = {
     'urn:ietf:params:jmap:vacationresponse': vacationresponse,
 }
 
+# write each method response as soon as it and all before it are done
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '0') == '1'
+
 METHODS = {}
 for module in CAPABILITIES.values():
     module.register_methods(METHODS)
@@ -31,81 +38,174 @@ for module in CAPABILITIES.values():
 class JSONResponse(Response):
     media_type = "application/json"
     def render(self, content) -> bytes:
-        return json.dumps(content)
+        return dumps(content)
 
 
 async def api(request):
-    results = []
-    results_bytag = {}
+    max_size = core.capability['maxSizeRequest']
+    try:
+        too_large = int(request.headers.get('content-length', 0)) > max_size
+    except ValueError:
+        too_large = False
+    if too_large:
+        return limit_response('maxSizeRequest', 413)
+    # chunked body without content-length is counted while read
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > max_size:
+            return limit_response('maxSizeRequest', 413)
 
     try:
-        data = await request.json()
+        data = json.loads(body)
     except Exception:
         return JSONResponse({
             "type": "urn:ietf:params:jmap:error:notJson",
             "status": 400,
             "detail": "The content of the request did not parse as JSON."
         }, 400)
+    if not isinstance(data, dict) or not isinstance(data.get('methodCalls', None), list) \
+            or not isinstance(data.get('createdIds', {}), dict):
+        return JSONResponse({
+            "type": "urn:ietf:params:jmap:error:notRequest",
+            "status": 400,
+            "detail": "The request did not match the type signature of the Request object."
+        }, 400)
+    if len(data['methodCalls']) > core.capability['maxCallsInRequest']:
+        return limit_response('maxCallsInRequest', 400)
 
     request.scope['idmap'] = IdMap(data.get('createdIds', {}))
 
-    for method_name, kwargs, tag in data['methodCalls']:
-        t0 = monotonic() * 1000
-        try:
-            method = METHODS[method_name]
-        except KeyError:
-            results.append(('error', {'error': 'unknownMethod'}, tag))
-            continue
-
-        # resolve kwargs
-        error = False
-        for key in [k for k in kwargs.keys() if k[0] == '#']:
-            # we are updating dict over which we iterate
-            # please check that your changes don't skip keys
-            val = kwargs.pop(key)
-            val = _parsepath(val['path'], results_bytag[val['resultOf']])
-            if val is None:
-                results.append(('error',
-                    {'type': 'resultReference', 'message': repr(val)}, tag))
-                error = True
-                break
-            elif not isinstance(val, list):
-                val = [val]
-            kwargs[key[1:]] = val
-        if error:
-            continue
-
-        try:
-            result = method(request, **kwargs)
-            if isawaitable(result):
-                result = await result
-            if type(result) is tuple:
-                # Emailsubmission/set may return 2 responses
-                for res in result:
-                    results.append((res.pop('method_name', method_name), res, tag))
-            else:
-                results.append((method_name, result, tag))
-            results_bytag[tag] = result
-        except errors.JmapError as e:
-            results.append(e.to_dict())
-        except Exception as e:
-            results.append(('error', {
-                'type': e.__class__.__name__,
-                'message': str(e),
-            }, tag))
-            raise e
-        finally:
-            log_method_call(method_name, monotonic() * 1000 - t0, kwargs)
+    # independent calls run concurrently, responses stay in order of calls
+    calls = data['methodCalls']
+    prefetches = plan.plan_prefetch(calls)
+    dependencies = plan.plan_dependencies(calls)
+    tasks = []
+    tasks_bytag = {}
+    for (method_name, kwargs, tag), prefetch, depends in zip(calls, prefetches, dependencies):
+        task = asyncio.ensure_future(call_method(
+            request, method_name, kwargs, tag, prefetch,
+            [tasks[i] for i in depends], dict(tasks_bytag)))
+        tasks.append(task)
+        tasks_bytag[tag] = task
+    if STREAM_RESPONSES:
+        return StreamingResponse(stream_responses(request, data, tasks), media_type=JSONResponse.media_type)
+    try:
+        done = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
 
     out = {
-        'methodResponses': results,
+        'methodResponses': [response for responses, result in done for response in responses],
         'sessionState': request['user'].sessionState,
     }
     if 'createdIds' in data:
-        out['createdIds'] = data['createdIds']
+        out['createdIds'] = created_ids(data, request['idmap'])
     return JSONResponse(out)
 
 
+async def stream_responses(request, data, tasks):
+    """Yields JSON envelope with method responses in order of calls,
+    each as soon as its call is done. sessionState and createdIds
+    follow methodResponses, so they are known after all calls.
+    Status 200 is already sent, so failed call responds serverFail error"""
+    try:
+        yield b'{"methodResponses":['
+        separator = b''
+        for (method_name, kwargs, tag), task in zip(data['methodCalls'], tasks):
+            try:
+                responses, result = await task
+            except Exception as e:
+                log.exception('%s failed', method_name)
+                responses = [('error', errors.serverFail(str(e)).to_dict(), tag)]
+            for response in responses:
+                yield separator + dumps(response)
+                separator = b','
+        out = {'sessionState': request['user'].sessionState}
+        if 'createdIds' in data:
+            out['createdIds'] = created_ids(data, request['idmap'])
+        yield b'],' + dumps(out)[1:]
+    finally:
+        # failed call or disconnected client
+        for task in tasks:
+            task.cancel()
+
+
+def created_ids(data, idmap):
+    "Returns createdIds of request with ids created by its calls"
+    created = dict(data['createdIds'])
+    created.update((key[1:], id) for key, id in idmap.items() if key[:1] == '#')
+    return created
+
+
+def limit_response(limit, status):
+    return JSONResponse({
+        "type": "urn:ietf:params:jmap:error:limit",
+        "limit": limit,
+        "status": status,
+        "detail": f"Request exceeds {limit} limit.",
+    }, status)
+
+
+async def call_method(request, method_name, kwargs, tag, prefetch, depends, tasks_bytag):
+    """Runs method call after calls it depends on
+    returns (responses, result)"""
+    if depends:
+        await asyncio.gather(*depends)
+
+    t0 = monotonic() * 1000
+    try:
+        method = METHODS[method_name]
+    except KeyError:
+        return [('error', {'error': 'unknownMethod'}, tag)], None
+
+    # resolve kwargs
+    for key in [k for k in kwargs.keys() if k[0] == '#']:
+        # we are updating dict over which we iterate
+        # please check that your changes don't skip keys
+        val = kwargs.pop(key)
+        task = tasks_bytag.get(val['resultOf'], None)
+        val = _parsepath(val['path'], task.result()[1]) if task else None
+        if val is None:
+            return [('error', {'type': 'resultReference', 'message': repr(val)}, tag)], None
+        elif not isinstance(val, list):
+            val = [val]
+        kwargs[key[1:]] = val
+
+    responses = []
+    token = plan.prefetch.set(prefetch)
+    try:
+        async with account_connection(request, kwargs.get('accountId', None)):
+            result = method(request, **kwargs)
+            if isawaitable(result):
+                result = await result
+        if type(result) is tuple:
+            # Emailsubmission/set may return 2 responses
+            for res in result:
+                responses.append((res.pop('method_name', method_name), res, tag))
+        else:
+            responses.append((method_name, result, tag))
+        return responses, result
+    except errors.JmapError as e:
+        return [('error', e.to_dict(), tag)], None
+    finally:
+        plan.prefetch.reset(token)
+        elapsed = monotonic() * 1000 - t0
+        metrics.jmap_methods.observe(method_name, elapsed / 1000)
+        log_method_call(method_name, elapsed, kwargs)
+
+
+def account_connection(request, accountId):
+    """Checks out own IMAP connection of account for call,
+    so independent calls don't wait for each other's commands"""
+    account = getattr(request['user'], 'accounts', {}).get(accountId, None) \
+        if isinstance(accountId, str) else None
+    connection = getattr(account, 'connection', None)
+    return connection() if connection is not None else nullcontext()
+
+
 class IdMap(dict):
     def __missing__(self, key):
         return key
@@ -118,6 +218,8 @@ class IdMap(dict):
 
 
 def _parsepath(path, item):
+    if isinstance(item, Fragment):
+        item = item.loads()
     match = re.match(r'^/([^/]+)', path)
     if not match:
         return item
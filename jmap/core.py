@@ -23,14 +23,28 @@ def api_Core_echo(request, **kwargs):
     return kwargs
 
 
-def api_Blob_copy(request, fromAccountId, accountId, blobIds):
+async def api_Blob_copy(request, fromAccountId, accountId, blobIds):
     fromAccount = request['user'].get_account(fromAccountId)
     account = request['user'].get_account(accountId)
+    copied = {}
+    notCopied = {}
+    for blobId in blobIds:
+        try:
+            if account is fromAccount:
+                copied[blobId] = blobId
+            elif not hasattr(account, 'blob_copy'):
+                raise errors.serverFail('Blob/copy not supported by account')
+            else:
+                copied[blobId] = await account.blob_copy(fromAccount, blobId)
+        except errors.notFound as e:
+            notCopied[blobId] = errors.blobNotFound(str(e)).to_dict()
+        except errors.JmapError as e:
+            notCopied[blobId] = e.to_dict()
     return {
         'fromAccountId': fromAccountId,
         'accountId': accountId,
-        'copied': None,
-        'notCopied': {id: errors.serverFail('Blob/copy not implemented') for id in blobIds},
+        'copied': copied or None,
+        'notCopied': notCopied or None,
     }
 
 
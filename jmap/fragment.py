@@ -0,0 +1,46 @@
+import os
+import re
+
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+
+# placeholders can't be made by strings of clients or emails
+TOKEN = os.urandom(8).hex()
+placeholder_re = re.compile(rb'"\\u0000' + TOKEN.encode() + rb'(\d+)\\u0000"')
+
+
+class Fragment:
+    """Already serialized JSON value, spliced as is into output of dumps,
+    so cached objects are not built and serialized again"""
+    __slots__ = ('json',)
+
+    def __init__(self, json: bytes):
+        self.json = json
+
+    def __repr__(self):
+        return f"Fragment({self.json!r})"
+
+    def loads(self):
+        "Returns deserialized value, for result references"
+        return json.loads(self.json)
+
+
+def dumps(content) -> bytes:
+    "Serializes content to JSON bytes with Fragments spliced in"
+    fragments = []
+
+    def default(obj):
+        if isinstance(obj, Fragment):
+            fragments.append(obj.json)
+            return f"\x00{TOKEN}{len(fragments) - 1}\x00"
+        raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+    body = json.dumps(content, default=default)
+    if isinstance(body, str):
+        body = body.encode()
+    if not fragments:
+        return body
+    return placeholder_re.sub(lambda m: fragments[int(m.group(1))], body)
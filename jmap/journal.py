@@ -0,0 +1,106 @@
+from bisect import bisect_right
+
+from jmap import errors
+
+
+class ChangeJournal:
+    """Bounded log of object changes ordered by integer state,
+    answers */changes for states not older than low in pages of maxChanges.
+    Kinds are 'created', 'destroyed' and any other string for update."""
+    __slots__ = 'maxsize', 'states', 'changes', 'state', 'low'
+
+    def __init__(self, state=0, maxsize=10000):
+        self.maxsize = maxsize
+        # parallel lists, states are nondecreasing
+        self.states = []
+        self.changes = []
+        self.state = state
+        # oldest state which changes can be calculated from
+        self.low = state
+
+    def __len__(self):
+        return len(self.states)
+
+    def record(self, id, kind, state=None):
+        "Appends change, with state=None it gets next state"
+        if state is None:
+            state = self.state + 1
+        elif state < self.state:
+            state = self.state
+        self.state = state
+        self.states.append(state)
+        self.changes.append((id, kind))
+        # trim in batches, not on every record
+        if len(self.states) > self.maxsize + self.maxsize // 8 + 1:
+            self.trim(self.maxsize)
+
+    def advance(self, state):
+        "Moves to newer state without recording change"
+        if state > self.state:
+            self.state = state
+
+    def trim(self, size):
+        "Drops oldest changes, so at most size are left"
+        if len(self.states) <= size:
+            return
+        # drop whole state, so low is exact
+        low = self.states[len(self.states) - size - 1]
+        drop = bisect_right(self.states, low)
+        del self.states[:drop]
+        del self.changes[:drop]
+        self.low = low
+
+    def clear(self):
+        del self.states[:]
+        del self.changes[:]
+        self.low = self.state
+
+    def changes_since(self, since, maxChanges=None):
+        """Returns (newState, hasMoreChanges, created, updated, removed)
+        where updated maps id to its update kind. Page ends on state boundary
+        with at most maxChanges ids"""
+        if since < self.low or since > self.state:
+            raise errors.cannotCalculateChanges()
+        start = bisect_right(self.states, since)
+        stop = len(self.states)
+        if maxChanges and stop - start > maxChanges:
+            # find last state boundary not exceeding maxChanges ids
+            seen = set()
+            end = start
+            for i in range(start, stop):
+                if i > start and self.states[i] != self.states[i - 1]:
+                    end = i
+                seen.add(self.changes[i][0])
+                if len(seen) > maxChanges:
+                    break
+            else:
+                end = stop
+            if end == start:
+                # one state has more changes than client wants
+                raise errors.cannotCalculateChanges()
+            stop = end
+
+        first = {}
+        last = {}
+        for id, kind in self.changes[start:stop]:
+            first.setdefault(id, kind)
+            if kind != 'destroyed' and last.get(id, kind) not in (kind, 'created'):
+                # different update kinds merge to plain update
+                kind = 'updated'
+            last[id] = kind
+
+        created = []
+        updated = {}
+        removed = []
+        for id, kind in first.items():
+            if kind == 'created':
+                if last[id] != 'destroyed':
+                    created.append(id)
+            elif last[id] == 'destroyed':
+                removed.append(id)
+            else:
+                updated[id] = last[id] if last[id] != 'created' else 'updated'
+
+        if stop < len(self.states):
+            return self.states[stop - 1], True, created, updated, removed
+        return self.state, False, created, updated, removed
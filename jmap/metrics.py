@@ -0,0 +1,127 @@
+"""
+Process metrics in Prometheus text format.
+Observations only increment numbers in memory, gauges like cache
+sizes and connections are read when /metrics is scraped.
+"""
+import asyncio
+from bisect import bisect_left
+
+# upper bounds in seconds, same as Prometheus client defaults
+BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        # last is +Inf bucket
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+
+class HistogramFamily:
+    """Histograms by value of one label"""
+    __slots__ = ('name', 'help', 'label', 'histograms')
+
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.histograms = {}
+
+    def observe(self, labelvalue, value):
+        try:
+            histogram = self.histograms[labelvalue]
+        except KeyError:
+            histogram = self.histograms[labelvalue] = Histogram()
+        histogram.observe(value)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labelvalue, histogram in sorted(self.histograms.items()):
+            label = f'{self.label}="{escape(labelvalue)}"'
+            cumulative = 0
+            for bound, count in zip((*BUCKETS, '+Inf'), histogram.counts):
+                cumulative += count
+                yield f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}'
+            yield f'{self.name}_sum{{{label}}} {histogram.sum}'
+            yield f'{self.name}_count{{{label}}} {cumulative}'
+
+
+jmap_methods = HistogramFamily('jmap_method_duration_seconds', 'Duration of JMAP method calls.', 'method')
+imap_commands = HistogramFamily('imap_command_duration_seconds', 'Duration of IMAP commands.', 'command')
+loop_lag = HistogramFamily('event_loop_lag_seconds', 'Delay of event loop wakeups.', 'loop')
+# bytes from and to IMAP servers
+imap_bytes = {'in': 0, 'out': 0}
+
+
+async def monitor_loop_lag(interval=0.5):
+    "Measures how late sleeps wake up, runs until cancelled"
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        loop_lag.observe('main', max(0.0, loop.time() - start - interval))
+
+
+def render(accounts=(), caches=None):
+    """Returns metrics in Prometheus text format, accounts are pairs
+    (account id, account), caches map name to list of LRUCaches"""
+    lines = []
+    for family in (jmap_methods, imap_commands, loop_lag):
+        lines.extend(family.render())
+
+    lines.append("# HELP imap_bytes_total Bytes received from and sent to IMAP servers.")
+    lines.append("# TYPE imap_bytes_total counter")
+    for direction, size in imap_bytes.items():
+        lines.append(f'imap_bytes_total{{direction="{direction}"}} {size}')
+
+    lines.append("# HELP imap_connections Open IMAP connections of account.")
+    lines.append("# TYPE imap_connections gauge")
+    connections = {}
+    for id, account in accounts:
+        connections[id] = connections.get(id, 0) + imap_connections(account)
+    for id, count in sorted(connections.items()):
+        lines.append(f'imap_connections{{account="{escape(id)}"}} {count}')
+
+    for name, type, help in (
+            ('cache_entries', 'gauge', 'Entries in cache.'),
+            ('cache_hits_total', 'counter', 'Cache lookups which found entry.'),
+            ('cache_misses_total', 'counter', 'Cache lookups which missed.'),
+            ('cache_hit_ratio', 'gauge', 'Hits of all cache lookups.')):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+        for cache_name, cache_list in sorted((caches or {}).items()):
+            entries = sum(len(cache) for cache in cache_list)
+            hits = sum(cache.hits for cache in cache_list)
+            misses = sum(cache.misses for cache in cache_list)
+            value = {
+                'cache_entries': entries,
+                'cache_hits_total': hits,
+                'cache_misses_total': misses,
+                'cache_hit_ratio': hits / (hits + misses) if hits + misses else 0.0,
+            }[name]
+            lines.append(f'{name}{{cache="{escape(cache_name)}"}} {value}')
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def imap_connections(account):
+    "Returns number of open IMAP connections of account"
+    pools = [getattr(account, name, None) for name in ('pool', 'downloads')]
+    connections = [imap for pool in pools if pool is not None for imap in pool.connections] \
+        if pools[0] is not None else [getattr(account, 'imap', None)]
+    count = 0
+    for imap in connections:
+        transport = getattr(getattr(imap, 'protocol', None), 'transport', None)
+        count += transport is not None and not transport.is_closing()
+    return count
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -1,12 +1,20 @@
+from base64 import b64decode
+import binascii
+from codecs import getincrementaldecoder
 from datetime import datetime
+from email import message_from_bytes
 from email.header import decode_header, make_header
 from email.message import EmailMessage
-from email.utils import format_datetime, parsedate_to_datetime
+from email.policy import default
+from email.utils import format_datetime, parsedate_to_datetime, decode_rfc2231
 from io import BytesIO
 from operator import itemgetter
+from quopri import decodestring
 from random import randrange
+from urllib.parse import unquote
 
-import lxml
+import lxml.etree
+import lxml.html
 from email._parseaddr import AddressList
 import re
 
@@ -54,19 +62,32 @@ def asOneURL(raw):
 def asRaw(raw):
     return raw
 
+fold_re = re.compile(r'\r?\n(?=[ \t])')
 def asText(raw):
-    return raw and str(make_header(decode_header(raw))).strip()
+    if not raw:
+        return raw
+    raw = fold_re.sub('', raw)
+    if '=?' not in raw:
+        # no RFC 2047 encoded words
+        return raw.strip()
+    return str(make_header(decode_header(raw))).strip()
+
+
+def parse_email(blobId, raw):
+    """Parses whole message to (bodyValues, bodyStructure)
+    made of plain picklable values, so it can run in process pool"""
+    return bodystructure(blobId, message_from_bytes(raw, policy=default))
 
 
 def bodystructure(blobId, part, partno=None):
-    hdrs = [{'name': k, 'value': v} for k, v in part.items()]
+    hdrs = [{'name': k, 'value': str(v)} for k, v in part.items()]
     typ = part.get_content_type().lower()
     bodyValues = {}
 
     if typ.startswith('multipart/'):
         subparts = []
         for n, subpart in enumerate(part.iter_parts(), 1):
-            subBodyValues, subpart = bodystructure(id, subpart, f"{partno}-{n}" if partno else f"{n}")
+            subBodyValues, subpart = bodystructure(blobId, subpart, f"{partno}-{n}" if partno else f"{n}")
             bodyValues.update(subBodyValues)
             subparts.append(subpart)
         return bodyValues, {
@@ -99,6 +120,77 @@ def bodystructure(blobId, part, partno=None):
     }
 
 
+def decode_body(data, encoding='7BIT', charset='us-ascii', partial=False):
+    """Decodes content-transfer-encoding and charset of part body
+    partial data are cut to last complete encoded unit and character
+    returns (str, isEncodingProblem)"""
+    problem = False
+    encoding = (encoding or '7BIT').upper()
+    try:
+        if encoding == 'BASE64':
+            if partial:
+                data = re.sub(rb'\s+', b'', data)
+                data = data[:len(data) // 4 * 4]
+            data = b64decode(data)
+        elif encoding == 'QUOTED-PRINTABLE':
+            if partial:
+                data = incomplete_qp_re.sub(b'', data)
+            data = decodestring(data)
+    except (binascii.Error, ValueError):
+        problem = True
+    try:
+        decoder = getincrementaldecoder(charset or 'us-ascii')
+    except LookupError:
+        decoder = getincrementaldecoder('utf-8')
+        problem = True
+    try:
+        value = decoder().decode(data, final=not partial)
+    except UnicodeDecodeError:
+        value = decoder(errors='replace').decode(data, final=not partial)
+        problem = True
+    return value.replace('\r\n', '\n'), problem
+
+incomplete_qp_re = re.compile(rb'=[0-9A-Fa-f\r]?$')
+
+
+def encoded_size(size, encoding='7BIT', charset='us-ascii'):
+    """Returns how many encoded bytes are enough to decode
+    value of at least size UTF-8 bytes"""
+    charset = (charset or 'us-ascii').lower()
+    if charset.startswith(('utf-16', 'utf-32', 'ucs')):
+        size *= 4
+    elif charset.startswith('iso-2022'):
+        size *= 2
+    encoding = (encoding or '7BIT').upper()
+    if encoding == 'BASE64':
+        # 57 decoded bytes in each 76 chars line + CRLF
+        size = (size // 57 + 1) * 78
+    elif encoding == 'QUOTED-PRINTABLE':
+        # 3 chars for each byte and soft line break after 73
+        size = size * 3 * 76 // 73 + 3
+    return size
+
+
+def truncate_utf8(value, size):
+    "Truncates str to at most size UTF-8 bytes without splitting characters"
+    if len(value) * 4 <= size:
+        return value
+    return value.encode()[:size].decode(errors='ignore')
+
+
+def asFilename(params):
+    "Returns decoded filename from Content-Disposition or Content-Type params"
+    for name in ('filename', 'name'):
+        if f'{name}*' in params:
+            charset, language, value = decode_rfc2231(params[f'{name}*'])
+            if charset:
+                return unquote(value, encoding=charset, errors='replace')
+            return value
+        if params.get(name, None):
+            return asText(params[name])
+    return None
+
+
 def parseStructure(parts, multipartType, inAlternative):
     textBody = []
     htmlBody = []
@@ -148,8 +240,9 @@ def parseStructure(parts, multipartType, inAlternative):
 
 
 def htmltotext(html):
-    doc = lxml.etree.html.fromstring(html)
-    doc = lxml.etree.html.clean_html(doc)
+    doc = lxml.html.fromstring(html)
+    for elem in doc.xpath('//script|//style'):
+        elem.drop_tree()
     return doc.text_content()
 
 def htmlpreview(html, maxlen=256, tags=('title','p','div','span','a','td','li','b','strong','code')):
@@ -158,7 +251,7 @@ def htmlpreview(html, maxlen=256, tags=('title','p','div','span','a','td','li','
         html = html.encode()
     for e, elem in lxml.etree.iterparse(BytesIO(html), events=("end",), tag=tags, no_network=True, remove_blank_text=True, remove_comments=True, remove_pis=True, html=True):
         if elem.tag in tags:
-            text = elem.text.strip()
+            text = (elem.text or '').strip()
             # TODO: elem.tail?
             if text:
                 preview += text + ' '
@@ -0,0 +1,70 @@
+"""
+Request planner looks ahead at method calls of one request:
+which calls can run concurrently and which emails later calls need,
+so the account can fetch them together with earlier calls.
+"""
+from contextvars import ContextVar
+
+# Email properties needed by later calls for emails of currently running call
+prefetch = ContextVar('prefetch', default=frozenset())
+
+# methods whose result references email ids with given path
+EMAIL_ID_SOURCES = {
+    'Email/query': ('/ids',),
+    'Email/get': ('/list/*/id',),
+    'Thread/get': ('/list/*/emailIds',),
+}
+
+
+def plan_prefetch(method_calls):
+    """Returns list of frozensets of Email properties (parallel to method_calls)
+    which Email/get calls referencing result of each call will need"""
+    extra = [set() for _ in method_calls]
+    bytag = {}
+    references = []
+    for i, (method_name, kwargs, tag) in enumerate(method_calls):
+        ref = kwargs.get('#ids', None) if isinstance(kwargs, dict) else None
+        if method_name == 'Email/get' and isinstance(ref, dict) and kwargs.get('properties'):
+            source = bytag.get(ref.get('resultOf'), None)
+            if source is not None:
+                references.append((i, source, ref.get('path')))
+        bytag[tag] = i
+
+    # from last so chained Email/get calls pass their needs further
+    for i, source, path in reversed(references):
+        source_name, source_kwargs, _ = method_calls[source]
+        if path in EMAIL_ID_SOURCES.get(source_name, ()) \
+                and source_kwargs.get('accountId') == method_calls[i][1].get('accountId'):
+            extra[source].update(method_calls[i][1]['properties'])
+            extra[source].update(extra[i])
+
+    return [frozenset(props) for props in extra]
+
+
+# methods changing state, creation ids are known only after them
+MUTATING_METHODS = ('/set', '/copy', '/import')
+
+
+def plan_dependencies(method_calls):
+    """Returns list of sets of indexes of earlier method calls each call
+    needs to wait for. Call waits for calls whose result it references.
+    Mutating call waits for all earlier calls and all later calls wait for it,
+    so creation ids and changed state are visible to them."""
+    dependencies = []
+    bytag = {}
+    last_mutation = -1
+    for i, (method_name, kwargs, tag) in enumerate(method_calls):
+        depends = set()
+        if isinstance(kwargs, dict):
+            for key, val in kwargs.items():
+                if key[:1] == '#' and isinstance(val, dict) and val.get('resultOf') in bytag:
+                    depends.add(bytag[val['resultOf']])
+        if method_name.endswith(MUTATING_METHODS):
+            # calls before last_mutation wait for it already
+            depends.update(range(max(last_mutation, 0), i))
+            last_mutation = i
+        elif last_mutation >= 0:
+            depends.add(last_mutation)
+        dependencies.append(depends)
+        bytag[tag] = i
+    return dependencies
@@ -1,5 +1,10 @@
 import asyncio
+from contextlib import asynccontextmanager
+from hmac import compare_digest
 import os
+import re
+from collections import Counter
+from urllib.parse import quote
 
 from starlette.applications import Starlette
 from starlette.middleware import Middleware
@@ -8,10 +13,17 @@ from starlette.middleware.cors import CORSMiddleware
 from starlette.responses import Response, StreamingResponse
 from starlette.routing import Route
 
-from jmap.api import api, CAPABILITIES, JSONResponse
+import jmap.core as core
+from jmap import errors, metrics
+from jmap.account.imap.email import PREVIEW_CACHE
+from jmap.api import api, CAPABILITIES, JSONResponse, limit_response
 from user import BasicAuthBackend
 
 BASEURL = os.getenv('BASEURL', 'http://127.0.0.1:8888')
+# /metrics in Prometheus format, exposes account names
+METRICS = os.getenv('METRICS', '0') == '1'
+# when set, /metrics requires header Authorization: Bearer METRICS_TOKEN
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
 
 
 async def event_stream(request, types, closeafter, ping):
@@ -53,8 +65,51 @@ async def upload(request):
         account = user.accounts[accountId]
     except KeyError:
         return Response('No access to this accountId', 403)
-    res = account.upload(request.stream(), request.headers['content-type'])
-    return JSONResponse(res)
+
+    max_size = core.capability['maxSizeUpload']
+    try:
+        too_large = int(request.headers.get('content-length', 0)) > max_size
+    except ValueError:
+        too_large = False
+    if too_large:
+        return limit_response('maxSizeUpload', 413)
+    if uploads[user.username] >= core.capability['maxConcurrentUpload']:
+        return limit_response('maxConcurrentUpload', 429)
+
+    stream = LimitedStream(request.stream(), max_size)
+    uploads[user.username] += 1
+    try:
+        res = await account.upload(stream, request.headers.get('content-type', None))
+    except Exception:
+        if stream.exceeded:
+            return limit_response('maxSizeUpload', 413)
+        raise
+    finally:
+        uploads[user.username] -= 1
+        if not uploads[user.username]:
+            del uploads[user.username]
+    return JSONResponse(res, 201)
+
+
+# number of running uploads by username
+uploads = Counter()
+
+
+class LimitedStream:
+    """Async iterator over chunks which fails after max_size bytes"""
+    def __init__(self, stream, max_size):
+        self.stream = stream
+        self.max_size = max_size
+        self.size = 0
+        self.exceeded = False
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            self.size += len(chunk)
+            if self.size > self.max_size:
+                self.exceeded = True
+                raise errors.tooLarge(f'Upload is bigger than {self.max_size} bytes')
+            yield chunk
 
 
 async def download(request):
@@ -65,17 +120,57 @@ async def download(request):
     except KeyError:
         return Response('No access to this accountId', 403)
     blobId = request.path_params['blobId']
-    try:
-        body = account.download(blobId)
-    except Exception as e:
-        return Response(str(e), 404)
     name = request.path_params['name']
+    # blobIds are immutable
+    etag = f'"{blobId}"'
     headers = {
-        'content-disposition': 'attachment; name=' + name
+        'content-disposition': "attachment; filename*=UTF-8''" + quote(name),
+        'etag': etag,
+        'cache-control': 'private, max-age=31536000, immutable',
+        'accept-ranges': 'bytes',
     }
-    if 'type' in request.query_params:
-        headers['content-type'] = request.query_params['type']
-    return Response(body, 200, headers=headers)
+    if_none_match = request.headers.get('if-none-match', None)
+    if if_none_match and (if_none_match.strip() == '*' or etag in if_none_match.split(', ')):
+        return Response(status_code=304, headers=headers)
+
+    byterange = None
+    if request.headers.get('if-range', etag) == etag:
+        byterange = parse_range(request.headers.get('range', None))
+    try:
+        stream = await account.download_stream(blobId, *(byterange or ()))
+    except errors.notFound as e:
+        return Response(str(e), 404)
+
+    status = 200
+    if byterange is not None:
+        if not stream.size:
+            await stream.aclose()
+            headers['content-range'] = f'bytes */{stream.total}'
+            return Response(status_code=416, headers=headers)
+        status = 206
+        headers['content-range'] = f'bytes {stream.start}-{stream.start + stream.size - 1}/{stream.total}'
+    headers['content-length'] = str(stream.size)
+    return StreamingResponse(stream, status, headers=headers,
+                             media_type=request.query_params.get('type', 'application/octet-stream'))
+
+
+def parse_range(value):
+    """Returns (start, stop) from single bytes range header value,
+    start is negative for suffix range, stop is None until the end.
+    Returns None for missing, invalid or multiple ranges"""
+    match = range_re.match(value or '')
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first:
+        return (-int(last), None) if last and int(last) else None
+    if not last:
+        return int(first), None
+    if int(last) < int(first):
+        return None
+    return int(first), int(last) + 1
+
+range_re = re.compile(r'^bytes=([0-9]*)-([0-9]*)$')
 
 
 async def well_known_jmap(request):
@@ -106,6 +201,32 @@ async def well_known_jmap(request):
     return JSONResponse(res)
 
 
+async def metrics_endpoint(request):
+    if METRICS_TOKEN and not compare_digest(request.headers.get('authorization', '').encode(),
+                                            f'Bearer {METRICS_TOKEN}'.encode()):
+        return Response('Unauthorized', 401, headers={'www-authenticate': 'Bearer'})
+    accounts = [(id, account) for user in auth_backend.users.values()
+                for id, account in user.accounts.items()]
+    caches = {
+        'preview': [PREVIEW_CACHE],
+        'fragments': [account.fragments for id, account in accounts
+                      if getattr(account, 'fragments', None) is not None],
+        'blob_uids': [account.blobs for id, account in accounts if hasattr(account, 'blobs')],
+        'blob_sizes': [account.blob_sizes for id, account in accounts if hasattr(account, 'blob_sizes')],
+    }
+    return Response(metrics.render(accounts, caches), media_type='text/plain; version=0.0.4')
+
+
+@asynccontextmanager
+async def lifespan(app):
+    monitor = asyncio.ensure_future(metrics.monitor_loop_lag()) if METRICS else None
+    yield
+    if monitor is not None:
+        monitor.cancel()
+
+
+auth_backend = BasicAuthBackend()
+
 routes = [
     Route('/api/', api, methods=["POST", "GET"]),
     Route('/event/', event),
@@ -113,14 +234,17 @@ routes = [
     Route('/download/{accountId}/{blobId}/{name}', download),
     Route('/.well-known/jmap', well_known_jmap),
 ]
+if METRICS:
+    routes.append(Route('/metrics', metrics_endpoint))
 
 middleware = [
     Middleware(CORSMiddleware, allow_origins=['*'], allow_headers=['authorization'], allow_methods=['*']),
-    Middleware(AuthenticationMiddleware, backend=BasicAuthBackend()),
+    Middleware(AuthenticationMiddleware, backend=auth_backend),
 ]
 
 app = Starlette(
     debug=True,
     routes=routes,
     middleware=middleware,
+    lifespan=lifespan,
 )
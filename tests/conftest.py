@@ -38,7 +38,7 @@ def idmap():
 @pytest.fixture()
 def req(user):
     from starlette.requests import Request
-    scope = {'type': 'http', 'user': user}
+    scope = {'type': 'http', 'user': user, 'headers': []}
     return Request(scope)
 
 
@@ -1,4 +1,7 @@
-from jmap.account.imap.aioimaplib import encode_messageset
+import asyncio
+
+from jmap.account.imap.aioimaplib import encode_messageset, parse_fetch, FetchCommand
+from jmap.account.imap.email import MessageSink, ParsedBody, StreamSink
 
 
 def test_encode_messageset():
@@ -7,3 +10,128 @@ def test_encode_messageset():
     assert encode_messageset([1,5,3]) == b'1,3,5'
     assert encode_messageset([1,5,3,2]) == b'1:3,5'
     assert encode_messageset([5,6,7,8,3,2,11,12,13]) == b'2:3,5:8,11:13'
+
+
+def test_parse_fetch_sections():
+    lines = [
+        '1 FETCH (UID 5 BODY[HEADER.FIELDS (SUBJECT FROM)] {14}',
+        bytearray(b'Subject: a\r\n\r\n'),
+        ' BODY[1]<0> {3}',
+        bytearray(b'abc'),
+        ' FLAGS (\\Seen))',
+    ]
+    (seq, data), = parse_fetch(lines)
+    assert data['UID'] == '5'
+    assert data['BODY[HEADER.FIELDS (SUBJECT FROM)]'] == b'Subject: a\r\n\r\n'
+    assert data['BODY[1]<0>'] == b'abc'
+    assert data['FLAGS'] == ['\\Seen']
+
+
+def test_literal_sink():
+    raw = b'Subject: big\r\nContent-Type: text/plain\r\n\r\nbody text\r\n'
+    sinks = []
+    def sink(line, size):
+        if line.endswith(' BODY[] {%d}' % size):
+            sinks.append(MessageSink(size))
+            return sinks[-1]
+    loop = asyncio.new_event_loop()
+    cmd = FetchCommand('A1', '5', '(UID BODY.PEEK[])', by_uid=True, loop=loop, literal_sink=sink)
+    cmd.append_to_resp('1 FETCH (UID 5 BODY[] {%d}' % len(raw))
+    rest = cmd.begin_literal_data(len(raw), raw[:20])
+    assert rest == b'' and cmd.wait_literal_data()
+    rest = cmd.append_literal_data(raw[20:] + b')\r\n')
+    assert rest == b')\r\n' and not cmd.wait_literal_data()
+    cmd.append_to_resp(')')
+    loop.close()
+    (seq, data), = parse_fetch(cmd.response.lines)
+    body = data['BODY[]']
+    assert isinstance(body, ParsedBody) and len(body) == len(raw)
+    assert body.headers == b'Subject: big\r\nContent-Type: text/plain\r\n\r\n'
+    assert body.message['subject'] == 'big'
+    assert body.message.get_content() == 'body text\r\n'
+
+
+def test_concurrent_commands():
+    from jmap.account.imap.aioimaplib import IMAP4ClientProtocol, SELECTED
+
+    class Server:
+        "Answers each command after it is sent, like IMAP server"
+        def __init__(self, protocol):
+            self.protocol = protocol
+            self.sent = []
+
+        def write(self, data):
+            tag, _, command = data.decode().partition(' ')
+            self.sent.append(tag)
+            uid = command.split()[2]
+            self.protocol.loop.call_soon(self.protocol.data_received,
+                                         f'* 1 FETCH (UID {uid})\r\n{tag} OK Fetch completed.\r\n'.encode())
+
+        def is_closing(self):
+            return False
+
+    async def main():
+        protocol = IMAP4ClientProtocol(asyncio.get_running_loop())
+        protocol.connection_made(Server(protocol))
+        protocol.state = SELECTED
+        fetches = asyncio.gather(*(protocol.fetch(str(uid), '(UID)', by_uid=True) for uid in (1, 2, 3)))
+        return await asyncio.wait_for(fetches, 5)
+
+    responses = asyncio.new_event_loop().run_until_complete(main())
+    assert [response.result for response in responses] == ['OK'] * 3
+    assert [response.lines[0] for response in responses] == ['1 FETCH (UID 1)', '1 FETCH (UID 2)', '1 FETCH (UID 3)']
+
+
+def test_stream_sink():
+    from jmap.account.imap.aioimaplib import IMAP4ClientProtocol, SELECTED
+
+    class Server:
+        "Sends literal in pieces while reading is not paused"
+        def __init__(self, protocol):
+            self.protocol = protocol
+            self.pieces = []
+            self.paused = False
+            self.pauses = 0
+
+        def write(self, data):
+            tag = data.decode().partition(' ')[0]
+            self.pieces = [b'* 1 FETCH (UID 7 BODY[]<2> {10}\r\n', b'0123', b'4567',
+                           b'89)\r\n' + tag.encode() + b' OK Fetch completed.\r\n']
+            self.send()
+
+        def send(self):
+            if self.pieces and not self.paused:
+                self.protocol.data_received(self.pieces.pop(0))
+                self.protocol.loop.call_soon(self.send)
+
+        def pause_reading(self):
+            self.paused = True
+            self.pauses += 1
+
+        def resume_reading(self):
+            self.paused = False
+            self.protocol.loop.call_soon(self.send)
+
+        def is_closing(self):
+            return False
+
+    async def main():
+        protocol = IMAP4ClientProtocol(asyncio.get_running_loop())
+        server = Server(protocol)
+        protocol.connection_made(server)
+        protocol.state = SELECTED
+        sink = StreamSink(server, limit=2)
+        fetch = asyncio.ensure_future(protocol.fetch('7', '(BODY.PEEK[]<2.10>)', by_uid=True, literal_sink=sink))
+        chunks = []
+        async for chunk in sink.iterate(fetch):
+            # consumer is slower than IMAP server
+            await asyncio.sleep(0)
+            chunks.append(chunk)
+        response = await asyncio.wait_for(fetch, 5)
+        return chunks, response, server
+
+    chunks, response, server = asyncio.new_event_loop().run_until_complete(main())
+    assert chunks and all(chunks) and b''.join(chunks) == b'0123456789'
+    assert server.pauses and not server.paused
+    assert response.result == 'OK'
+    assert response.lines[:2] == ['1 FETCH (UID 7 BODY[]<2> {10}', b'']
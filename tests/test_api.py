@@ -1,5 +1,6 @@
 import pytest
 from jmap.api import api
+from jmap.fragment import dumps
 
 try:
     import orjson as json
@@ -14,7 +15,7 @@ async def test_Email_query_first_page(req, inbox_id):
         "keywords", "hasAttachment", "from", "to", "preview",
     ]
     user = req['user']
-    req._json = {
+    req._body = dumps({
         "using": ["urn:ietf:params:jmap:core", "urn:ietf:params:jmap:mail"],
         "methodCalls": [
         # First we do a query for the id of first 10 messages in the mailbox
@@ -63,7 +64,7 @@ async def test_Email_query_first_page(req, inbox_id):
             },
             "properties": properties
         }, "3"]
-    ]}
+    ]})
     res = json.loads((await api(req)).body)
     assert len(res['methodResponses']) == 4
     for method, response, tag in res['methodResponses']:
@@ -88,7 +89,7 @@ async def test_Email_query_second_page(req, inbox_id):
         "keywords", "hasAttachment", "from", "to", "preview",
     ]
     user = req['user']
-    req._json = {
+    req._body = dumps({
         "using": ["urn:ietf:params:jmap:core", "urn:ietf:params:jmap:mail"],
         "methodCalls": [
         [ "Email/query", {
@@ -112,7 +113,7 @@ async def test_Email_query_second_page(req, inbox_id):
             },
             "properties": properties
         }, "1" ]
-    ]}
+    ]})
     res = json.loads((await api(req)).body)
     assert len(res['methodResponses']) == 2
     for method, response, tag in res['methodResponses']:
@@ -123,3 +124,84 @@ async def test_Email_query_second_page(req, inbox_id):
             for msg in response['list']:
                 for prop in properties:
                     assert prop in msg
+
+
+@pytest.mark.asyncio
+async def test_streaming_responses(req, inbox_id, monkeypatch):
+    import jmap.api
+    monkeypatch.setattr(jmap.api, 'STREAM_RESPONSES', True)
+    user = req['user']
+    req._body = dumps({
+        "using": ["urn:ietf:params:jmap:core", "urn:ietf:params:jmap:mail"],
+        "methodCalls": [
+            ["Email/query", {
+                "accountId": user.username,
+                "filter": {"inMailbox": inbox_id},
+                "limit": 5,
+            }, "0"],
+            ["Email/get", {
+                "accountId": user.username,
+                "#ids": {"name": "Email/query", "path": "/ids", "resultOf": "0"},
+                "properties": ["subject"],
+            }, "1"],
+            ["Unknown/method", {}, "2"],
+        ],
+        "createdIds": {"k1": "x"},
+    })
+    response = await api(req)
+    body = b''.join([chunk async for chunk in response.body_iterator])
+    res = json.loads(body)
+    assert [tag for method, response, tag in res['methodResponses']] == ['0', '1', '2']
+    assert res['methodResponses'][2][0] == 'error'
+    assert res['sessionState'] == user.sessionState
+    assert res['createdIds'] == {"k1": "x"}
+
+
+@pytest.mark.asyncio
+async def test_streaming_failed_call(req, monkeypatch):
+    import jmap.api
+    monkeypatch.setattr(jmap.api, 'STREAM_RESPONSES', True)
+
+    def fail(request, **kwargs):
+        raise RuntimeError('broken')
+    monkeypatch.setitem(jmap.api.METHODS, 'Test/fail', fail)
+    req._body = dumps({
+        "using": ["urn:ietf:params:jmap:core"],
+        "methodCalls": [
+            ["Core/echo", {"hello": True}, "0"],
+            ["Test/fail", {}, "1"],
+            ["Core/echo", {"hello": False}, "2"],
+        ],
+    })
+    response = await api(req)
+    assert response.status_code == 200
+    body = b''.join([chunk async for chunk in response.body_iterator])
+    res = json.loads(body)
+    assert res['methodResponses'] == [
+        ["Core/echo", {"hello": True}, "0"],
+        ["error", {"type": "serverFail", "description": "broken"}, "1"],
+        ["Core/echo", {"hello": False}, "2"],
+    ]
+    assert res['sessionState'] == req['user'].sessionState
+
+
+@pytest.mark.asyncio
+async def test_request_limits(req, monkeypatch):
+    import jmap.core
+    req._body = b'{"using": []'
+    response = await api(req)
+    assert json.loads(response.body)['type'] == 'urn:ietf:params:jmap:error:notJson'
+    req._body = b'[]'
+    response = await api(req)
+    assert json.loads(response.body)['type'] == 'urn:ietf:params:jmap:error:notRequest'
+
+    monkeypatch.setitem(jmap.core.capability, 'maxCallsInRequest', 2)
+    req._body = dumps({"using": [], "methodCalls": [["Core/echo", {}, str(i)] for i in range(3)]})
+    response = await api(req)
+    assert response.status_code == 400
+    assert json.loads(response.body)['limit'] == 'maxCallsInRequest'
+
+    monkeypatch.setitem(jmap.core.capability, 'maxSizeRequest', 10)
+    response = await api(req)
+    assert response.status_code == 413
+    assert json.loads(response.body)['limit'] == 'maxSizeRequest'
@@ -0,0 +1,16 @@
+from jmap.cache import LRUCache
+
+
+def test_lrucache():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert cache.pop('a') == 1 and cache.pop('a') is None
+    assert len(cache) == 1
@@ -0,0 +1,11 @@
+from datetime import datetime, timezone
+
+from jmap.fragment import Fragment, dumps
+
+
+def test_dumps_fragments():
+    fragment = Fragment(dumps({'id': 'a', 'receivedAt': datetime(2020, 1, 2, tzinfo=timezone.utc)}))
+    body = dumps({'list': [fragment, {'id': 'b'}, fragment], 'text': '\x00x\x00'})
+    assert body == b'{"list":[{"id":"a","receivedAt":"2020-01-02T00:00:00+00:00"},{"id":"b"},' \
+                   b'{"id":"a","receivedAt":"2020-01-02T00:00:00+00:00"}],"text":"\\u0000x\\u0000"}'
+    assert fragment.loads()['id'] == 'a'
@@ -138,6 +138,34 @@ async def test_email_query_inMailbox(account, inbox_id, email_id):
     assert response['canCalculateChanges'] in (True, False)
 
 
+@pytest.mark.asyncio
+async def test_email_query_index(account, inbox_id):
+    from jmap.account.imap.index import EmailIndex
+    query = {
+        "filter": {"operator": "AND", "conditions": [
+            {"inMailbox": inbox_id},
+            {"notKeyword": "$seen"},
+        ]},
+        "sort": [{"property": "size", "isAscending": False}],
+        "calculateTotal": True,
+    }
+    account.index = None
+    expected = await account.email_query(**query)
+    account.index = EmailIndex()
+    # IMAP SEARCH answers while index is built
+    response = await account.email_query(**query)
+    assert response['total'] == expected['total']
+    assert account.index_build is not None
+    await account.index_build
+    assert len(account.index) > 0
+    response = await account.email_query(**query)
+    assert response['total'] == expected['total']
+    # text filter falls back to IMAP SEARCH
+    response = await account.email_query(filter={"text": "test"})
+    assert isinstance(response['ids'], list)
+    account.index = None
+
+
 @pytest.mark.asyncio
 async def test_email_get_all(account, idmap, uidvalidity):
     response = await account.email_get(idmap)
@@ -291,6 +319,70 @@ async def test_email_setget_seen(account, idmap, email_id):
         assert response['list'][0]['keywords'].get('$seen', False) == state
 
 
+@pytest.mark.asyncio
+async def test_email_get_fragments(account, idmap, email_id):
+    from jmap.cache import LRUCache
+    from jmap.fragment import Fragment
+    account.fragments = LRUCache(100)
+    response = await account.email_get(idmap, ids=[email_id], properties=['keywords', 'subject'])
+    first, = response['list']
+    assert isinstance(first, Fragment)
+    response = await account.email_get(idmap, ids=[email_id], properties=['keywords', 'subject'])
+    assert response['list'][0] is first
+    seen = '$seen' in first.loads()['keywords']
+    await account.email_set(idmap, update={email_id: {"keywords/$seen": not seen}})
+    response = await account.email_get(idmap, ids=[email_id], properties=['keywords', 'subject'])
+    assert response['list'][0] is not first
+    assert ('$seen' in response['list'][0].loads()['keywords']) != seen
+    await account.email_set(idmap, update={email_id: {"keywords/$seen": seen}})
+    account.fragments = None
+
+
+@pytest.mark.asyncio
+async def test_email_get_fragments_changed_elsewhere(account, idmap, email_id):
+    from jmap.cache import LRUCache
+    account.fragments = LRUCache(100)
+    state = await account.email_state()
+    response = await account.email_get(idmap, ids=[email_id], properties=['keywords'])
+    seen = '$seen' in response['list'][0].loads()['keywords']
+    # flags changed by other IMAP client, cached email isn't updated
+    uid = account.parse_email_id(email_id)
+    await account.imap.uid_store(str(uid), '-FLAGS.SILENT' if seen else '+FLAGS.SILENT', '(\\Seen)')
+    await account.email_changes(sinceState=state)
+    response = await account.email_get(idmap, ids=[email_id], properties=['keywords'])
+    assert ('$seen' in response['list'][0].loads()['keywords']) != seen
+    await account.email_set(idmap, update={email_id: {"keywords/$seen": seen}})
+    account.fragments = None
+
+
+@pytest.mark.asyncio
+async def test_blob_download(account, idmap, email_id):
+    response = await account.email_get(idmap, ids=[email_id], properties=['blobId', 'size', 'textBody'])
+    msg, = response['list']
+    account.blobs.clear()
+    uid = await account.blob_uid(msg['blobId'])
+    assert f"{account.uidvalidity}-{uid}" == email_id
+    raw = await account.download(msg['blobId'])
+    assert len(raw) == msg['size']
+    # stale uid of moved message is searched again by X-GUID
+    account.blobs[msg['blobId']] = uid + 1000000
+    assert await account.download(msg['blobId']) == raw
+    assert account.blobs.get(msg['blobId']) == uid
+    # part is fetched decoded by BINARY
+    part = msg['textBody'][0]
+    content = await account.download(part['blobId'])
+    assert isinstance(content, (bytes, bytearray)) and len(content) > 0
+    with pytest.raises(errors.notFound):
+        await account.download('G00000000000000000000000000000000')
+    # size of fetched email is cached, stream needs only the literal FETCH
+    assert account.blob_sizes.get(msg['blobId']) == msg['size']
+    stream = await account.download_stream(msg['blobId'], 0, 10)
+    assert (stream.total, await stream.read()) == (msg['size'], raw[:10])
+    stream = await account.download_stream(part['blobId'])
+    assert await stream.read() == content
+    assert account.blob_sizes.get(part['blobId']) == len(content)
+
+
 @pytest.mark.asyncio
 async def test_email_create_destroy(account, idmap, inbox_id):
     async def create_stream():
@@ -346,6 +438,20 @@ async def test_email_changes(account, uidvalidity):
     assert 0 < len(changes) < 3000
 
 
+@pytest.mark.asyncio
+async def test_email_changes_modseq_windows(account, uidvalidity):
+    state = f"{uidvalidity},1,1"
+    seen = 0
+    for _ in range(3):
+        response = await account.email_changes(sinceState=state, maxChanges=2)
+        changes = response['created'] + response['updated'] + response['removed']
+        assert len(changes) <= 2
+        seen += len(changes)
+        assert response['newState'] != state
+        state = response['newState']
+    assert seen > 0
+
+
 @pytest.mark.asyncio
 async def test_thread_changes(account, uidvalidity):
     response = await account.thread_changes(sinceState=f"{uidvalidity},1,10", maxChanges=30)
@@ -357,3 +463,160 @@ async def test_thread_changes(account, uidvalidity):
 async def test_mailbox_changes(account):
     with pytest.raises(jmap.errors.cannotCalculateChanges):
         await account.mailbox_changes(sinceState="1", maxChanges=300)
+    state = await account.mailbox_state()
+    response = await account.mailbox_changes(sinceState=state, maxChanges=300)
+    assert response['newState'] == state
+    assert not response['hasMoreChanges']
+
+
+@pytest.mark.asyncio
+async def test_email_changes_pages(account, idmap, email_id, email_id2):
+    state = await account.email_state()
+    await account.email_set(idmap, update={
+        email_id: {'keywords/$flagged': True},
+        email_id2: {'keywords/$flagged': True},
+    })
+    response = await account.email_changes(sinceState=state, maxChanges=1)
+    assert response['hasMoreChanges']
+    assert len(response['updated']) == 1
+    response = await account.email_changes(sinceState=response['newState'], maxChanges=1)
+    assert len(response['updated']) == 1
+    await account.email_set(idmap, update={
+        email_id: {'keywords/$flagged': None},
+        email_id2: {'keywords/$flagged': None},
+    })
+
+
+@pytest.mark.asyncio
+async def test_email_changes_imap_pages(account, idmap, email_id, email_id2, monkeypatch):
+    state = await account.email_state()
+    await account.email_set(idmap, update={
+        email_id: {'keywords/$seen': True, 'keywords/$flagged': True},
+        email_id2: {'keywords/$seen': True, 'keywords/$flagged': True},
+    })
+    # states older than journal are answered from IMAP, one email per page
+    monkeypatch.setattr(account.email_journal, 'low', 1 << 62)
+    updated = []
+    for _ in range(5):
+        response = await account.email_changes(sinceState=state, maxChanges=1)
+        assert len(response['updated']) <= 1
+        updated += response['updated']
+        state = response['newState']
+        if not response['hasMoreChanges']:
+            break
+    assert not response['hasMoreChanges']
+    assert {email_id, email_id2} <= set(updated)
+    await account.email_set(idmap, update={
+        email_id: {'keywords/$flagged': None},
+        email_id2: {'keywords/$flagged': None},
+    })
+
+
+@pytest.mark.asyncio
+async def test_email_create_batch(account, idmap, inbox_id, drafts_id):
+    create = {
+        f"test{i}": {
+            "mailboxIds": [mailbox_id],
+            "keywords": {"$seen": True},
+            "subject": f"batch {i}",
+            "bodyValues": {"1": {"type": "text/plain", "value": f"Message {i}"}},
+            "textBody": [{"partId": "1", "type": "text/plain"}],
+        } for i, mailbox_id in enumerate((inbox_id, drafts_id, inbox_id))
+    }
+    response = await account.email_set(idmap, create=create)
+    assert not response['notCreated']
+    assert set(response['created'].keys()) == set(create.keys())
+    ids = [created['id'] for created in response['created'].values()]
+    assert len(set(ids)) == len(ids)
+
+    response = await account.email_get(idmap, ids=ids, properties=['mailboxIds', 'subject'])
+    assert response['notFound'] == []
+    for msg in response['list']:
+        cid = f"test{msg['subject'][6:]}"
+        assert msg['mailboxIds'] == create[cid]['mailboxIds']
+
+    response = await account.email_set(idmap, destroy=ids)
+    assert set(response['destroyed']) == set(ids)
+
+
+@pytest.mark.asyncio
+async def test_email_set_batch_update(account, idmap, email_id, email_id2):
+    ids = [email_id, email_id2]
+    for state in (True, None):
+        response = await account.email_set(
+            idmap,
+            update={id: {"keywords/$flagged": state} for id in ids},
+        )
+        assert set(response['updated'].keys()) == set(ids)
+        assert not response['notUpdated']
+
+        response = await account.email_get(idmap, ids=ids, properties=['keywords'])
+        for msg in response['list']:
+            assert msg['keywords'].get('$flagged', None) == state
+
+
+@pytest.mark.asyncio
+async def test_email_get_bodystructure(account, idmap, email_id):
+    account.use_bodystructure = True
+    properties = ["bodyStructure", "bodyValues", "textBody", "htmlBody", "attachments", "hasAttachment"]
+    response = await account.email_get(idmap, ids=[email_id], properties=properties,
+                                       fetchAllBodyValues=True)
+    msg, = response['list']
+    for prop in properties:
+        assert prop in msg
+    for part in msg['textBody'] + msg['htmlBody']:
+        if part['type'] in ('text/plain', 'text/html'):
+            assert part['partId'] in msg['bodyValues']
+    assert 'BODY[]' not in account.emails[email_id]
+
+
+@pytest.mark.asyncio
+async def test_email_get_max_body_value_bytes(account, idmap, email_id):
+    account.use_bodystructure = True
+    response = await account.email_get(idmap, ids=[email_id], properties=['bodyValues'],
+                                       fetchAllBodyValues=True, maxBodyValueBytes=10)
+    msg, = response['list']
+    for bodyValue in msg['bodyValues'].values():
+        assert len(bodyValue['value'].encode()) <= 10
+    response = await account.email_get(idmap, ids=[email_id], properties=['bodyValues'],
+                                       fetchAllBodyValues=True)
+    msg, = response['list']
+    assert not any(v['isTruncated'] for v in msg['bodyValues'].values())
+
+
+@pytest.mark.asyncio
+async def test_email_get_header_fields(account, idmap, email_id):
+    account.emails.pop(email_id, None)
+    properties = ['subject', 'header:Subject:asText', 'header:Received:all']
+    response = await account.email_get(idmap, ids=[email_id], properties=properties)
+    msg, = response['list']
+    assert msg['subject'] == msg['header:Subject:asText']
+    assert isinstance(msg['header:Received:all'], list)
+    assert 'BODY[HEADER]' not in account.emails[email_id]
+
+
+@pytest.mark.asyncio
+async def test_blob_copy(account, idmap, email_id):
+    response = await account.email_get(idmap, ids=[email_id], properties=['blobId'])
+    msg, = response['list']
+    blobId = await account.blob_copy(account, msg['blobId'])
+    assert await account.download(blobId) == await account.download(msg['blobId'])
+
+
+@pytest.mark.asyncio
+async def test_searchsnippet_get(account, email_id):
+    from jmap.account.imap.fts import TextIndex
+    account.fts = TextIndex()
+    # IMAP SEARCH answers while index is built
+    response = await account.email_query(filter={"text": "test"})
+    assert isinstance(response['ids'], list)
+    assert account.fts_build is not None
+    await account.fts_build
+    response = await account.email_query(filter={"text": "test"})
+    assert isinstance(response['ids'], list)
+    response = await account.searchsnippet_get(filter={"text": "test"}, emailIds=[email_id, 'x'])
+    snippet, = response['list']
+    assert snippet['emailId'] == email_id
+    assert snippet['preview'] is None or '<mark>' in snippet['preview']
+    assert response['notFound'] == ['x']
+    account.fts = None
@@ -0,0 +1,145 @@
+from jmap.account.imap.aioimaplib import parse_fetch
+from jmap.account.imap.email import EmailState, ImapEmail, imap_bodystructure, PREVIEW_CACHE
+
+
+def test_imap_bodystructure():
+    lines = [
+        '1 FETCH (UID 5 BODYSTRUCTURE ((("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 12 1 NIL NIL NIL NIL)'
+        '("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "BASE64" 12 1 NIL NIL NIL NIL) "ALTERNATIVE" ("BOUNDARY" "a") NIL NIL NIL)'
+        '("APPLICATION" "PDF" ("NAME" "x.pdf") "<cid1>" NIL "BASE64" 7800 NIL'
+        ' ("ATTACHMENT" ("FILENAME*" "utf-8\'\'%C5%BE.pdf")) NIL NIL) "MIXED" ("BOUNDARY" "b") NIL NIL NIL)'
+        ' BODY[1.1] {12}',
+        bytearray(b'caf=C3=A9 ok'),
+        ' BODY[1.2] "PGI+aGk8L2I+")',
+    ]
+    (seq, data), = parse_fetch(lines)
+    bodyStructure, sections = imap_bodystructure('G1', data['BODYSTRUCTURE'])
+    assert bodyStructure['type'] == 'multipart/mixed'
+    alternative, attachment = bodyStructure['subParts']
+    assert [p['partId'] for p in alternative['subParts']] == ['1-1', '1-2']
+    assert attachment['blobId'] == 'G1-2'
+    assert attachment['name'] == 'ž.pdf'
+    assert attachment['cid'] == 'cid1'
+    assert attachment['disposition'] == 'attachment'
+    assert set(sections.keys()) == {'1-1', '1-2'}
+    assert sections['1-2']['section'] == '1.2'
+
+    msg = ImapEmail(data, **{'X-GUID': '1'})
+    assert msg['bodyValues']['1-1']['value'] == 'café ok'
+    assert msg['bodyValues']['1-2']['value'] == '<b>hi</b>'
+    assert [p['partId'] for p in msg['textBody']] == ['1-1']
+    assert [p['partId'] for p in msg['htmlBody']] == ['1-2']
+    assert [p['partId'] for p in msg['attachments']] == ['2']
+    assert msg['hasAttachment']
+
+
+def test_header_fields():
+    msg = ImapEmail(id='1-5')
+    assert msg.missing_header_fields({'subject', 'from'}) == {'subject', 'from'}
+    msg.add_header_fields({'subject'}, b'Subject: Hello\r\n\r\n')
+    assert msg['subject'] == 'Hello'
+    msg.add_header_fields({'from', 'x-spam'}, b'From: joe@example.com\r\nX-Spam: 1\r\nX-Spam: 2\r\n\r\n')
+    assert msg.missing_header_fields({'subject', 'from', 'to'}) == {'to'}
+    assert msg['subject'] == 'Hello'
+    assert msg['from'] == [{'name': None, 'email': 'joe@example.com'}]
+    assert msg.get_all_headers('x-spam') == ['1', '2']
+    msg.set_headers(b'Subject: Hello\r\nTo: jane@example.com\r\n\r\n')
+    assert msg.missing_header_fields({'to', 'cc'}) == set()
+    assert msg['to'] == [{'name': None, 'email': 'jane@example.com'}]
+
+
+def test_preview():
+    assert ImapEmail(id='1-1', PREVIEW='"Hello"')['preview'] == 'Hello'
+    assert ImapEmail(id='1-1', PREVIEW=['FUZZY', '"Hello"'])['preview'] == 'Hello'
+    assert ImapEmail(id='1-1', PREVIEW=bytearray(b'Hello'))['preview'] == 'Hello'
+    # PREVIEW (LAZY) not generated yet and no body fetched
+    assert ImapEmail(id='1-1', PREVIEW='NIL')['preview'] == ''
+    body = b'Subject: Hi\r\nContent-Type: text/html\r\n\r\n<p>Hello <b>there</b></p>\r\n'
+    msg = ImapEmail({'id': '1-2', 'X-GUID': 'preview-guid', 'BODY[]': body})
+    assert 'Hello' in msg['preview']
+    assert PREVIEW_CACHE.get('Gpreview-guid') == msg['preview']
+    assert ImapEmail({'id': '1-2', 'X-GUID': 'preview-guid'})['preview'] == msg['preview']
+
+
+def test_preview_bodystructure():
+    def fetched(sections):
+        (seq, data), = parse_fetch(['1 FETCH (UID 5 BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "utf-8")'
+                                    ' NIL NIL "7BIT" 400 1 NIL NIL NIL NIL)' + sections + ')'])
+        return ImapEmail(data, **{'X-GUID': 'bs-guid'})
+
+    # no text sections fetched
+    assert fetched('')['preview'] == ''
+    assert PREVIEW_CACHE.get('Gbs-guid') is None
+    # first bytes fetched for maxBodyValueBytes
+    assert fetched(' BODY[1]<0> "Hello"')['preview'] == 'Hello'
+    assert PREVIEW_CACHE.get('Gbs-guid') is None
+    assert fetched(' BODY[1] "Hello world"')['preview'] == 'Hello world'
+    assert PREVIEW_CACHE.get('Gbs-guid') == 'Hello world'
+
+
+def test_compact_fields():
+    msg = ImapEmail({'UID': '5', 'FLAGS': ['\\Seen', '$label'], 'RFC822.SIZE': '123',
+                     'INTERNALDATE': '" 7-Jul-2020 02:44:25 -0700"', 'X-GUID': 'abc'}, id='1-5')
+    assert not hasattr(msg, '__dict__')
+    assert msg['keywords'] == {'$seen': True, '$label': True}
+    assert msg['size'] == 123
+    assert msg['receivedAt'].isoformat() == '2020-07-07T02:44:25-07:00'
+    assert 'BODY[HEADER]' not in msg and msg.get('BODY[HEADER]') is None
+    msg['FLAGS'] = ['\\Flagged']
+    assert msg['keywords'] == {'$flagged': True}
+    assert set(msg) == {'id', 'UID', 'X-GUID', 'FLAGS', 'INTERNALDATE', 'RFC822.SIZE'}
+
+
+def test_flags_overflow(monkeypatch):
+    import jmap.account.imap.email as email_module
+    ImapEmail({'FLAGS': ['\\Seen']})
+    # flag table is full, new flags are kept by email
+    monkeypatch.setattr(email_module, 'MAX_FLAGS', len(email_module.FLAG_NAMES))
+    names = list(email_module.FLAG_NAMES)
+    msg = ImapEmail({'FLAGS': ['\\Seen', '$overflow1', '$overflow2']}, id='1-5')
+    assert email_module.FLAG_NAMES == names
+    assert msg['keywords'] == {'$seen': True, '$overflow1': True, '$overflow2': True}
+    msg['FLAGS'] = ['$overflow1']
+    assert msg['keywords'] == {'$overflow1': True}
+    del msg['FLAGS']
+    assert 'FLAGS' not in msg
+    msg['FLAGS'] = ['\\Seen']
+    assert msg['FLAGS'] == ['\\Seen']
+
+
+def test_header_index():
+    msg = ImapEmail(id='1-5')
+    msg.set_headers(b'Received: from a\r\n\tby b\r\nX-Empty:\r\nsubject: =?utf-8?q?caf=C3=A9?=\r\n'
+                    b'Received: from c\r\nX-Latin: \xe9\r\n\r\n')
+    assert msg.get_all_headers('received') == ['from a\r\n\tby b', 'from c']
+    assert msg.get_header('x-empty') == ''
+    assert msg.get_header('x-latin') == 'é'
+    assert msg['subject'] == 'café'
+    assert [h['name'] for h in msg['headers']] == ['Received', 'X-Empty', 'subject', 'Received', 'X-Latin']
+    # bare LF line endings, headers end before body
+    msg = ImapEmail({'id': '1-6', 'BODY[]': b'Subject: Hi\n there\nFrom: a@b\n\nBody: no\n'})
+    assert msg['subject'] == 'Hi there'
+    assert msg.get_header('body') is None
+
+
+def test_header_fields_then_body():
+    msg = ImapEmail(id='1-5')
+    msg.add_header_fields({'subject'}, b'Subject: hi\r\n\r\n')
+    assert msg.missing_header_fields({'subject', 'from'}) == {'from'}
+    msg['BODY[]'] = b'Subject: hi\r\nX-Foo: bar\r\nFrom: a@b.c\r\n\r\nbody'
+    assert msg.missing_header_fields({'subject', 'from'}) == set()
+    assert msg.get_header('x-foo') == 'bar'
+    assert msg.get_header('from') == 'a@b.c'
+    msg.add_header_fields({'to'}, b'To: c@d.e\r\n\r\n')
+    assert msg.get_header('from') == 'a@b.c'
+
+
+def test_email_state_cursor():
+    state = EmailState.from_string('7,30,100')
+    assert (state.modseq, state.cursor) == (100, 0)
+    assert str(state) == '7,30,100'
+    paged = EmailState.from_string('7,30,100:12')
+    assert (paged.modseq, paged.cursor) == (100, 12)
+    assert str(paged) == '7,30,100:12'
+    assert state <= paged and paged > state
+    assert EmailState(7, 30, 101) > paged
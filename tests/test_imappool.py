@@ -0,0 +1,118 @@
+import asyncio
+import types
+
+import pytest
+
+from jmap.account.imap.pool import ImapPool
+
+
+class Connection:
+    def __init__(self, name):
+        self.name = name
+        self.closing = False
+        self.fetches = []
+        self.stall = asyncio.Event()
+        self.protocol = types.SimpleNamespace(transport=types.SimpleNamespace(
+            is_closing=lambda: self.closing, pause_reading=lambda: None, resume_reading=lambda: None))
+
+    async def uid_fetch(self, uids, items, literal_sink=None):
+        self.fetches.append(items)
+        if literal_sink is not None:
+            sink = literal_sink('1 FETCH (UID 7 BODY[]<0> {10}', 10)
+            sink.feed(b'01234')
+            await self.stall.wait()
+            sink.feed(b'56789')
+            sink.close()
+        return 'OK', ['1 FETCH (UID 7)', 'OK']
+
+
+def pool_of(size):
+    opened = []
+
+    async def connect():
+        await asyncio.sleep(0)
+        opened.append(Connection(len(opened)))
+        return opened[-1]
+    return ImapPool(connect, size), opened
+
+
+@pytest.mark.asyncio
+async def test_pool():
+    pool, opened = pool_of(2)
+    a = await pool.acquire()
+    b = await pool.acquire()
+    assert (a, b) == tuple(opened) and pool.count == 2
+
+    # third caller waits for released connection
+    waiting = asyncio.ensure_future(pool.acquire())
+    await asyncio.sleep(0)
+    assert not waiting.done()
+    pool.release(a)
+    assert await waiting is a
+    assert len(opened) == 2
+
+    # closed connection is not handed over, its place is reopened
+    waiting = asyncio.ensure_future(pool.acquire())
+    await asyncio.sleep(0)
+    b.closing = True
+    pool.release(b)
+    c = await waiting
+    assert c is opened[2] and pool.connections == [a, c]
+
+    pool.release(a)
+    pool.release(c)
+    assert await pool.acquire() is c
+
+
+@pytest.mark.asyncio
+async def test_connection_checkout():
+    from jmap.account.imap.account import ImapAccount
+    from contextvars import ContextVar
+    account = ImapAccount.__new__(ImapAccount)
+    account.imap_context = ContextVar('imap test', default=None)
+    account.pool, opened = pool_of(2)
+    account.imap_main = main = Connection('main')
+    account.pool.add(main)
+
+    async def call(event):
+        async with account.connection() as imap:
+            assert account.imap is imap
+            async with account.connection() as nested:
+                assert nested is imap
+            await event.wait()
+            return imap
+
+    first, second = asyncio.Event(), asyncio.Event()
+    calls = [asyncio.ensure_future(call(first)), asyncio.ensure_future(call(second))]
+    await asyncio.sleep(0.01)
+    # independent calls run on different connections
+    assert account.pool.idle == []
+    first.set()
+    second.set()
+    assert {*await asyncio.gather(*calls)} == {main, opened[0]}
+    assert account.imap is main
+
+
+@pytest.mark.asyncio
+async def test_download_connection():
+    from jmap.account.imap.account import ImapAccount
+    from jmap.cache import LRUCache
+    from contextvars import ContextVar
+    account = ImapAccount.__new__(ImapAccount)
+    account.imap_context = ContextVar('imap test', default=None)
+    account.imap_main = main = Connection('main')
+    account.downloads, opened = pool_of(1)
+    account.blobs = LRUCache(10)
+    account.blob_sizes = LRUCache(10)
+    account.blobs['Gabc'] = 7
+    account.blob_sizes['Gabc'] = 10
+
+    stream = await account.download_stream('Gabc')
+    chunks = stream.__aiter__()
+    assert await chunks.__anext__() == b'01234'
+    # client doesn't read, calls of account go on
+    assert await asyncio.wait_for(account.imap.uid_fetch('7', '(FLAGS)'), 1) == ('OK', ['1 FETCH (UID 7)', 'OK'])
+    assert main.fetches == ['(FLAGS)'] and opened[0].fetches == ['(BODY.PEEK[]<0.10>)']
+    opened[0].stall.set()
+    assert [chunk async for chunk in chunks] == [b'56789']
+    assert account.downloads.idle == opened
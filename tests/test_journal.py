@@ -0,0 +1,41 @@
+import pytest
+
+from jmap import errors
+from jmap.journal import ChangeJournal
+
+
+def test_journal_changes():
+    journal = ChangeJournal(100)
+    journal.record('a', 'created')
+    journal.record('b', 'counts')
+    journal.record('a', 'counts')
+    journal.record('c', 'created')
+    journal.record('c', 'destroyed')
+    journal.record('d', 'destroyed')
+    assert journal.changes_since(100) == (106, False, ['a'], {'b': 'counts'}, ['d'])
+    assert journal.changes_since(102) == (106, False, [], {'a': 'counts'}, ['d'])
+    assert journal.changes_since(106) == (106, False, [], {}, [])
+    with pytest.raises(errors.cannotCalculateChanges):
+        journal.changes_since(99)
+
+
+def test_journal_pages():
+    journal = ChangeJournal(0)
+    for i, state in enumerate([1, 1, 2, 3, 3, 3]):
+        journal.record(f'id{i}', 'updated', state)
+    state, more, created, updated, removed = journal.changes_since(0, 4)
+    assert (state, more, list(updated)) == (2, True, ['id0', 'id1', 'id2'])
+    state, more, created, updated, removed = journal.changes_since(state, 4)
+    assert (state, more, list(updated)) == (3, False, ['id3', 'id4', 'id5'])
+    with pytest.raises(errors.cannotCalculateChanges):
+        journal.changes_since(2, 2)
+
+
+def test_journal_trim():
+    journal = ChangeJournal(0, maxsize=2)
+    for i in range(10):
+        journal.record(f'id{i}', 'updated')
+    assert len(journal) <= 3
+    assert journal.low >= 7
+    with pytest.raises(errors.cannotCalculateChanges):
+        journal.changes_since(1)
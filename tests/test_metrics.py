@@ -0,0 +1,26 @@
+import types
+
+from jmap import metrics
+from jmap.cache import LRUCache
+
+
+def test_render():
+    family = metrics.HistogramFamily('test_seconds', 'Test.', 'method')
+    family.observe('Email/get', 0.02)
+    family.observe('Email/get', 20)
+    lines = list(family.render())
+    assert 'test_seconds_bucket{method="Email/get",le="0.01"} 0' in lines
+    assert 'test_seconds_bucket{method="Email/get",le="0.025"} 1' in lines
+    assert 'test_seconds_bucket{method="Email/get",le="+Inf"} 2' in lines
+    assert 'test_seconds_count{method="Email/get"} 2' in lines
+
+    cache = LRUCache(10)
+    cache['a'] = 1
+    cache.get('a')
+    cache.get('b')
+    closed = types.SimpleNamespace(imap=None)
+    text = metrics.render([('u"1', closed)], {'preview': [cache]})
+    assert 'imap_connections{account="u\\"1"} 0' in text
+    assert 'cache_entries{cache="preview"} 1' in text
+    assert 'cache_hit_ratio{cache="preview"} 0.5' in text
+    assert text.endswith('\n')
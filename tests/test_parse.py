@@ -1,8 +1,10 @@
 import email
 from email.policy import default
 import datetime
+import pickle
 
-from jmap.parse import asAddresses, asMessageIds, asGroupedAddresses, asDate, asURLs, asRaw, asCommaList, bodystructure
+from jmap.parse import asAddresses, asMessageIds, asGroupedAddresses, asDate, asURLs, asRaw, asCommaList, bodystructure, \
+    parse_email, decode_body, encoded_size, truncate_utf8, asText
 
 
 def test_asAddresses():
@@ -33,6 +35,12 @@ def test_asAddresses():
     ]
 
 
+def test_asText():
+    assert asText(' Hello\r\n world ') == 'Hello world'
+    assert asText('=?utf-8?q?caf=C3=A9?=\r\n =?utf-8?q?_ok?=') == 'café ok'
+    assert asText(None) is None
+
+
 def test_asGroupedAddresses():
     assert asGroupedAddresses(None) is None
     assert asGroupedAddresses('') is None
@@ -100,4 +108,47 @@ def test_bodystructure():
     body = b''''''
     blobId = 'blobId'
     part = email.message_from_bytes(body, policy=default)
-    bodyValues, bodyStructure = bodystructure(blobId, part)
\ No newline at end of file
+    bodyValues, bodyStructure = bodystructure(blobId, part)
+
+def test_parse_email():
+    body = b'''From: joe@example.com\r
+Subject: Hello\r
+Content-Type: multipart/mixed; boundary=XX\r
+\r
+--XX\r
+Content-Type: text/plain\r
+\r
+Hello\r
+--XX\r
+Content-Type: application/pdf\r
+Content-Disposition: attachment; filename=a.pdf\r
+Content-Transfer-Encoding: base64\r
+\r
+AAAA\r
+--XX--\r
+'''
+    bodyValues, bodyStructure = parse_email('blobId', body)
+    assert pickle.loads(pickle.dumps((bodyValues, bodyStructure))) == (bodyValues, bodyStructure)
+    assert bodyValues == {'1': {'value': 'Hello', 'type': 'text/plain'}}
+    assert bodyStructure['type'] == 'multipart/mixed'
+    assert [p['blobId'] for p in bodyStructure['subParts']] == ['blobId-1', 'blobId-2']
+    assert bodyStructure['subParts'][1]['name'] == 'a.pdf'
+
+
+def test_decode_body_partial():
+    value = 'žluťoučký kůň ' * 20
+    for encoding in ('base64', 'quoted-printable', '8bit'):
+        raw = email.message.EmailMessage(policy=default)
+        raw.set_content(value, cte=encoding)
+        data = raw.get_payload().encode()
+        size = encoded_size(30, encoding, 'utf-8')
+        partial, problem = decode_body(data[:size], encoding, 'utf-8', partial=True)
+        assert not problem
+        assert value.startswith(partial)
+        assert len(partial.encode()) >= 30
+
+
+def test_truncate_utf8():
+    assert truncate_utf8('abc', 5) == 'abc'
+    assert truncate_utf8('žžž', 5) == 'žž'
+    assert truncate_utf8('žžž', 6) == 'žžž'
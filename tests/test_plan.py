@@ -0,0 +1,47 @@
+from jmap.plan import plan_prefetch, plan_dependencies
+
+
+def test_plan_prefetch():
+    calls = [
+        ["Email/query", {"accountId": "a", "limit": 10}, "0"],
+        ["Email/get", {"accountId": "a", "properties": ["threadId"],
+                       "#ids": {"name": "Email/query", "path": "/ids", "resultOf": "0"}}, "1"],
+        ["Thread/get", {"accountId": "a",
+                        "#ids": {"name": "Email/get", "path": "/list/*/threadId", "resultOf": "1"}}, "2"],
+        ["Email/get", {"accountId": "a", "properties": ["subject", "from"],
+                       "#ids": {"name": "Thread/get", "path": "/list/*/emailIds", "resultOf": "2"}}, "3"],
+        ["Email/get", {"accountId": "b", "properties": ["preview"],
+                       "#ids": {"name": "Email/query", "path": "/ids", "resultOf": "0"}}, "4"],
+    ]
+    assert plan_prefetch(calls) == [
+        {"threadId"},
+        set(),
+        {"subject", "from"},
+        set(),
+        set(),
+    ]
+
+
+def test_plan_prefetch_chained_get():
+    calls = [
+        ["Email/query", {"accountId": "a"}, "0"],
+        ["Email/get", {"accountId": "a", "properties": ["threadId"],
+                       "#ids": {"name": "Email/query", "path": "/ids", "resultOf": "0"}}, "1"],
+        ["Email/get", {"accountId": "a", "properties": ["subject"],
+                       "#ids": {"name": "Email/get", "path": "/list/*/id", "resultOf": "1"}}, "2"],
+    ]
+    assert plan_prefetch(calls) == [{"threadId", "subject"}, {"subject"}, set()]
+
+
+def test_plan_dependencies():
+    calls = [
+        ["Mailbox/get", {"accountId": "a"}, "0"],
+        ["Email/query", {"accountId": "a", "filter": {"inMailbox": "1"}}, "1"],
+        ["Email/query", {"accountId": "a", "filter": {"inMailbox": "2"}}, "2"],
+        ["Email/get", {"accountId": "a",
+                       "#ids": {"name": "Email/query", "path": "/ids", "resultOf": "1"}}, "3"],
+        ["Email/set", {"accountId": "a", "create": {"k1": {}}}, "4"],
+        ["Email/get", {"accountId": "a", "ids": ["#k1"]}, "5"],
+        ["Mailbox/get", {"accountId": "a"}, "6"],
+    ]
+    assert plan_dependencies(calls) == [set(), set(), set(), {1}, {0, 1, 2, 3}, {4}, {4}]
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import types
+
+import pytest
+from starlette.requests import Request
+
+from jmap.account.storage import BlobStream, byte_range, slice_chunks
+import jmap.core as core
+import server
+from server import download, parse_range, upload, uploads
+
+BLOB = b'0123456789'
+
+
+def test_parse_range():
+    assert parse_range('bytes=2-4') == (2, 5)
+    assert parse_range('bytes=2-') == (2, None)
+    assert parse_range('bytes=-3') == (-3, None)
+    assert parse_range('bytes=-0') is None
+    assert parse_range('bytes=4-2') is None
+    assert parse_range('bytes=0-1,4-5') is None
+    assert parse_range('items=0-1') is None
+    assert parse_range(None) is None
+
+
+def test_byte_range():
+    assert byte_range(2, 5, 10) == (2, 5)
+    assert byte_range(2, None, 10) == (2, 10)
+    assert byte_range(-3, None, 10) == (7, 10)
+    assert byte_range(-30, None, 10) == (0, 10)
+    assert byte_range(5, 50, 10) == (5, 10)
+    assert byte_range(20, None, 10) == (10, 10)
+
+
+@pytest.mark.asyncio
+async def test_slice_chunks():
+    async def chunks():
+        yield b'012'
+        yield b'345'
+        yield b'6789'
+
+    assert [c async for c in slice_chunks(chunks(), 2, 7)] == [b'2', b'345', b'6']
+    assert [c async for c in slice_chunks(chunks(), 3, 6)] == [b'345']
+    assert [c async for c in slice_chunks(chunks(), 10, 10)] == []
+
+
+class BlobAccount:
+    async def download_stream(self, blobId, start=0, stop=None):
+        start, stop = byte_range(start, stop, len(BLOB))
+        return BlobStream.from_bytes(BLOB[start:stop], len(BLOB), start)
+
+
+async def get(*headers):
+    user = types.SimpleNamespace(accounts={'u1': BlobAccount()})
+    request = Request({
+        'type': 'http',
+        'method': 'GET',
+        'user': user,
+        'path_params': {'accountId': 'u1', 'blobId': 'Gabc', 'name': 'a.txt'},
+        'headers': [(name.encode(), value.encode()) for name, value in headers],
+        'query_string': b'',
+    })
+    response = await download(request)
+    body = b''
+    if hasattr(response, 'body_iterator'):
+        async for chunk in response.body_iterator:
+            body += chunk
+    return response, body
+
+
+@pytest.mark.asyncio
+async def test_download_range():
+    response, body = await get()
+    assert (response.status_code, body) == (200, BLOB)
+    assert response.headers['content-length'] == '10'
+
+    response, body = await get(('range', 'bytes=2-4'))
+    assert (response.status_code, body) == (206, b'234')
+    assert response.headers['content-range'] == 'bytes 2-4/10'
+
+    response, body = await get(('range', 'bytes=7-'))
+    assert (response.status_code, body) == (206, b'789')
+    assert response.headers['content-range'] == 'bytes 7-9/10'
+
+    response, body = await get(('range', 'bytes=-3'))
+    assert (response.status_code, body) == (206, b'789')
+
+    response, body = await get(('range', 'bytes=10-'))
+    assert response.status_code == 416
+    assert response.headers['content-range'] == 'bytes */10'
+
+    # unsupported ranges are ignored
+    for value in ('bytes=-0', 'bytes=4-2', 'bytes=0-1,4-5'):
+        response, body = await get(('range', value))
+        assert (response.status_code, body) == (200, BLOB)
+
+
+@pytest.mark.asyncio
+async def test_download_if_range():
+    response, body = await get(('range', 'bytes=2-4'), ('if-range', '"Gabc"'))
+    assert (response.status_code, body) == (206, b'234')
+
+    response, body = await get(('range', 'bytes=2-4'), ('if-range', '"Gother"'))
+    assert (response.status_code, body) == (200, BLOB)
+
+    response, body = await get(('if-none-match', '"Gabc"'))
+    assert response.status_code == 304
+
+
+class UploadAccount:
+    def __init__(self, wait=None, fail=None):
+        self.wait = wait
+        self.fail = fail
+        self.calls = 0
+
+    async def upload(self, stream, type):
+        self.calls += 1
+        if self.wait is not None:
+            await self.wait.wait()
+        size = 0
+        async for chunk in stream:
+            size += len(chunk)
+        if self.fail is not None:
+            raise self.fail
+        return {'accountId': 'u1', 'blobId': 'b1', 'type': type, 'size': size}
+
+
+async def post(account, chunks, *headers):
+    messages = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+                for i, chunk in enumerate(chunks)]
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    user = types.SimpleNamespace(username='u1', accounts={'u1': account})
+    request = Request({
+        'type': 'http',
+        'method': 'POST',
+        'user': user,
+        'path_params': {'accountId': 'u1'},
+        'headers': [(name.encode(), value.encode()) for name, value in headers],
+        'query_string': b'',
+    }, receive)
+    return await upload(request)
+
+
+@pytest.mark.asyncio
+async def test_upload():
+    response = await post(UploadAccount(), [b'abc', b'def'], ('content-type', 'text/plain'))
+    assert response.status_code == 201
+    assert json.loads(response.body) == {'accountId': 'u1', 'blobId': 'b1', 'type': 'text/plain', 'size': 6}
+    assert 'u1' not in uploads
+
+
+@pytest.mark.asyncio
+async def test_upload_too_large(monkeypatch):
+    monkeypatch.setitem(core.capability, 'maxSizeUpload', 5)
+    account = UploadAccount()
+    response = await post(account, [b'0123456789'], ('content-length', '10'))
+    assert response.status_code == 413
+    assert json.loads(response.body)['limit'] == 'maxSizeUpload'
+    assert account.calls == 0
+
+    # without content-length size is counted while body streams
+    response = await post(account, [b'012', b'345'])
+    assert response.status_code == 413
+    assert json.loads(response.body)['limit'] == 'maxSizeUpload'
+    assert account.calls == 1
+    assert 'u1' not in uploads
+
+
+@pytest.mark.asyncio
+async def test_upload_concurrent(monkeypatch):
+    monkeypatch.setitem(core.capability, 'maxConcurrentUpload', 1)
+    wait = asyncio.Event()
+    first = asyncio.ensure_future(post(UploadAccount(wait), [b'abc']))
+    while not uploads['u1']:
+        await asyncio.sleep(0)
+    response = await post(UploadAccount(), [b'abc'])
+    assert response.status_code == 429
+    assert json.loads(response.body)['limit'] == 'maxConcurrentUpload'
+    wait.set()
+    assert (await first).status_code == 201
+    assert 'u1' not in uploads
+
+    # counter is released when upload fails
+    with pytest.raises(RuntimeError):
+        await post(UploadAccount(fail=RuntimeError('storage down')), [b'abc'])
+    assert 'u1' not in uploads
+
+
+@pytest.mark.asyncio
+async def test_metrics_token(monkeypatch):
+    monkeypatch.setattr(server, 'METRICS_TOKEN', 'secret')
+
+    def request(*headers):
+        return Request({
+            'type': 'http',
+            'method': 'GET',
+            'headers': [(name.encode(), value.encode()) for name, value in headers],
+            'query_string': b'',
+        })
+
+    response = await server.metrics_endpoint(request())
+    assert response.status_code == 401
+    response = await server.metrics_endpoint(request(('authorization', 'Bearer wrong')))
+    assert response.status_code == 401
+    response = await server.metrics_endpoint(request(('authorization', 'Bearer secret')))
+    assert response.status_code == 200
+    assert b'imap_bytes_total' in response.body